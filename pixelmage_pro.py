@@ -1,25 +1,44 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # для замера времени старта
+
 import os
 import asyncio
 import logging
 import aiohttp
 import base64
+import io
 import uuid
 import json
+import re
 import hashlib
+import hmac
+import html
 import sqlite3
-from datetime import datetime
-from collections import deque
-from typing import List, Dict, Any, Union, Optional
-from aiohttp import ClientTimeout
+import unicodedata
+import ipaddress
+import bisect
+import functools
+import contextvars
+from datetime import datetime, timezone
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Dict, Any, Union, Optional, Callable, Tuple, Awaitable
+from aiohttp import ClientTimeout, web
+from PIL import Image, ImageOps
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, StateFilter
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import (
-    FSInputFile, ReplyKeyboardMarkup,
+    FSInputFile, BufferedInputFile, ReplyKeyboardMarkup,
     KeyboardButton, ReplyKeyboardRemove, InputMediaPhoto
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+LIBRARIES_IMPORTED = time.perf_counter()
 
 # ========== НАСТРОЙКА ЛОГИРОВАНИЯ ==========
 logging.basicConfig(
@@ -53,194 +72,1367 @@ if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
 else:
     logger.info("✅ YOOKASSA ключи найдены, реальная оплата включена")
 
+# ========== МЕТРИКИ ==========
+# Счетчики и гистограммы в памяти процесса, отдаются на /metrics в текстовом формате Prometheus.
+# Обновление - несколько операций со словарем, без блокировок: все вызовы идут из event loop
+# или из единственного потока БД.
+# Выключено по умолчанию: в режиме polling иначе открывался бы порт только ради /metrics.
+# С METRICS_TOKEN эндпоинт требует заголовок Authorization: Bearer <токен>
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+def format_labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, *label_values: Any, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # метки -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self.values: Dict[Tuple[Any, ...], List[Any]] = {}
+
+    def observe(self, value: float, *label_values: Any):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *label_values: Any) -> "HistogramTimer":
+        return HistogramTimer(self, label_values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = format_labels((*self.labels, "le"), (*label_values, bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+class HistogramTimer:
+    """with histogram.time(...): замеряет длительность блока"""
+
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram: Histogram, label_values: Tuple[Any, ...]):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+# Имя вспомогательной функции БД, которая сейчас выполняется: по нему размечается pixelmage_sqlite_seconds
+CURRENT_DB_HELPER: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("db_helper", default=None)
+
+def db_helper(func):
+    """Декоратор функций доступа к БД: их запросы попадают в метрики под именем функции.
+
+    Ставится только на функции, которые не вызывают чужой код, иначе чужие запросы
+    получат ту же метку.
+    """
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = CURRENT_DB_HELPER.set(name)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            CURRENT_DB_HELPER.reset(token)
+    return wrapper
+
+def timed(histogram: Histogram, *label_values: Any):
+    """Декоратор корутины: длительность каждого вызова попадает в гистограмму"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(*label_values):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+AI_TUNNEL_SECONDS = Histogram("pixelmage_aitunnel_request_seconds", "Длительность запросов к AI Tunnel",
+                              ("endpoint", "status"))
+OPERATION_SECONDS = Histogram("pixelmage_operation_seconds", "Длительность генерации, редактирования и доставки",
+                              ("operation",))
+QUEUE_WAIT_SECONDS = Histogram("pixelmage_queue_wait_seconds", "Ожидание задачи в очереди до начала выполнения")
+SQLITE_SECONDS = Histogram("pixelmage_sqlite_seconds", "Время запросов функции доступа к БД с ожиданием потока БД", ("helper",),
+                           buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+TELEGRAM_SEND_SECONDS = Histogram("pixelmage_telegram_send_seconds", "Длительность отправки фото в Telegram",
+                                  ("method",))
+BASE64_DECODE_SECONDS = Histogram("pixelmage_base64_decode_seconds", "Декодирование base64 одного изображения",
+                                  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+CACHE_LOOKUPS = Counter("pixelmage_cache_lookups_total", "Поиск промпта в кэше изображений", ("result",))
+REFUNDED_IMAGES = Counter("pixelmage_refunded_images_total", "Изображения, возвращенные на баланс")
+QUEUE_REJECTIONS = Counter("pixelmage_queue_rejections_total", "Задачи, отклоненные из-за заполненной очереди")
+
+METRICS = [AI_TUNNEL_SECONDS, OPERATION_SECONDS, QUEUE_WAIT_SECONDS, SQLITE_SECONDS, TELEGRAM_SEND_SECONDS,
+           BASE64_DECODE_SECONDS, CACHE_LOOKUPS, REFUNDED_IMAGES, QUEUE_REJECTIONS]
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+# ========== ХРАНИЛИЩЕ FSM ==========
+# memory - один процесс; sqlite - FSM и очередь задач общие для нескольких процессов
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+
+class SQLiteStorage(BaseStorage):
+    """FSM в таблице fsm_state базы STATE_DB_PATH: состояние видно всем процессам бота"""
+
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True)
+
+    @db_helper
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await state_db.execute(
+            """INSERT INTO fsm_state (key, state) VALUES (?, ?)
+               ON CONFLICT(key) DO UPDATE SET state = excluded.state""",
+            (self.key_builder.build(key), value)
+        )
+
+    @db_helper
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await state_db.fetchone("SELECT state FROM fsm_state WHERE key = ?", (self.key_builder.build(key),))
+        return row[0] if row else None
+
+    @db_helper
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await state_db.execute(
+            """INSERT INTO fsm_state (key, data) VALUES (?, ?)
+               ON CONFLICT(key) DO UPDATE SET data = excluded.data""",
+            (self.key_builder.build(key), json.dumps(dict(data)))
+        )
+
+    @db_helper
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await state_db.fetchone("SELECT data FROM fsm_state WHERE key = ?", (self.key_builder.build(key),))
+        return json.loads(row[0]) if row and row[0] else {}
+
+    @db_helper
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        storage_key = self.key_builder.build(key)
+
+        def update(conn: sqlite3.Connection) -> Dict[str, Any]:
+            # Чтение и запись под одной блокировкой, иначе другой процесс может затереть данные
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM fsm_state WHERE key = ?", (storage_key,)).fetchone()
+            current = json.loads(row[0]) if row and row[0] else {}
+            current.update(data)
+            conn.execute(
+                """INSERT INTO fsm_state (key, data) VALUES (?, ?)
+                   ON CONFLICT(key) DO UPDATE SET data = excluded.data""",
+                (storage_key, json.dumps(current))
+            )
+            return current
+
+        return dict(await state_db.transaction(update))
+
+    async def close(self) -> None:
+        pass
+
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Bot и его HTTP-сессия создаются при запуске приложения, а не при импорте модуля
+bot: Optional[Bot] = None
+storage = SQLiteStorage() if STATE_BACKEND == "sqlite" else MemoryStorage()
 dp = Dispatcher(storage=storage)
 
+def get_bot() -> Bot:
+    """Возвращает бота (создает его при первом обращении, обычно в BotApplication.start)"""
+    global bot
+    if bot is None:
+        bot = Bot(token=BOT_TOKEN)
+    return bot
+
 # ========== КОНСТАНТЫ ==========
 YOUR_USER_ID = 953958006  # ⬅️ ЗАМЕНИТЕ ЭТО НА ВАШ РЕАЛЬНЫЙ TELEGRAM ID!
 
-# ========== ВОССТАНОВЛЕНИЕ БАЗЫ ДАННЫХ ==========
-def restore_database_from_yookassa():
-    """Восстанавливает данные платежей из ЮKassa"""
-    try:
-        if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
-            logger.warning("⚠️ Нет ключей ЮKassa для восстановления данных")
-            return
-        
-        import yookassa
-        from yookassa import Configuration, Payment
-        
-        # Настройка
-        Configuration.account_id = YOOKASSA_SHOP_ID
-        Configuration.secret_key = YOOKASSA_SECRET_KEY
-        
-        # Создаем или пересоздаем базу данных
-        conn = sqlite3.connect('payments.db')
-        c = conn.cursor()
-        
-        # Очищаем таблицы (сохраняем структуру)
-        c.execute("DELETE FROM payments")
-        c.execute("DELETE FROM user_balance")
-        c.execute("DELETE FROM payment_history")
-        
-        # Получаем платежи из ЮKassa
+# ========== СЛОЙ ДОСТУПА К SQLITE ==========
+PAYMENTS_DB_PATH = os.getenv("PAYMENTS_DB_PATH", "payments.db")
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "bot_cache.db")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# FSM и общая очередь задач (STATE_BACKEND=sqlite) живут в отдельном файле: их частые
+# блокировки на запись не должны конкурировать с платежами и журналом баланса
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+
+class Database:
+    """Одно постоянное соединение: payments_path как main, cache_path (если задан) как cache.
+
+    Все запросы выполняются в отдельном потоке, поэтому event loop не ждет диск.
+    Повторяющиеся SQL-строки попадают в кэш подготовленных выражений sqlite3.
+    """
+
+    def __init__(self, payments_path: str, cache_path: Optional[str], busy_timeout_ms: int = 5000):
+        self.payments_path = payments_path
+        self.cache_path = cache_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """Открывает соединение (вызывается только из потока БД)"""
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.payments_path,
+                timeout=self.busy_timeout_ms / 1000,
+                cached_statements=256
+            )
+            conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+            # Удаление строк через OR REPLACE должно запускать триггеры счетчиков
+            conn.execute("PRAGMA recursive_triggers = ON")
+            schemas = ["main"]
+            if self.cache_path:
+                conn.execute("ATTACH DATABASE ? AS cache", (self.cache_path,))
+                schemas.append("cache")
+            for schema in schemas:
+                conn.execute(f"PRAGMA {schema}.journal_mode = WAL")
+                conn.execute(f"PRAGMA {schema}.synchronous = NORMAL")
+            self._conn = conn
+        return self._conn
+
+    def _run_in_transaction(self, fn: Callable, *args):
+        conn = self._get_conn()
         try:
-            payments = Payment.list({"limit": 100})  # Берем последние 100 платежей
-            
-            restored_count = 0
-            for payment in payments.items:
-                if payment.status == 'succeeded' and payment.metadata and 'user_id' in payment.metadata:
-                    user_id = int(payment.metadata['user_id'])
-                    amount = float(payment.amount.value)
-                    
-                    # Определяем сколько изображений дать за сумму
-                    images_to_add = 0
-                    if amount == 39.0:
-                        images_to_add = 1
-                    elif amount == 29.0:
-                        images_to_add = 1
-                    elif amount == 99.0:
-                        images_to_add = 5
-                    elif amount == 199.0:
-                        images_to_add = 15
-                    
-                    if images_to_add > 0:
-                        # Восстанавливаем платеж
-                        c.execute('''INSERT OR IGNORE INTO payments 
-                                     (user_id, amount, payment_id, yookassa_payment_id, status, created_at) 
-                                     VALUES (?, ?, ?, ?, ?, ?)''',
-                                  (user_id, amount, f"restored_{payment.id}", 
-                                   payment.id, 'completed', 
-                                   payment.created_at or datetime.now().isoformat()))
-                        
-                        # Восстанавливаем баланс пользователя
-                        c.execute('''INSERT OR REPLACE INTO user_balance 
-                                     (user_id, images_left, total_spent) 
-                                     VALUES (?, COALESCE((SELECT images_left FROM user_balance WHERE user_id = ?), 0) + ?,
-                                             COALESCE((SELECT total_spent FROM user_balance WHERE user_id = ?), 0) + ?)''',
-                                  (user_id, user_id, images_to_add, user_id, amount))
-                        
-                        # Восстанавливаем историю
-                        description = f"Восстановленный платеж: {amount} руб."
-                        c.execute('''INSERT INTO payment_history 
-                                     (user_id, amount, description, status, created_at) 
-                                     VALUES (?, ?, ?, ?, ?)''',
-                                  (user_id, amount, description, 'completed', 
-                                   payment.created_at or datetime.now().isoformat()))
-                        
-                        restored_count += 1
-                        logger.info(f"✅ Восстановлен платеж: user_id={user_id}, amount={amount}, images={images_to_add}")
-            
+            result = fn(conn, *args)
             conn.commit()
-            conn.close()
-            
-            logger.info(f"✅ Восстановлено {restored_count} платежей из ЮKassa")
-            
-            # Проверяем что восстановилось
-            conn = sqlite3.connect('payments.db')
-            c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM user_balance")
-            balance_count = c.fetchone()[0]
-            c.execute("SELECT SUM(amount) FROM payments WHERE status = 'completed'")
-            total_income = c.fetchone()[0] or 0
-            conn.close()
-            
-            logger.info(f"✅ В БД: {balance_count} пользователей, {total_income} руб. доход")
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка восстановления из ЮKassa: {e}")
-            conn.close()
-    
-    except Exception as e:
-        logger.error(f"❌ Ошибка при восстановлении БД: {e}")
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    def transaction_sync(self, fn: Callable, *args):
+        """Выполняет fn(conn, *args) в транзакции, блокируя вызывающий поток"""
+        with SQLITE_SECONDS.time(fn.__name__):
+            return self._executor.submit(self._run_in_transaction, fn, *args).result()
+
+    async def _submit(self, helper: str, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        # Запросы вне функций с @db_helper размечаются переданной меткой, методом или именем fn
+        with SQLITE_SECONDS.time(CURRENT_DB_HELPER.get() or helper):
+            return await loop.run_in_executor(self._executor, self._run_in_transaction, fn, *args)
+
+    async def transaction(self, fn: Callable, *args):
+        """Выполняет fn(conn, *args) в транзакции в потоке БД"""
+        return await self._submit(fn.__name__, fn, *args)
+
+    # label - метка в метриках для запросов из обработчиков и циклов, которым не подходит @db_helper
+    async def fetchone(self, sql: str, params: tuple = (), label: Optional[str] = None):
+        return await self._submit(label or "fetchone", lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = (), label: Optional[str] = None):
+        return await self._submit(label or "fetchall", lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = (), label: Optional[str] = None) -> int:
+        """Выполняет изменяющий запрос и возвращает число затронутых строк"""
+        return await self._submit(label or "execute", lambda conn: conn.execute(sql, params).rowcount)
+
+    def close(self):
+        def close_conn():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(close_conn).result()
+        self._executor.shutdown(wait=True)
+
+db = Database(PAYMENTS_DB_PATH, CACHE_DB_PATH, DB_BUSY_TIMEOUT_MS)
+state_db = Database(STATE_DB_PATH, None, DB_BUSY_TIMEOUT_MS)
+
+# ========== ХРАНИЛИЩЕ ИЗОБРАЖЕНИЙ ==========
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+# Лимиты действуют на процесс: у каждого процесса свой LRU-индекс, поэтому при
+# STATE_BACKEND=sqlite и N процессах на диске может оказаться до N * IMAGE_STORE_MAX_BYTES
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(500 * 1024 * 1024)))
+IMAGE_STORE_MAX_ENTRIES = int(os.getenv("IMAGE_STORE_MAX_ENTRIES", "2000"))
+# Файлы моложе этого срока не считаются сиротами: их может писать или отправлять другой процесс
+IMAGE_STORE_ORPHAN_GRACE = int(os.getenv("IMAGE_STORE_ORPHAN_GRACE", str(3600)))
+
+class FrequencySketch:
+    """Count-Min Sketch с периодическим старением счетчиков (фильтр TinyLFU)"""
+
+    MAX_COUNT = 15
+
+    def __init__(self, width: int = 4096, depth: int = 4, sample_size: int = 20000):
+        self.width = width
+        self.depth = depth
+        self.sample_size = sample_size
+        self.additions = 0
+        self.table = [[0] * width for _ in range(depth)]
+
+    def _indexes(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        for row in range(self.depth):
+            yield row, int.from_bytes(digest[row * 4:(row + 1) * 4], "little") % self.width
+
+    def increment(self, key: str):
+        for row, index in self._indexes(key):
+            if self.table[row][index] < self.MAX_COUNT:
+                self.table[row][index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            # Старение: старые популярные ключи постепенно уступают новым
+            self.table = [[count // 2 for count in row] for row in self.table]
+            self.additions //= 2
+
+    def estimate(self, key: str) -> int:
+        return min(self.table[row][index] for row, index in self._indexes(key))
+
+class ImageStore:
+    """Хранилище изображений по хэшу содержимого с LRU-вытеснением и TinyLFU-допуском.
+
+    Файлы лежат в IMAGE_STORE_DIR/ab/cd/<sha256>.png. Только допущенные (admit) файлы
+    учитываются в лимитах и ссылаются из image_cache; остальные удаляются после отправки.
+    Индекс и лимиты у каждого процесса свои, каталог при этом общий.
+    Индекс меняется только в event loop (или в потоке БД при старте), файловые операции
+    из корутин идут через asyncio.to_thread: put, delete_files, discard_files.
+    """
+
+    def __init__(self, root: str, max_bytes: int, max_entries: int, orphan_grace: int = 3600):
+        self.root = root
+        self.orphan_grace = orphan_grace
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # путь -> (размер, ключ кэша); порядок = LRU (первый - самый старый)
+        self.entries: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+        self.total_bytes = 0
+        self.sketch = FrequencySketch(sample_size=max(1000, max_entries * 10))
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "rejections": 0}
+
+    def path_for(self, content_hash: str, ext: str = "png") -> str:
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], f"{content_hash}.{ext}")
+
+    def new_temp_path(self) -> str:
+        """Путь для потоковой записи; незавершенные файлы удалит rebuild_index"""
+        temp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        return os.path.join(temp_dir, f"{uuid.uuid4().hex}.tmp")
+
+    def commit_temp(self, temp_path: str, content_hash: str, ext: str = "png") -> str:
+        """Переносит записанный файл на место по хэшу содержимого"""
+        path = self.path_for(content_hash, ext)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return path
+
+    def put(self, data: bytes, ext: str = "png") -> str:
+        """Записывает изображение и возвращает путь (еще не допущено в кэш)"""
+        temp_path = self.new_temp_path()
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        return self.commit_temp(temp_path, hashlib.sha256(data).hexdigest(), ext)
+
+    def record_lookup(self, key: str, hit: bool):
+        self.sketch.increment(key)
+        self.stats["hits" if hit else "misses"] += 1
+        CACHE_LOOKUPS.inc("hit" if hit else "miss")
+
+    def touch(self, path: str):
+        if path in self.entries:
+            self.entries.move_to_end(path)
+
+    def admit(self, path: str, key: str, size: int) -> Tuple[bool, List[str]]:
+        """Решает, оставить ли файл в кэше; возвращает (допущен, вытесненные пути).
+
+        Вытесненные файлы убираются из индекса, удалить их с диска должен вызывающий код.
+        """
+        if path in self.entries:
+            self.touch(path)
+            return True, []
+
+        if size > self.max_bytes:
+            self.stats["rejections"] += 1
+            return False, []
+
+        candidate_freq = self.sketch.estimate(key)
+        victims = []
+        projected_bytes = self.total_bytes + size
+        projected_entries = len(self.entries) + 1
+        for victim_path, (victim_size, victim_key) in self.entries.items():
+            if projected_bytes <= self.max_bytes and projected_entries <= self.max_entries:
+                break
+            if candidate_freq <= self.sketch.estimate(victim_key):
+                # Новый файл менее популярен, чем самый старый - не вытесняем ради него
+                self.stats["rejections"] += 1
+                return False, []
+            victims.append(victim_path)
+            projected_bytes -= victim_size
+            projected_entries -= 1
+
+        for victim_path in victims:
+            self.forget(victim_path)
+            self.stats["evictions"] += 1
+
+        self.entries[path] = (size, key)
+        self.total_bytes += size
+        return True, victims
+
+    def forget(self, path: str):
+        """Убирает файл из индекса, не трогая диск"""
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.total_bytes -= entry[0]
+
+    def delete_files(self, paths: List[str]):
+        for path in paths:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось удалить {path}: {e}")
+
+    def remove(self, path: str):
+        self.forget(path)
+        self.delete_files([path])
+
+    def discard(self, path: str):
+        """Удаляет файл после отправки, если он не попал в кэш"""
+        if path not in self.entries:
+            self.remove(path)
+
+    async def discard_files(self, paths: List[str]):
+        """discard для нескольких файлов: проверка индекса в event loop, удаление в потоке"""
+        unreferenced = [path for path in paths if path not in self.entries]
+        if unreferenced:
+            await asyncio.to_thread(self.delete_files, unreferenced)
+
+    def rebuild_index(self, conn: sqlite3.Connection):
+        """Сверяет image_cache с файлами на диске (выполняется в потоке БД при старте)"""
+        self.entries.clear()
+        self.total_bytes = 0
+        c = conn.cursor()
+        rows = c.execute("SELECT prompt_hash, file_path FROM cache.image_cache ORDER BY created_at").fetchall()
+        stale_keys = []
+        for key, path in rows:
+            if path and path in self.entries:
+                continue
+            if not path or not os.path.exists(path):
+                stale_keys.append((key,))
+                continue
+            size = os.path.getsize(path)
+            self.entries[path] = (size, key)
+            self.total_bytes += size
+        c.executemany("DELETE FROM cache.image_cache WHERE prompt_hash = ?", stale_keys)
+
+        # Файлы без записи в индексе (обрывы записи, упавшие отправки). Свежие не трогаем:
+        # в общем каталоге это могут быть потоки и неотправленные фото другого процесса
+        orphans = 0
+        deadline = time.time() - self.orphan_grace
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path in self.entries:
+                    continue
+                try:
+                    if os.path.getmtime(path) > deadline:
+                        continue
+                except OSError:
+                    continue
+                # Старые файлы в tmp/ - недописанные потоки завершившихся процессов
+                self.remove(path)
+                orphans += 1
+
+        # Лимиты могли уменьшиться между запусками
+        evicted = []
+        while self.entries and (self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            path = next(iter(self.entries))
+            self.remove(path)
+            evicted.append((path,))
+        c.executemany("DELETE FROM cache.image_cache WHERE file_path = ?", evicted)
+
+        logger.info(
+            f"🗂 Хранилище изображений: {len(self.entries)} файлов, {self.total_bytes // 1024} КБ "
+            f"(удалено записей: {len(stale_keys)}, сирот: {orphans}, вытеснено: {len(evicted)})"
+        )
+
+    def stats_snapshot(self) -> Dict[str, int]:
+        return {**self.stats, "entries": len(self.entries), "bytes": self.total_bytes}
+
+image_store = ImageStore(IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES, IMAGE_STORE_MAX_ENTRIES, IMAGE_STORE_ORPHAN_GRACE)
+
+# ========== КЛЮЧИ КЭША ==========
+# Все параметры генерации входят в ключ: смена модели или размера не отдаст старые картинки
+GENERATION_PARAMS = {
+    "model": "flux.2-pro",
+    "width": 1024,
+    "height": 1024,
+    "steps": 20,
+    "num_images": 1
+}
+CACHE_KEY_VERSION = 2
+
+def normalize_prompt(prompt: str) -> str:
+    """Канонический вид промпта: NFKC, без учета регистра, одиночные пробелы"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+
+def build_cache_key(prompt: str, params: Dict[str, Any] = GENERATION_PARAMS) -> str:
+    """Ключ кэша из нормализованного промпта и параметров генерации"""
+    payload = json.dumps(
+        {"v": CACHE_KEY_VERSION, "prompt": normalize_prompt(prompt), "params": params},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def migrate_cache_keys(conn: sqlite3.Connection):
+    """Пересчитывает ключи старых версий; записи без текста промпта (md5) удаляются"""
+    c = conn.cursor()
+    rows = c.execute("SELECT prompt_hash, prompt, params FROM cache.image_cache "
+                     "WHERE key_version IS NULL OR key_version != ?", (CACHE_KEY_VERSION,)).fetchall()
+    rekeyed = dropped = 0
+    for old_key, prompt, params in rows:
+        if prompt and params:
+            c.execute("UPDATE OR REPLACE cache.image_cache SET prompt_hash = ?, key_version = ? WHERE prompt_hash = ?",
+                      (build_cache_key(prompt, json.loads(params)), CACHE_KEY_VERSION, old_key))
+            rekeyed += 1
+        else:
+            c.execute("DELETE FROM cache.image_cache WHERE prompt_hash = ?", (old_key,))
+            dropped += 1
+    if rows:
+        logger.info(f"🔑 Миграция ключей кэша: пересчитано {rekeyed}, удалено {dropped}")
+
+# ========== МИГРАЦИИ СХЕМЫ ==========
+# Версия схемы payments.db хранится в PRAGMA main.user_version.
+# Каждая миграция применяется один раз, в своей транзакции, вместе с новой версией.
+EPOCH_NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+# created_at бывал строкой CURRENT_TIMESTAMP, str(datetime) и ISO 8601 из ЮKassa
+EPOCH_FROM_CREATED_AT_SQL = ("CASE WHEN typeof(created_at) IN ('integer', 'real') THEN CAST(created_at AS INTEGER) "
+                             "ELSE CAST(strftime('%s', created_at) AS INTEGER) END")
+
+def rebuild_with_epoch_timestamps(conn: sqlite3.Connection, table: str, columns: str):
+    """Пересоздает таблицу с created_at INTEGER (секунды Unix), переводя старые значения"""
+    names = ", ".join(column.split()[0] for column in columns.split(","))
+    conn.execute(f"CREATE TABLE main.{table}_new ({columns}, created_at INTEGER DEFAULT ({EPOCH_NOW_SQL}))")
+    conn.execute(f"INSERT INTO main.{table}_new ({names}, created_at) "
+                 f"SELECT {names}, {EPOCH_FROM_CREATED_AT_SQL} FROM main.{table}")
+    conn.execute(f"DROP TABLE main.{table}")
+    conn.execute(f"ALTER TABLE main.{table}_new RENAME TO {table}")
+
+def migration_epoch_timestamps(conn: sqlite3.Connection):
+    rebuild_with_epoch_timestamps(
+        conn, "payments",
+        "user_id INTEGER, amount REAL, payment_id TEXT, status TEXT, yookassa_payment_id TEXT"
+    )
+    rebuild_with_epoch_timestamps(
+        conn, "payment_history",
+        "user_id INTEGER, amount REAL, description TEXT, status TEXT"
+    )
+
+def migration_unique_yookassa_id(conn: sqlite3.Connection):
+    # Дубликаты могли появиться до индекса; оставляем зачисленную запись, иначе самую раннюю
+    removed = conn.execute(
+        """DELETE FROM main.payments WHERE rowid IN (
+               SELECT rowid FROM (
+                   SELECT rowid, ROW_NUMBER() OVER (
+                       PARTITION BY yookassa_payment_id ORDER BY status = 'completed' DESC, rowid
+                   ) AS position
+                   FROM main.payments WHERE yookassa_payment_id IS NOT NULL
+               ) WHERE position > 1
+           )"""
+    ).rowcount
+    if removed:
+        logger.warning(f"⚠️ Удалено дубликатов платежей ЮKassa: {removed}")
+    conn.execute("CREATE UNIQUE INDEX main.ux_payments_yookassa_payment_id "
+                 "ON payments (yookassa_payment_id) WHERE yookassa_payment_id IS NOT NULL")
+
+def migration_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX main.idx_payments_user_status ON payments (user_id, status, created_at)")
+    conn.execute("CREATE INDEX main.idx_payments_status ON payments (status)")
+    conn.execute("CREATE INDEX main.idx_payments_payment_id ON payments (payment_id)")
+    conn.execute("CREATE INDEX main.idx_payment_history_user ON payment_history (user_id, created_at)")
+    conn.execute("CREATE INDEX main.idx_balance_holds_created ON balance_holds (created_at)")
+
+def migration_free_gift_flag(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE main.user_balance ADD COLUMN free_gift_claimed INTEGER NOT NULL DEFAULT 0")
+    # Раньше подарок определялся по тексту в истории платежей
+    conn.execute("INSERT OR IGNORE INTO main.user_balance (user_id) "
+                 "SELECT DISTINCT user_id FROM main.payment_history "
+                 "WHERE description LIKE '%бесплатный%' OR description LIKE '%подарок%' OR description LIKE '%тест%'")
+    conn.execute("UPDATE main.user_balance SET free_gift_claimed = 1 WHERE user_id IN ("
+                 "SELECT user_id FROM main.payment_history "
+                 "WHERE description LIKE '%бесплатный%' OR description LIKE '%подарок%' OR description LIKE '%тест%')")
+
+# Счетчики админ-панели ведут триггеры: они срабатывают в той же транзакции, что и запись,
+# поэтому панель читает несколько строк вместо агрегатов по всем таблицам
+def migration_admin_counters(conn: sqlite3.Connection):
+    conn.execute("CREATE TABLE main.admin_counters (name TEXT PRIMARY KEY, value REAL NOT NULL DEFAULT 0)")
+    conn.execute("""INSERT INTO main.admin_counters (name, value) VALUES
+        ('users', (SELECT COUNT(*) FROM main.user_balance)),
+        ('users_with_balance', (SELECT COUNT(*) FROM main.user_balance WHERE images_left > 0)),
+        ('paying_users', (SELECT COUNT(DISTINCT user_id) FROM main.payments WHERE status = 'completed')),
+        ('completed_payments', (SELECT COUNT(*) FROM main.payments WHERE status = 'completed')),
+        ('income', (SELECT COALESCE(SUM(amount), 0) FROM main.payments WHERE status = 'completed'))""")
+
+    conn.execute("""CREATE TRIGGER main.trg_user_balance_insert AFTER INSERT ON user_balance BEGIN
+        UPDATE admin_counters SET value = value + 1 WHERE name = 'users';
+        UPDATE admin_counters SET value = value + (NEW.images_left > 0) WHERE name = 'users_with_balance';
+    END""")
+    conn.execute("""CREATE TRIGGER main.trg_user_balance_update AFTER UPDATE OF images_left ON user_balance
+        WHEN (NEW.images_left > 0) != (OLD.images_left > 0) BEGIN
+        UPDATE admin_counters SET value = value + (NEW.images_left > 0) - (OLD.images_left > 0)
+            WHERE name = 'users_with_balance';
+    END""")
+    conn.execute("""CREATE TRIGGER main.trg_user_balance_delete AFTER DELETE ON user_balance BEGIN
+        UPDATE admin_counters SET value = value - 1 WHERE name = 'users';
+        UPDATE admin_counters SET value = value - (OLD.images_left > 0) WHERE name = 'users_with_balance';
+    END""")
+
+    # Платящий пользователь считается по первому зачисленному платежу (поиск по индексу user_id, status)
+    conn.execute("""CREATE TRIGGER main.trg_payments_insert AFTER INSERT ON payments
+        WHEN NEW.status = 'completed' BEGIN
+        UPDATE admin_counters SET value = value + 1 WHERE name = 'completed_payments';
+        UPDATE admin_counters SET value = value + NEW.amount WHERE name = 'income';
+        UPDATE admin_counters SET value = value + NOT EXISTS (
+            SELECT 1 FROM payments WHERE user_id = NEW.user_id AND status = 'completed' AND rowid != NEW.rowid
+        ) WHERE name = 'paying_users';
+    END""")
+    conn.execute("""CREATE TRIGGER main.trg_payments_update AFTER UPDATE OF status ON payments
+        WHEN (NEW.status = 'completed') != (OLD.status = 'completed') BEGIN
+        UPDATE admin_counters SET value = value + (NEW.status = 'completed') - (OLD.status = 'completed')
+            WHERE name = 'completed_payments';
+        UPDATE admin_counters SET value = value + (NEW.status = 'completed') * NEW.amount
+            - (OLD.status = 'completed') * OLD.amount WHERE name = 'income';
+        UPDATE admin_counters SET value = value + ((NEW.status = 'completed') - (OLD.status = 'completed')) * NOT EXISTS (
+            SELECT 1 FROM payments WHERE user_id = NEW.user_id AND status = 'completed' AND rowid != NEW.rowid
+        ) WHERE name = 'paying_users';
+    END""")
+    conn.execute("""CREATE TRIGGER main.trg_payments_delete AFTER DELETE ON payments
+        WHEN OLD.status = 'completed' BEGIN
+        UPDATE admin_counters SET value = value - 1 WHERE name = 'completed_payments';
+        UPDATE admin_counters SET value = value - OLD.amount WHERE name = 'income';
+        UPDATE admin_counters SET value = value - NOT EXISTS (
+            SELECT 1 FROM payments WHERE user_id = OLD.user_id AND status = 'completed'
+        ) WHERE name = 'paying_users';
+    END""")
+
+def migration_balance_ledger(conn: sqlite3.Connection):
+    # Раньше журнал создавался при старте, вне миграций: такой журнал уже начат, повторно не заполняем
+    if conn.execute("SELECT 1 FROM main.sqlite_master WHERE name = 'balance_ledger'").fetchone() is None:
+        conn.execute('''CREATE TABLE main.balance_ledger
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         user_id INTEGER,
+                         delta INTEGER,
+                         kind TEXT,
+                         ref TEXT,
+                         created_at INTEGER)''')
+        # Балансы, накопленные до журнала, становятся его начальными записями
+        conn.execute(f"INSERT INTO main.balance_ledger (user_id, delta, kind, created_at) "
+                     f"SELECT user_id, images_left, 'opening', {EPOCH_NOW_SQL} FROM main.user_balance")
+    conn.execute("CREATE INDEX IF NOT EXISTS main.idx_balance_ledger_user ON balance_ledger (user_id)")
+
+MIGRATIONS = [
+    (1, "created_at в секундах Unix", migration_epoch_timestamps),
+    (2, "уникальный yookassa_payment_id", migration_unique_yookassa_id),
+    (3, "индексы платежей и резервов", migration_indexes),
+    (4, "флаг бесплатного подарка", migration_free_gift_flag),
+    (5, "счетчики админ-панели", migration_admin_counters),
+    (6, "журнал баланса", migration_balance_ledger),
+]
+
+def migration_cache_counters(conn: sqlite3.Connection):
+    conn.execute("CREATE TABLE cache.admin_counters (name TEXT PRIMARY KEY, value REAL NOT NULL DEFAULT 0)")
+    conn.execute("""INSERT INTO cache.admin_counters (name, value) VALUES
+        ('cached_images', (SELECT COUNT(*) FROM cache.image_cache)),
+        ('stats_users', (SELECT COUNT(*) FROM cache.user_stats)),
+        ('generated_images', (SELECT COALESCE(SUM(total_images), 0) FROM cache.user_stats))""")
+
+    # INSERT OR REPLACE удаляет старую строку; ее триггер срабатывает при PRAGMA recursive_triggers
+    conn.execute("""CREATE TRIGGER cache.trg_image_cache_insert AFTER INSERT ON image_cache BEGIN
+        UPDATE admin_counters SET value = value + 1 WHERE name = 'cached_images';
+    END""")
+    conn.execute("""CREATE TRIGGER cache.trg_image_cache_delete AFTER DELETE ON image_cache BEGIN
+        UPDATE admin_counters SET value = value - 1 WHERE name = 'cached_images';
+    END""")
+    conn.execute("""CREATE TRIGGER cache.trg_user_stats_insert AFTER INSERT ON user_stats BEGIN
+        UPDATE admin_counters SET value = value + 1 WHERE name = 'stats_users';
+        UPDATE admin_counters SET value = value + COALESCE(NEW.total_images, 0) WHERE name = 'generated_images';
+    END""")
+    conn.execute("""CREATE TRIGGER cache.trg_user_stats_update AFTER UPDATE OF total_images ON user_stats BEGIN
+        UPDATE admin_counters SET value = value + COALESCE(NEW.total_images, 0) - COALESCE(OLD.total_images, 0)
+            WHERE name = 'generated_images';
+    END""")
+    conn.execute("""CREATE TRIGGER cache.trg_user_stats_delete AFTER DELETE ON user_stats BEGIN
+        UPDATE admin_counters SET value = value - 1 WHERE name = 'stats_users';
+        UPDATE admin_counters SET value = value - COALESCE(OLD.total_images, 0) WHERE name = 'generated_images';
+    END""")
+
+def migration_drop_shared_state(conn: sqlite3.Connection):
+    # FSM и очередь задач переехали в STATE_DB_PATH; их строки - временное состояние, переносить нечего
+    conn.execute("DROP TABLE IF EXISTS cache.fsm_state")
+    conn.execute("DROP TABLE IF EXISTS cache.job_queue")
+
+# bot_cache.db можно удалить независимо от payments.db, поэтому у него своя версия
+CACHE_MIGRATIONS = [
+    (1, "счетчики кэша и статистики", migration_cache_counters),
+    (2, "FSM и очередь задач перенесены в отдельную базу", migration_drop_shared_state),
+]
+
+def apply_migrations(schema: str, migrations: List[Tuple[int, str, Callable]]):
+    """Применяет недостающие миграции; параллельный процесс дождется блокировки и пропустит их"""
+    def apply_migration(conn: sqlite3.Connection, version: int, fn: Callable) -> bool:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0] >= version:
+            return False
+        fn(conn)
+        conn.execute(f"PRAGMA {schema}.user_version = {version}")
+        return True
+
+    for version, description, fn in migrations:
+        started = time.perf_counter()
+        if db.transaction_sync(apply_migration, version, fn):
+            logger.info(f"🗄 Миграция {schema} {version} ({description}) применена за {time.perf_counter() - started:.2f} с")
+
+@db_helper
+async def read_admin_counters() -> Dict[str, float]:
+    """Текущие значения счетчиков из обеих баз"""
+    rows = await db.fetchall("SELECT name, value FROM main.admin_counters "
+                             "UNION ALL SELECT name, value FROM cache.admin_counters")
+    return {name: value for name, value in rows}
 
 # ========== БАЗА ДАННЫХ ==========
 def init_db():
     """Инициализация всех баз данных"""
-    # База для кэша
-    conn = sqlite3.connect('bot_cache.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS image_cache
-                 (prompt_hash TEXT PRIMARY KEY,
-                  file_path TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS user_stats
-                 (user_id INTEGER PRIMARY KEY,
-                  requests_count INTEGER DEFAULT 0,
-                  total_images INTEGER DEFAULT 0,
-                  last_request TIMESTAMP)''')
-    conn.commit()
-    conn.close()
-    
-    # База для платежей
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS payments
-                 (user_id INTEGER,
-                  amount REAL,
-                  payment_id TEXT,
-                  status TEXT,
-                  yookassa_payment_id TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS user_balance
-                 (user_id INTEGER PRIMARY KEY,
-                  images_left INTEGER DEFAULT 0,
-                  total_spent REAL DEFAULT 0)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS payment_history
-                 (user_id INTEGER,
-                  amount REAL,
-                  description TEXT,
-                  status TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    def create_schema(conn: sqlite3.Connection):
+        c = conn.cursor()
+        # База для кэша
+        c.execute('''CREATE TABLE IF NOT EXISTS cache.image_cache
+                     (prompt_hash TEXT PRIMARY KEY,
+                      file_path TEXT,
+                      file_id TEXT,
+                      file_unique_id TEXT,
+                      prompt TEXT,
+                      params TEXT,
+                      key_version INTEGER,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        # Старые базы: добавляем недостающие колонки
+        cache_columns = {row[1] for row in c.execute("PRAGMA cache.table_info(image_cache)")}
+        for column, column_type in (("file_id", "TEXT"), ("file_unique_id", "TEXT"), ("prompt", "TEXT"),
+                                    ("params", "TEXT"), ("key_version", "INTEGER")):
+            if column not in cache_columns:
+                c.execute(f"ALTER TABLE cache.image_cache ADD COLUMN {column} {column_type}")
+        c.execute('''CREATE TABLE IF NOT EXISTS cache.user_stats
+                     (user_id INTEGER PRIMARY KEY,
+                      requests_count INTEGER DEFAULT 0,
+                      total_images INTEGER DEFAULT 0,
+                      last_request TIMESTAMP)''')
+        
+        # База для платежей
+        c.execute('''CREATE TABLE IF NOT EXISTS main.payments
+                     (user_id INTEGER,
+                      amount REAL,
+                      payment_id TEXT,
+                      status TEXT,
+                      yookassa_payment_id TEXT,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS main.user_balance
+                     (user_id INTEGER PRIMARY KEY,
+                      images_left INTEGER DEFAULT 0,
+                      total_spent REAL DEFAULT 0)''')
+        # Резервы под выполняющиеся задачи; журнал баланса создает миграция 6
+        c.execute('''CREATE TABLE IF NOT EXISTS main.balance_holds
+                     (hold_id TEXT PRIMARY KEY,
+                      user_id INTEGER,
+                      images INTEGER,
+                      created_at INTEGER)''')
+        # Отметки фоновой синхронизации с ЮKassa
+        c.execute('''CREATE TABLE IF NOT EXISTS main.sync_state
+                     (name TEXT PRIMARY KEY,
+                      value TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS main.payment_history
+                     (user_id INTEGER,
+                      amount REAL,
+                      description TEXT,
+                      status TEXT,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     
-    # Пытаемся восстановить данные из ЮKassa при старте
-    restore_database_from_yookassa()
-
-init_db()
+    def create_state_schema(conn: sqlite3.Connection):
+        # Общее состояние процессов бота (STATE_BACKEND=sqlite)
+        conn.execute('''CREATE TABLE IF NOT EXISTS fsm_state
+                        (key TEXT PRIMARY KEY,
+                         state TEXT,
+                         data TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS job_queue
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         user_id INTEGER,
+                         priority INTEGER,
+                         owner TEXT,
+                         status TEXT DEFAULT 'waiting',
+                         lease_until REAL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_status ON job_queue (status, priority, user_id, id)")
+
+    db.transaction_sync(create_schema)
+    if STATE_BACKEND == "sqlite":
+        state_db.transaction_sync(create_state_schema)
+    apply_migrations("main", MIGRATIONS)
+    apply_migrations("cache", CACHE_MIGRATIONS)
+    db.transaction_sync(migrate_cache_keys)
+    db.transaction_sync(image_store.rebuild_index)
 
 # ========== ОЧЕРЕДЬ ЗАПРОСОВ ==========
-request_queue = deque()
-queue_lock = asyncio.Lock()
-PROCESSING_LIMIT = 3
+# Одновременных задач на процесс: при STATE_BACKEND=sqlite N процессов выполняют до N * JOB_WORKERS
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "3"))
+MAX_WAITING_JOBS = int(os.getenv("MAX_WAITING_JOBS", "50"))
+PRIORITY_MIN_SPENT = 99.0  # Купившие пакет идут в приоритетную очередь
 MAX_PROMPTS_PER_BATCH = 5
 
+class QueueFullError(Exception):
+    """Очередь ожидания заполнена"""
+
+class Job:
+    def __init__(self, user_id: int, func: Callable[[], Awaitable[Any]],
+                 on_position: Optional[Callable[[int], Awaitable[None]]]):
+        self.user_id = user_id
+        self.func = func
+        self.on_position = on_position
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.last_position: Optional[int] = None
+        self.enqueued_at = time.perf_counter()
+        self._notify_lock = asyncio.Lock()
+
+    def notify_position(self, position: int) -> Optional[asyncio.Task]:
+        """Отправляет позицию в очереди; уведомления одной задачи доставляются строго по порядку"""
+        if self.on_position is None or self.last_position == position:
+            return None
+        if position == 0 and self.last_position is None:
+            # Задача не ждала в очереди - сообщать не о чем
+            return None
+        self.last_position = position
+        return asyncio.create_task(self._deliver_position(position))
+
+    async def _deliver_position(self, position: int):
+        # Lock в asyncio обслуживает ожидающих по порядку, поэтому «🚀» не обгонит позицию
+        async with self._notify_lock:
+            await self.on_position(position)
+
+class JobScheduler:
+    """Фиксированный пул воркеров и ограниченная очередь ожидания.
+
+    Внутри каждой полосы (приоритетной и обычной) пользователи обслуживаются по кругу,
+    поэтому один большой пакет не задерживает всех остальных.
+    """
+
+    def __init__(self, workers: int, max_waiting: int):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        # полоса -> user_id -> очередь задач пользователя
+        self.lanes: Dict[bool, "OrderedDict[int, deque]"] = {True: OrderedDict(), False: OrderedDict()}
+        self.waiting = 0
+        self.running = 0
+        self._available = asyncio.Semaphore(0)
+        self._worker_tasks: List[asyncio.Task] = []
+        self._notify_tasks = set()
+
+    def start(self):
+        if not self._worker_tasks:
+            self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    async def run(self, user_id: int, func: Callable[[], Awaitable[Any]], priority: bool = False,
+                  on_position: Optional[Callable[[int], Awaitable[None]]] = None) -> Any:
+        """Ставит задачу в очередь и ждет ее результата"""
+        self.start()
+        if self.waiting >= self.max_waiting:
+            QUEUE_REJECTIONS.inc()
+            raise QueueFullError()
+
+        job = Job(user_id, func, on_position)
+        lane = self.lanes[priority]
+        lane.setdefault(user_id, deque()).append(job)
+        self.waiting += 1
+        self._available.release()
+        # Пока есть свободный воркер, задача не ждет: позицию не показываем
+        if self.running >= self.workers:
+            self._publish_positions()
+        return await job.future
+
+    def _next_job(self) -> Job:
+        for priority in (True, False):
+            lane = self.lanes[priority]
+            if lane:
+                user_id, jobs = next(iter(lane.items()))
+                job = jobs.popleft()
+                # Пользователь уходит в конец круга
+                del lane[user_id]
+                if jobs:
+                    lane[user_id] = jobs
+                return job
+        raise RuntimeError("Очередь пуста")
+
+    def _dispatch_order(self) -> List[Job]:
+        """Порядок, в котором воркеры заберут ожидающие задачи"""
+        order = []
+        for priority in (True, False):
+            queues = [list(jobs) for jobs in self.lanes[priority].values()]
+            depth = max((len(q) for q in queues), default=0)
+            for round_index in range(depth):
+                order.extend(q[round_index] for q in queues if round_index < len(q))
+        return order
+
+    def _notify(self, job: Job, position: int):
+        task = job.notify_position(position)
+        if task is not None:
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+    def _publish_positions(self):
+        for position, job in enumerate(self._dispatch_order(), start=1):
+            self._notify(job, position)
+
+    async def _worker(self):
+        while True:
+            await self._available.acquire()
+            job = self._next_job()
+            self.waiting -= 1
+            if job.future.done():
+                self._publish_positions()
+                continue
+
+            # running увеличивается до публикации: остальные задачи ждут, только если заняты все воркеры
+            self.running += 1
+            if self.running >= self.workers:
+                self._publish_positions()
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - job.enqueued_at)
+            self._notify(job, 0)
+            try:
+                job.future.set_result(await job.func())
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                self.running -= 1
+
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.25"))
+JOB_LEASE_SECONDS = 30  # задачи процесса, не продлевавшего аренду, считаются брошенными
+
+# Очередь в порядке обслуживания: приоритетная полоса, затем по кругу между пользователями
+DISPATCH_ORDER_SQL = """
+    SELECT id, owner FROM (
+        SELECT id, owner, priority,
+               ROW_NUMBER() OVER (PARTITION BY priority, user_id ORDER BY id) AS round
+        FROM job_queue WHERE status = 'waiting'
+    ) ORDER BY priority DESC, round, id
+"""
+
+class SharedJobScheduler:
+    """Очередь задач в SQLite (STATE_DB_PATH), общая для нескольких процессов бота.
+
+    Каждый процесс выполняет только свои задачи, до JOB_WORKERS одновременно: при свободном
+    слоте он забирает свою первую задачу в общем порядке обслуживания. Задачи занятых
+    процессов не задерживают остальных, поэтому пропускная способность растет с числом
+    процессов. Позиции в очереди считаются по общему порядку.
+    """
+
+    def __init__(self, workers: int, max_waiting: int):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.jobs: Dict[int, Job] = {}
+        self._wakeup = asyncio.Event()
+        self._poller: Optional[asyncio.Task] = None
+        self._running_tasks = set()
+        self._notify_tasks = set()
+
+    def start(self):
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        tasks = [t for t in (self._poller, *self._running_tasks) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._poller = None
+        await state_db.execute("DELETE FROM job_queue WHERE owner = ?", (self.owner,),
+                               label="SharedJobScheduler.stop")
+
+    async def run(self, user_id: int, func: Callable[[], Awaitable[Any]], priority: bool = False,
+                  on_position: Optional[Callable[[int], Awaitable[None]]] = None) -> Any:
+        """Ставит задачу в общую очередь и ждет ее результата"""
+        self.start()
+        job = Job(user_id, func, on_position)
+        job_id = await state_db.transaction(self._enqueue, user_id, priority)
+        if job_id is None:
+            QUEUE_REJECTIONS.inc()
+            raise QueueFullError()
+
+        self.jobs[job_id] = job
+        self._wakeup.set()
+        return await job.future
+
+    def _enqueue(self, conn: sqlite3.Connection, user_id: int, priority: bool) -> Optional[int]:
+        # Проверка лимита и вставка одним выражением - атомарно для всех процессов
+        cursor = conn.execute(
+            """INSERT INTO job_queue (user_id, priority, owner, lease_until)
+               SELECT ?, ?, ?, ?
+               WHERE (SELECT COUNT(*) FROM job_queue WHERE status = 'waiting') < ?""",
+            (user_id, int(priority), self.owner, time.time() + JOB_LEASE_SECONDS, self.max_waiting)
+        )
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def _poll(self, conn: sqlite3.Connection, known: set, cancelled: List[int]) -> Tuple[List[int], Dict[int, int]]:
+        """Продлевает аренду, захватывает свои задачи по порядку обслуживания, считает позиции"""
+        # Блокировка на запись сразу: позиции считаются по тому же состоянию, что и захват.
+        # Блокируется только STATE_DB_PATH, платежи в payments.db она не задерживает
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        if cancelled:
+            conn.executemany("DELETE FROM job_queue WHERE id = ?", [(job_id,) for job_id in cancelled])
+        conn.execute("UPDATE job_queue SET lease_until = ? WHERE owner = ?",
+                     (now + JOB_LEASE_SECONDS, self.owner))
+        conn.execute("DELETE FROM job_queue WHERE lease_until < ?", (now,))
+
+        claimed = []
+        running = conn.execute("SELECT COUNT(*) FROM job_queue WHERE status = 'running' AND owner = ?",
+                               (self.owner,)).fetchone()[0]
+        if running < self.workers:
+            for job_id, owner in conn.execute(DISPATCH_ORDER_SQL).fetchall():
+                # Задачи других процессов они выполняют сами
+                if owner != self.owner or job_id not in known:
+                    continue
+                conn.execute("UPDATE job_queue SET status = 'running' WHERE id = ?", (job_id,))
+                claimed.append(job_id)
+                running += 1
+                if running >= self.workers:
+                    break
+
+        positions = {
+            job_id: position
+            for position, (job_id, owner) in enumerate(conn.execute(DISPATCH_ORDER_SQL), start=1)
+            if owner == self.owner
+        }
+        return claimed, positions
+
+    async def _poll_loop(self):
+        while True:
+            # asyncio.timeout, а не wait_for: в 3.11 wait_for может проглотить отмену при stop()
+            try:
+                async with asyncio.timeout(JOB_POLL_INTERVAL):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self.jobs:
+                continue
+
+            cancelled = [job_id for job_id, job in self.jobs.items() if job.future.done()]
+            for job_id in cancelled:
+                del self.jobs[job_id]
+            try:
+                claimed, positions = await state_db.transaction(self._poll, set(self.jobs), cancelled)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Ошибка опроса общей очереди: {e}")
+                continue
+
+            for job_id, position in positions.items():
+                if job_id in self.jobs:
+                    self._notify(self.jobs[job_id], position)
+            for job_id in claimed:
+                task = asyncio.create_task(self._execute(job_id))
+                self._running_tasks.add(task)
+                task.add_done_callback(self._running_tasks.discard)
+
+    async def _execute(self, job_id: int):
+        job = self.jobs.get(job_id)
+        try:
+            if job is None or job.future.done():
+                return
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - job.enqueued_at)
+            self._notify(job, 0)
+            try:
+                job.future.set_result(await job.func())
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                job.future.set_exception(e)
+        finally:
+            self.jobs.pop(job_id, None)
+            try:
+                await state_db.execute("DELETE FROM job_queue WHERE id = ?", (job_id,),
+                                       label="SharedJobScheduler._execute")
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Не удалось удалить задачу {job_id} из очереди: {e}")
+            # Слот освободился - сразу пробуем забрать следующую задачу
+            self._wakeup.set()
+
+    def _notify(self, job: Job, position: int):
+        task = job.notify_position(position)
+        if task is not None:
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+if STATE_BACKEND == "sqlite":
+    job_scheduler = SharedJobScheduler(JOB_WORKERS, MAX_WAITING_JOBS)
+else:
+    job_scheduler = JobScheduler(JOB_WORKERS, MAX_WAITING_JOBS)
+
+def queue_position_notifier(message: types.Message) -> Callable[[int], Awaitable[None]]:
+    """Показывает пользователю его место в очереди одним редактируемым сообщением"""
+    status_message = None
+
+    async def notify(position: int):
+        nonlocal status_message
+        try:
+            if position > 0:
+                text = f"⏳ Вы в очереди: <b>{position}</b>-й"
+                if status_message is None:
+                    status_message = await message.answer(text, parse_mode="HTML")
+                else:
+                    await status_message.edit_text(text, parse_mode="HTML")
+            elif status_message is not None:
+                await status_message.edit_text("🚀 Ваша очередь подошла, обрабатываю...")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить позицию в очереди: {e}")
+
+    return notify
+
+@db_helper
+async def has_priority(user_id: int) -> bool:
+    """Купившие пакет идут в приоритетную полосу очереди"""
+    row = await db.fetchone("SELECT total_spent FROM user_balance WHERE user_id = ?", (user_id,))
+    return bool(row and row[0] and row[0] >= PRIORITY_MIN_SPENT)
+
+async def run_user_job(message: types.Message, func: Callable[[], Awaitable[Any]]) -> Any:
+    """Выполняет генерацию/редактирование через планировщик задач"""
+    user_id = message.from_user.id
+    priority = await has_priority(user_id)
+    return await job_scheduler.run(user_id, func, priority=priority,
+                                   on_position=queue_position_notifier(message))
+
+# Сколько промптов одновременно отправляем в AI Tunnel (на весь бот)
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "5"))
+generation_semaphore = asyncio.BoundedSemaphore(GENERATION_CONCURRENCY)
+SECONDS_PER_GENERATION = 20
+
+def estimate_batch_seconds(prompts_count: int) -> int:
+    """Оценка времени пакета: промпты идут параллельно волнами по GENERATION_CONCURRENCY"""
+    waves = (prompts_count + GENERATION_CONCURRENCY - 1) // GENERATION_CONCURRENCY
+    return max(1, waves) * SECONDS_PER_GENERATION
+
+# ========== HTTP КЛИЕНТ AI TUNNEL ==========
+AITUNNEL_BASE_URL = os.getenv("AITUNNEL_BASE_URL", "https://api.aitunnel.ru").rstrip("/")
+AITUNNEL_MAX_CONNECTIONS = int(os.getenv("AITUNNEL_MAX_CONNECTIONS", "10"))
+AITUNNEL_KEEPALIVE = float(os.getenv("AITUNNEL_KEEPALIVE", "60"))
+AITUNNEL_DNS_TTL = int(os.getenv("AITUNNEL_DNS_TTL", "300"))
+AITUNNEL_PRECONNECT = os.getenv("AITUNNEL_PRECONNECT", "1") == "1"
+AITUNNEL_TIMEOUT = ClientTimeout(total=120, connect=15)
+
+http_session: Optional[aiohttp.ClientSession] = None
+
+def _create_http_session() -> aiohttp.ClientSession:
+    """Создает пул соединений к AI Tunnel с keep-alive и DNS-кэшем"""
+    connector = aiohttp.TCPConnector(
+        limit=AITUNNEL_MAX_CONNECTIONS * 2,
+        limit_per_host=AITUNNEL_MAX_CONNECTIONS,
+        ttl_dns_cache=AITUNNEL_DNS_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=AITUNNEL_KEEPALIVE,
+        enable_cleanup_closed=True
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=AITUNNEL_TIMEOUT,
+        headers={"Authorization": f"Bearer {AITUNNEL_API_KEY}"}
+    )
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую сессию (создает ее, если бот еще не запустил пул)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = _create_http_session()
+    return http_session
+
+async def start_http_session():
+    """Открывает общую сессию и прогревает соединение с AI Tunnel"""
+    session = get_http_session()
+    if not AITUNNEL_PRECONNECT:
+        return
+    try:
+        # Любой ответ подходит: нам нужны только DNS, TCP и TLS в пуле
+        async with session.get(f"{AITUNNEL_BASE_URL}/v1/models",
+                               timeout=ClientTimeout(total=10)) as response:
+            await response.read()
+        logger.info(f"🔌 Соединение с AI Tunnel прогрето ({response.status})")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось прогреть соединение с AI Tunnel: {e}")
+
+async def close_http_session():
+    """Закрывает общую сессию при остановке бота"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
 # ========== ФУНКЦИИ КЭША ==========
-def get_cached_image(prompt: str) -> Optional[str]:
-    """Получает изображение из кэша"""
-    prompt_hash = hashlib.md5(prompt.encode()).hexdigest()
-    conn = sqlite3.connect('bot_cache.db')
-    c = conn.cursor()
-    c.execute("SELECT file_path FROM image_cache WHERE prompt_hash = ?", (prompt_hash,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-def save_to_cache(prompt: str, file_path: str):
-    """Сохраняет изображение в кэш"""
-    prompt_hash = hashlib.md5(prompt.encode()).hexdigest()
-    conn = sqlite3.connect('bot_cache.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO image_cache (prompt_hash, file_path) VALUES (?, ?)",
-              (prompt_hash, file_path))
-    conn.commit()
-    conn.close()
+@db_helper
+async def get_cached_image(prompt: str) -> Optional[Tuple[str, Optional[str]]]:
+    """Получает из кэша Telegram file_id изображения и путь к его копии в хранилище"""
+    prompt_hash = build_cache_key(prompt)
+    result = await db.fetchone("SELECT file_id, file_path FROM cache.image_cache WHERE prompt_hash = ? AND file_id IS NOT NULL",
+                               (prompt_hash,))
+    image_store.record_lookup(prompt_hash, hit=result is not None)
+    if not result:
+        return None
+    image_store.touch(result[1])
+    return result[0], result[1]
+
+@db_helper
+async def save_to_cache(prompt: str, file_id: str, file_unique_id: str, file_path: str):
+    """Сохраняет в кэш file_id, который Telegram вернул после отправки фото"""
+    prompt_hash = build_cache_key(prompt)
+    size = await asyncio.to_thread(os.path.getsize, file_path)
+    admitted, evicted = image_store.admit(file_path, prompt_hash, size)
+    if evicted:
+        await asyncio.to_thread(image_store.delete_files, evicted)
+    if not admitted:
+        await image_store.discard_files([file_path])
+        return
+
+    def write_entry(conn: sqlite3.Connection) -> Optional[str]:
+        c = conn.cursor()
+        c.executemany("DELETE FROM cache.image_cache WHERE file_path = ?", [(p,) for p in evicted])
+        previous = c.execute("SELECT file_path FROM cache.image_cache WHERE prompt_hash = ?", (prompt_hash,)).fetchone()
+        c.execute('''INSERT OR REPLACE INTO cache.image_cache
+                     (prompt_hash, file_path, file_id, file_unique_id, prompt, params, key_version)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  (prompt_hash, file_path, file_id, file_unique_id, normalize_prompt(prompt),
+                   json.dumps(GENERATION_PARAMS, sort_keys=True), CACHE_KEY_VERSION))
+        return previous[0] if previous else None
+
+    previous_path = await db.transaction(write_entry)
+    if previous_path and previous_path != file_path:
+        image_store.forget(previous_path)
+        await asyncio.to_thread(image_store.delete_files, [previous_path])
+
+# ========== СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ ==========
+USER_STATS_FLUSH_INTERVAL = float(os.getenv("USER_STATS_FLUSH_INTERVAL", "10"))
+USER_STATS_FLUSH_SIZE = int(os.getenv("USER_STATS_FLUSH_SIZE", "500"))
+
+class UserStatsBuffer:
+    """Отложенная запись user_stats: приращения копятся в памяти и пишутся одной транзакцией.
+
+    Сброс происходит по таймеру, при USER_STATS_FLUSH_SIZE пользователях в буфере
+    и при остановке бота. Несохраненное при падении процесса теряется: это только статистика.
+    """
+
+    def __init__(self, flush_interval: float, flush_size: int):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.pending: Dict[int, List[Any]] = {}
+        self.flushing: Dict[int, List[Any]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def add(self, user_id: int, images_count: int):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        delta = self.pending.setdefault(user_id, [0, 0, now])
+        delta[0] += 1
+        delta[1] += images_count
+        delta[2] = now
+        if len(self.pending) >= self.flush_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    @db_helper
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            self.flushing, self.pending = self.pending, {}
+            rows = [(user_id, requests, images, last) for user_id, (requests, images, last) in self.flushing.items()]
+
+            def write_user_stats(conn: sqlite3.Connection):
+                conn.executemany(
+                    '''INSERT INTO cache.user_stats (user_id, requests_count, total_images, last_request)
+                       VALUES (?, ?, ?, ?)
+                       ON CONFLICT(user_id) DO UPDATE SET
+                           requests_count = COALESCE(requests_count, 0) + excluded.requests_count,
+                           total_images = COALESCE(total_images, 0) + excluded.total_images,
+                           last_request = excluded.last_request''',
+                    rows
+                )
+
+            try:
+                await db.transaction(write_user_stats)
+            except Exception as e:
+                # Возвращаем приращения в буфер, следующий сброс повторит запись
+                logger.error(f"❌ Ошибка записи статистики ({len(rows)} пользователей): {e}")
+                for user_id, (requests, images, last) in self.flushing.items():
+                    delta = self.pending.setdefault(user_id, [0, 0, last])
+                    delta[0] += requests
+                    delta[1] += images
+                    delta[2] = max(delta[2], last)
+            finally:
+                self.flushing = {}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    @db_helper
+    async def get(self, user_id: int) -> Optional[Tuple[int, int, Any]]:
+        """Сохраненная статистика плюс еще не записанные приращения"""
+        row = await db.fetchone("SELECT requests_count, total_images, last_request FROM cache.user_stats WHERE user_id = ?",
+                                (user_id,))
+        requests_count, total_images, last_request = row or (0, 0, None)
+        requests_count, total_images = requests_count or 0, total_images or 0
+        for buffer in (self.flushing, self.pending):
+            if user_id in buffer:
+                requests, images, last = buffer[user_id]
+                requests_count += requests
+                total_images += images
+                last_request = last
+        if not row and not requests_count:
+            return None
+        return requests_count, total_images, last_request
+
+user_stats_buffer = UserStatsBuffer(USER_STATS_FLUSH_INTERVAL, USER_STATS_FLUSH_SIZE)
 
 def update_user_stats(user_id: int, images_count: int = 1):
-    """Обновляет статистика пользователя"""
-    conn = sqlite3.connect('bot_cache.db')
-    c = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO user_stats 
-                 (user_id, requests_count, total_images, last_request) 
-                 VALUES (?, COALESCE((SELECT requests_count FROM user_stats WHERE user_id = ?), 0) + 1,
-                         COALESCE((SELECT total_images FROM user_stats WHERE user_id = ?), 0) + ?,
-                         ?)''',
-              (user_id, user_id, user_id, images_count, datetime.now()))
-    conn.commit()
-    conn.close()
+    """Учитывает запрос пользователя (запись в БД отложена)"""
+    user_stats_buffer.add(user_id, images_count)
 
 def enhance_edit_prompt(original_prompt: str) -> str:
     """Автоматически улучшаем промпт для сохранения лиц"""
@@ -345,13 +1537,10 @@ def get_payment_keyboard():
     )
 
 # ========== БАЛАНС И ОПЛАТА ==========
+@db_helper
 async def check_balance(user_id: int) -> int:
     """Проверяет баланс пользователя"""
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute("SELECT images_left FROM user_balance WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
+    result = await db.fetchone("SELECT images_left FROM user_balance WHERE user_id = ?", (user_id,))
     if result:
         logger.info(f"💰 Баланс пользователя {user_id}: {result[0]} изображений")
         return result[0]
@@ -359,46 +1548,107 @@ async def check_balance(user_id: int) -> int:
         logger.info(f"💰 Пользователь {user_id} не найден в базе")
         return 0
 
-async def deduct_balance(user_id: int, amount: int = 1) -> bool:
-    """Списывает изображения с баланса"""
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    
-    # Проверяем баланс
-    c.execute("SELECT images_left FROM user_balance WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    
-    if not result:
-        conn.close()
-        logger.warning(f"❌ Пользователь {user_id} не найден в базе")
-        return False
-    
-    if result[0] < amount:
-        conn.close()
-        logger.warning(f"❌ Недостаточно изображений: есть {result[0]}, нужно {amount}")
-        return False
-    
-    # Списание
-    c.execute("UPDATE user_balance SET images_left = images_left - ? WHERE user_id = ?", 
-              (amount, user_id))
-    conn.commit()
-    conn.close()
-    logger.info(f"✅ Списано {amount} изображений с баланса пользователя {user_id}")
-    return True
+BALANCE_HOLD_TTL = 6 * 3600  # резервы упавших процессов возвращаются на баланс
+
+def ledger_append(conn: sqlite3.Connection, user_id: int, delta: int, kind: str, ref: Optional[str] = None):
+    """Запись в журнал баланса (только добавление; сумма delta равна images_left)"""
+    conn.execute("INSERT INTO balance_ledger (user_id, delta, kind, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+                 (user_id, delta, kind, ref, int(time.time())))
+
+def charge_balance(conn: sqlite3.Connection, user_id: int, images: int, kind: str,
+                   ref: Optional[str] = None) -> Optional[int]:
+    """Условное списание одним UPDATE; возвращает остаток или None, если не хватает"""
+    row = conn.execute(
+        "UPDATE user_balance SET images_left = images_left - ? WHERE user_id = ? AND images_left >= ? RETURNING images_left",
+        (images, user_id, images)
+    ).fetchone()
+    if row is None:
+        return None
+    ledger_append(conn, user_id, -images, kind, ref)
+    return row[0]
+
+def credit_balance(conn: sqlite3.Connection, user_id: int, images_to_add: int, amount: float,
+                   kind: str = "credit", ref: Optional[str] = None):
+    """Зачисление внутри уже открытой транзакции"""
+    conn.execute('''INSERT INTO user_balance (user_id, images_left, total_spent) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        images_left = images_left + excluded.images_left,
+                        total_spent = COALESCE(total_spent, 0) + excluded.total_spent''',
+                 (user_id, images_to_add, amount))
+    ledger_append(conn, user_id, images_to_add, kind, ref)
+
+@db_helper
+async def reserve_balance(user_id: int, images: int = 1) -> Optional[str]:
+    """Резервирует изображения под задачу; возвращает id резерва или None, если не хватает"""
+    hold_id = f"{user_id}_{uuid.uuid4().hex}"
+
+    def reserve(conn: sqlite3.Connection) -> Optional[int]:
+        images_left = charge_balance(conn, user_id, images, "reserve", hold_id)
+        if images_left is not None:
+            conn.execute("INSERT INTO balance_holds (hold_id, user_id, images, created_at) VALUES (?, ?, ?, ?)",
+                         (hold_id, user_id, images, int(time.time())))
+        return images_left
+
+    images_left = await db.transaction(reserve)
+    if images_left is None:
+        logger.warning(f"❌ Недостаточно изображений у пользователя {user_id}: нужно {images}")
+        return None
 
+    logger.info(f"✅ Зарезервировано {images} изображений пользователя {user_id} (осталось {images_left})")
+    return hold_id
+
+def settle_hold_row(conn: sqlite3.Connection, hold_id: str, used: Optional[int]) -> Optional[int]:
+    """Закрывает резерв: used списывается окончательно, остальное возвращается.
+
+    Возвращает число возвращенных изображений или None, если резерв уже закрыт.
+    """
+    row = conn.execute("DELETE FROM balance_holds WHERE hold_id = ? RETURNING user_id, images",
+                       (hold_id,)).fetchone()
+    if row is None:
+        return None
+    user_id, images = row
+    used = images if used is None else max(0, min(used, images))
+    if used:
+        ledger_append(conn, user_id, 0, "commit", hold_id)
+    returned = images - used
+    if returned:
+        conn.execute("UPDATE user_balance SET images_left = images_left + ? WHERE user_id = ?", (returned, user_id))
+        ledger_append(conn, user_id, returned, "release", hold_id)
+    return returned
+
+@db_helper
+async def commit_hold(hold_id: Optional[str], used: Optional[int] = None) -> Optional[int]:
+    """Списывает used изображений из резерва (по умолчанию все), остаток возвращает"""
+    if not hold_id:
+        return None
+    returned = await db.transaction(settle_hold_row, hold_id, used)
+    if returned:
+        REFUNDED_IMAGES.inc(amount=returned)
+    return returned
+
+async def release_hold(hold_id: Optional[str]) -> Optional[int]:
+    """Возвращает резерв на баланс целиком (повторный вызов ничего не делает)"""
+    return await commit_hold(hold_id, used=0)
+
+@db_helper
+async def release_stale_holds() -> int:
+    """Возвращает резервы старше BALANCE_HOLD_TTL (задача потерялась вместе с процессом)"""
+    def release(conn: sqlite3.Connection) -> List[int]:
+        stale = conn.execute("SELECT hold_id FROM balance_holds WHERE created_at < ?",
+                             (int(time.time()) - BALANCE_HOLD_TTL,)).fetchall()
+        returned = [settle_hold_row(conn, hold_id, 0) for (hold_id,) in stale]
+        return [images for images in returned if images is not None]
+
+    returned = await db.transaction(release)
+    if returned:
+        REFUNDED_IMAGES.inc(amount=sum(returned))
+        logger.warning(f"⚠️ Возвращено {len(returned)} зависших резервов баланса")
+    return len(returned)
+
+@db_helper
 async def add_balance(user_id: int, images_to_add: int, amount: float):
     """Добавляет изображения на баланс"""
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    
-    c.execute('''INSERT OR REPLACE INTO user_balance 
-                 (user_id, images_left, total_spent) 
-                 VALUES (?, COALESCE((SELECT images_left FROM user_balance WHERE user_id = ?), 0) + ?,
-                         COALESCE((SELECT total_spent FROM user_balance WHERE user_id = ?), 0) + ?)''',
-              (user_id, user_id, images_to_add, user_id, amount))
-    
-    conn.commit()
-    conn.close()
+    await db.transaction(credit_balance, user_id, images_to_add, amount)
     logger.info(f"✅ Добавлено {images_to_add} изображений на баланс пользователя {user_id}")
 
 def get_images_count_by_amount(amount: float) -> int:
@@ -413,7 +1663,81 @@ def get_images_count_by_amount(amount: float) -> int:
         return 15
     return 0
 
+# ========== КЛИЕНТ ЮKASSA ==========
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3").rstrip("/")
+YOOKASSA_MAX_CONNECTIONS = int(os.getenv("YOOKASSA_MAX_CONNECTIONS", "5"))
+YOOKASSA_RETRIES = int(os.getenv("YOOKASSA_RETRIES", "3"))
+YOOKASSA_TIMEOUT = ClientTimeout(total=float(os.getenv("YOOKASSA_TIMEOUT", "15")), connect=5)
+
+class YooKassaError(Exception):
+    """ЮKassa отклонила запрос или недоступна после всех повторов"""
+
+class YooKassaClient:
+    """Асинхронный клиент API ЮKassa v3 на общем пуле соединений.
+
+    POST-запросы отправляются с Idempotence-Key, поэтому повтор после таймаута
+    или 5xx не создаст второй платеж.
+    """
+
+    RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str, shop_id: Optional[str], secret_key: Optional[str]):
+        self.base_url = base_url
+        self.auth = aiohttp.BasicAuth(shop_id or "", secret_key or "")
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=YOOKASSA_MAX_CONNECTIONS, ttl_dns_cache=300),
+                timeout=YOOKASSA_TIMEOUT,
+                auth=self.auth
+            )
+        return self._session
+
+    async def request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None,
+                      params: Optional[Dict[str, Any]] = None,
+                      idempotence_key: Optional[str] = None) -> Dict[str, Any]:
+        """Выполняет запрос с повторами и возвращает JSON ответа"""
+        headers = {}
+        if method == "POST":
+            headers["Idempotence-Key"] = idempotence_key or uuid.uuid4().hex
+
+        last_error = ""
+        for attempt in range(YOOKASSA_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(min(0.5 * 2 ** (attempt - 1), 5))
+            try:
+                async with self._get_session().request(method, f"{self.base_url}{path}", json=payload,
+                                                       params=params, headers=headers) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    last_error = f"HTTP {response.status}: {(await response.text())[:200]}"
+                    if response.status not in self.RETRY_STATUSES:
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = f"{type(e).__name__}: {e}"
+            logger.warning(f"⚠️ ЮKassa {method} {path}: {last_error} (попытка {attempt + 1})")
+        raise YooKassaError(last_error)
+
+    async def create_payment(self, payment_data: Dict[str, Any], idempotence_key: str) -> Dict[str, Any]:
+        return await self.request("POST", "/payments", payload=payment_data, idempotence_key=idempotence_key)
+
+    async def find_payment(self, payment_id: str) -> Dict[str, Any]:
+        return await self.request("GET", f"/payments/{payment_id}")
+
+    async def list_payments(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.request("GET", "/payments", params=params)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+yookassa_client = YooKassaClient(YOOKASSA_API_URL, YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
+
 # ========== ЮKASSA ОПЛАТА ==========
+@db_helper
 async def create_yookassa_payment(user_id: int, amount: float, description: str):
     """Создает платеж в ЮKassa"""
     
@@ -422,13 +1746,6 @@ async def create_yookassa_payment(user_id: int, amount: float, description: str)
         return await create_test_payment(user_id, amount, description)
     
     try:
-        import yookassa
-        from yookassa import Payment, Configuration
-        
-        # Настройка
-        Configuration.account_id = YOOKASSA_SHOP_ID
-        Configuration.secret_key = YOOKASSA_SECRET_KEY
-        
         # Уникальный ID платежа
         payment_id = f"{user_id}_{int(datetime.now().timestamp())}"
         
@@ -453,23 +1770,19 @@ async def create_yookassa_payment(user_id: int, amount: float, description: str)
             }
         }
         
-        # Создаем платеж
-        payment = Payment.create(payment_data, payment_id)
+        # Создаем платеж (payment_id - ключ идемпотентности)
+        payment = await yookassa_client.create_payment(payment_data, payment_id)
         
         # Сохраняем в БД
-        conn = sqlite3.connect('payments.db')
-        c = conn.cursor()
-        c.execute('''INSERT INTO payments 
-                     (user_id, amount, payment_id, yookassa_payment_id, status, created_at) 
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (user_id, amount, payment_id, payment.id, 'pending', datetime.now()))
-        conn.commit()
-        conn.close()
+        await db.execute('''INSERT INTO payments 
+                            (user_id, amount, payment_id, yookassa_payment_id, status, created_at) 
+                            VALUES (?, ?, ?, ?, ?, ?)''',
+                         (user_id, amount, payment_id, payment["id"], 'pending', int(time.time())))
         
         return {
             "success": True,
-            "payment_url": payment.confirmation.confirmation_url,
-            "payment_id": payment.id,
+            "payment_url": payment["confirmation"]["confirmation_url"],
+            "payment_id": payment["id"],
             "amount": amount
         }
         
@@ -478,6 +1791,7 @@ async def create_yookassa_payment(user_id: int, amount: float, description: str)
         # Если ошибка, переключаемся на тестовый режим
         return await create_test_payment(user_id, amount, description)
 
+@db_helper
 async def create_test_payment(user_id: int, amount: float, description: str):
     """Тестовый режим оплаты (если нет ключей ЮKassa)"""
     images_to_add = get_images_count_by_amount(amount)
@@ -486,15 +1800,16 @@ async def create_test_payment(user_id: int, amount: float, description: str):
     await add_balance(user_id, images_to_add, amount)
     
     # Сохраняем в историю
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
     payment_id = f"test_{uuid.uuid4().hex}"
-    c.execute("INSERT INTO payments (user_id, amount, payment_id, status) VALUES (?, ?, ?, ?)",
-              (user_id, amount, payment_id, 'completed'))
-    c.execute("INSERT INTO payment_history (user_id, amount, description, status) VALUES (?, ?, ?, ?)",
-              (user_id, amount, description, 'completed'))
-    conn.commit()
-    conn.close()
+    
+    def save_test_payment(conn: sqlite3.Connection):
+        c = conn.cursor()
+        c.execute("INSERT INTO payments (user_id, amount, payment_id, status) VALUES (?, ?, ?, ?)",
+                  (user_id, amount, payment_id, 'completed'))
+        c.execute("INSERT INTO payment_history (user_id, amount, description, status) VALUES (?, ?, ?, ?)",
+                  (user_id, amount, description, 'completed'))
+    
+    await db.transaction(save_test_payment)
     
     return {
         "success": True,
@@ -509,86 +1824,817 @@ async def check_payment_status(payment_id: str):
         return None
     
     try:
-        import yookassa
-        from yookassa import Payment
-        
-        payment = Payment.find_one(payment_id)
-        return payment.status
-    except:
+        payment = await yookassa_client.find_payment(payment_id)
+        return payment.get("status")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось проверить платеж {payment_id}: {e}")
         return None
 
-# ========== ФУНКЦИЯ РЕДАКТИРОВАНИЯ ИЗОБРАЖЕНИЙ ==========
-async def edit_image_api(photo_bytes: bytes, edit_prompt: str) -> Dict[str, Any]:
-    """Редактирует загруженное фото через AI Tunnel API"""
-    temp_file_name = f"temp_upload_{uuid.uuid4().hex}.png"
-    with open(temp_file_name, "wb") as f:
-        f.write(photo_bytes)
+def complete_payment_row(conn: sqlite3.Connection, payment_id: str, user_id: int, amount: float) -> bool:
+    """Зачисление платежа внутри транзакции; False - платеж уже не в статусе pending"""
+    # Условный UPDATE - защита от двойного зачисления (кнопка, сверка, другой процесс)
+    updated = conn.execute("UPDATE payments SET status = 'completed' WHERE payment_id = ? AND status = 'pending'",
+                           (payment_id,)).rowcount
+    if not updated:
+        return False
+    images_to_add = get_images_count_by_amount(amount)
+    credit_balance(conn, user_id, images_to_add, amount, ref=payment_id)
+    conn.execute("INSERT INTO payment_history (user_id, amount, description, status) VALUES (?, ?, ?, ?)",
+                 (user_id, amount, f"Покупка {images_to_add} изображений", 'completed'))
+    return True
+
+@db_helper
+async def complete_payment(payment_id: str, user_id: int, amount: float) -> Optional[int]:
+    """Переводит платеж в completed и зачисляет изображения ровно один раз.
+
+    Возвращает число зачисленных изображений или None, если платеж уже обработан.
+    """
+    images_to_add = get_images_count_by_amount(amount)
+    if not await db.transaction(complete_payment_row, payment_id, user_id, amount):
+        return None
+    logger.info(f"✅ Платеж {payment_id} зачислен: {images_to_add} изображений пользователю {user_id}")
+    return images_to_add
+
+@db_helper
+async def cancel_payment(payment_id: str):
+    """Помечает ожидающий платеж отмененным"""
+    await db.execute("UPDATE payments SET status = 'canceled' WHERE payment_id = ? AND status = 'pending'",
+                     (payment_id,))
+
+# ========== СВЕРКА ПЛАТЕЖЕЙ ==========
+PAYMENT_RECONCILE_INTERVAL = int(os.getenv("PAYMENT_RECONCILE_INTERVAL", "10"))
+PAYMENT_RECONCILE_MAX_AGE = 3 * 24 * 3600  # старше - ЮKassa уже отменила неоплаченный платеж
+# (возраст платежа до, секунд) -> как часто его проверять
+PAYMENT_CHECK_BACKOFF = ((10 * 60, 15), (60 * 60, 60), (24 * 3600, 10 * 60))
+PAYMENT_CHECK_SLOW_INTERVAL = 60 * 60
+NOTIFIED_PAYMENT_CHECK_INTERVAL = 10 * 60
+
+def payment_check_interval(age_seconds: float) -> int:
+    """Свежие платежи проверяются часто, старые - все реже"""
+    interval = PAYMENT_CHECK_SLOW_INTERVAL
+    for max_age, backoff_interval in PAYMENT_CHECK_BACKOFF:
+        if age_seconds < max_age:
+            interval = backoff_interval
+            break
+    if YOOKASSA_NOTIFICATIONS:
+        # Зачисляют уведомления, сверка - только страховка от потерянных
+        interval = max(interval, NOTIFIED_PAYMENT_CHECK_INTERVAL)
+    return interval
+
+async def notify_payment_completed(user_id: int, images_added: int):
+    """Сообщает пользователю о зачислении без нажатия кнопок"""
+    try:
+        balance = await check_balance(user_id)
+        await get_bot().send_message(
+            user_id,
+            f"✅ <b>Оплата подтверждена!</b>\n\n"
+            f"<b>Зачислено:</b> {images_added} изображений\n"
+            f"<b>Ваш баланс:</b> {balance} изображений\n\n"
+            f"<i>Теперь можете использовать функции бота</i>",
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(user_id)
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось уведомить {user_id} о зачислении: {e}")
+
+async def reconcile_payment(payment_id: str, yookassa_payment_id: str, user_id: int, amount: float):
+    """Сверяет один ожидающий платеж со статусом в ЮKassa"""
+    status = await check_payment_status(yookassa_payment_id)
+    if status == 'succeeded':
+        images_added = await complete_payment(payment_id, user_id, amount)
+        if images_added is not None:
+            await notify_payment_completed(user_id, images_added)
+    elif status == 'canceled':
+        await cancel_payment(payment_id)
+        logger.info(f"🚫 Платеж {payment_id} отменен в ЮKassa")
+
+async def payment_reconciler():
+    """Фоновая задача: зачисляет оплаченные платежи без участия пользователя"""
+    if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
+        return
+    next_check: Dict[str, float] = {}
+    limiter = asyncio.Semaphore(YOOKASSA_MAX_CONNECTIONS)
+
+    async def limited(*args):
+        async with limiter:
+            await reconcile_payment(*args)
+
+    while True:
+        await asyncio.sleep(PAYMENT_RECONCILE_INTERVAL)
+        try:
+            now = time.time()
+            rows = await db.fetchall(
+                """SELECT payment_id, yookassa_payment_id, user_id, amount, created_at
+                   FROM payments WHERE status = 'pending' AND yookassa_payment_id IS NOT NULL""",
+                label="payment_reconciler"
+            )
+            due = []
+            for payment_id, yookassa_payment_id, user_id, amount, created_ts in rows:
+                age = now - (created_ts or now)
+                if age > PAYMENT_RECONCILE_MAX_AGE or next_check.get(payment_id, 0) > now:
+                    continue
+                next_check[payment_id] = now + payment_check_interval(age)
+                due.append((payment_id, yookassa_payment_id, user_id, amount))
+
+            pending_ids = {row[0] for row in rows}
+            for payment_id in list(next_check):
+                if payment_id not in pending_ids:
+                    del next_check[payment_id]
+
+            if due:
+                logger.info(f"🔄 Сверка платежей: проверяю {len(due)} из {len(rows)} ожидающих")
+                await asyncio.gather(*(limited(*payment) for payment in due))
+        except Exception as e:
+            logger.error(f"❌ Ошибка сверки платежей: {e}")
+
+# ========== СИНХРОНИЗАЦИЯ С ЮKASSA ==========
+PAYMENT_SYNC_INTERVAL = int(os.getenv("PAYMENT_SYNC_INTERVAL", str(30 * 60)))
+PAYMENT_SYNC_PAGE_SIZE = 100  # максимум, который отдает ЮKassa
+
+def get_sync_state(conn: sqlite3.Connection, name: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+def set_sync_state(conn: sqlite3.Connection, name: str, value: Optional[str]):
+    conn.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, value))
+
+def iso_to_epoch(value: Optional[str]) -> int:
+    """ISO 8601 из ответа ЮKassa в секунды Unix"""
+    if not value:
+        return int(time.time())
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+
+def sync_payments_page(conn: sqlite3.Connection, items: List[Dict[str, Any]],
+                       next_cursor: Optional[str]) -> int:
+    """Применяет страницу платежей и сохраняет курсор в той же транзакции.
+
+    Зачисляются только платежи, ожидающие в базе, и новые платежи после отметки yookassa_since.
+    Первый проход (отметки еще нет) переносит историю как completed без зачисления:
+    эти покупки уже были зачислены прежними версиями бота.
+    """
+    synced = 0
+    backfill = get_sync_state(conn, "yookassa_since") is None
+    run_newest = get_sync_state(conn, "yookassa_run_newest")
+    for payment in items:
+        created_at = payment.get("created_at")
+        if created_at and (run_newest is None or created_at > run_newest):
+            run_newest = created_at
+
+        metadata = payment.get("metadata") or {}
+        if payment.get("status") != 'succeeded' or 'user_id' not in metadata:
+            if payment.get("status") == 'canceled':
+                conn.execute("UPDATE payments SET status = 'canceled' WHERE yookassa_payment_id = ? AND status = 'pending'",
+                             (payment["id"],))
+            continue
+        user_id = int(metadata['user_id'])
+        amount = float(payment["amount"]["value"])
+        if get_images_count_by_amount(amount) == 0:
+            continue
 
-    API_URL = "https://api.aitunnel.ru/v1/images/edits"
-    headers = {"Authorization": f"Bearer {AITUNNEL_API_KEY}", "Accept": "application/json"}
-    timeout = ClientTimeout(total=120)
+        # Платеж, которого нет в базе: новый добавляем как ожидающий, исторический - сразу completed
+        inserted = conn.execute('''INSERT OR IGNORE INTO payments
+                                   (user_id, amount, payment_id, yookassa_payment_id, status, created_at)
+                                   VALUES (?, ?, ?, ?, ?, ?)''',
+                                (user_id, amount, f"restored_{payment['id']}", payment['id'],
+                                 'completed' if backfill else 'pending', iso_to_epoch(created_at))).rowcount
+        if backfill and inserted:
+            continue
+        row = conn.execute("SELECT payment_id FROM payments WHERE yookassa_payment_id = ?", (payment['id'],)).fetchone()
+        # Уже зачисленные платежи не трогаем: зачисление строго однократное
+        if complete_payment_row(conn, row[0], user_id, amount):
+            synced += 1
+
+    set_sync_state(conn, "yookassa_run_newest", run_newest)
+    set_sync_state(conn, "yookassa_cursor", next_cursor)
+    if next_cursor is None:
+        # Проход завершен: следующий начнется с самого нового увиденного платежа.
+        # После первого прохода отметка ставится всегда, иначе новые платежи тоже ушли бы в историю
+        if run_newest or backfill:
+            set_sync_state(conn, "yookassa_since",
+                           run_newest or datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+        set_sync_state(conn, "yookassa_run_newest", None)
+    return synced
+
+@db_helper
+async def sync_payments_from_yookassa() -> int:
+    """Догружает платежи из ЮKassa постранично, начиная с сохраненной отметки"""
+    if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
+        logger.warning("⚠️ Нет ключей ЮKassa для синхронизации платежей")
+        return 0
+
+    def load_checkpoint(conn: sqlite3.Connection) -> Tuple[Optional[str], Optional[str]]:
+        return get_sync_state(conn, "yookassa_cursor"), get_sync_state(conn, "yookassa_since")
 
+    cursor, since = await db.transaction(load_checkpoint)
+    total_synced = pages = 0
+    while True:
+        if cursor:
+            # Курсор уже содержит фильтры прерванного прохода
+            params = {"limit": PAYMENT_SYNC_PAGE_SIZE, "cursor": cursor}
+        else:
+            params = {"limit": PAYMENT_SYNC_PAGE_SIZE}
+            if since:
+                # Включительно: платежи с той же секундой применятся повторно без вреда
+                params["created_at.gte"] = since
+        page = await yookassa_client.list_payments(params)
+        cursor = page.get("next_cursor")
+        total_synced += await db.transaction(sync_payments_page, page.get("items", []), cursor)
+        pages += 1
+        if not cursor:
+            break
+
+    logger.info(f"✅ Синхронизация с ЮKassa: {pages} стр., зачислено {total_synced} платежей")
+    return total_synced
+
+async def payment_sync_loop():
+    """Фоновая задача: периодическая синхронизация платежей (бот уже обслуживает пользователей)"""
+    if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
+        return
+    while True:
+        try:
+            await sync_payments_from_yookassa()
+        except Exception as e:
+            logger.error(f"❌ Ошибка синхронизации с ЮKassa: {e}")
+        await asyncio.sleep(PAYMENT_SYNC_INTERVAL)
+
+# ========== УВЕДОМЛЕНИЯ ЮKASSA ==========
+YOOKASSA_NOTIFICATIONS = os.getenv("YOOKASSA_NOTIFICATIONS", "0") == "1"
+YOOKASSA_NOTIFICATION_PATH = os.getenv("YOOKASSA_NOTIFICATION_PATH", "/yookassa/notifications")
+YOOKASSA_NOTIFICATION_IP_CHECK = os.getenv("YOOKASSA_NOTIFICATION_IP_CHECK", "0") == "1"
+# Сколько доверенных прокси стоит перед ботом (на Railway - 1). Каждый дописывает адрес
+# в конец X-Forwarded-For, поэтому адрес клиента - N-й справа; левые записи подставляет сам клиент.
+# 0 - прокси нет, берется адрес TCP-соединения
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+# Адреса, с которых ЮKassa отправляет уведомления
+YOOKASSA_NOTIFICATION_NETWORKS = [ipaddress.ip_network(net) for net in (
+    "185.71.76.0/27", "185.71.77.0/27", "77.75.153.0/25", "77.75.156.11/32",
+    "77.75.156.35/32", "77.75.154.128/25", "2a02:5180::/32"
+)]
+
+def notification_sender_allowed(request: web.Request) -> bool:
+    """Проверяет, что уведомление пришло с адреса ЮKassa"""
+    remote = request.remote
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [entry.strip() for entry in request.headers.get("X-Forwarded-For", "").split(",") if entry.strip()]
+        # Записей меньше, чем прокси: запрос пришел в обход них
+        remote = forwarded[-TRUSTED_PROXY_HOPS] if len(forwarded) >= TRUSTED_PROXY_HOPS else None
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            logger.info(f"✏️ Редактирую фото: '{edit_prompt[:50]}...'")
+        address = ipaddress.ip_address(remote or "")
+    except ValueError:
+        return False
+    return any(address in network for network in YOOKASSA_NOTIFICATION_NETWORKS)
 
-            with open(temp_file_name, 'rb') as image_file:
-                form_data = aiohttp.FormData()
-                form_data.add_field('model', 'flux.2-pro')
-                form_data.add_field('prompt', edit_prompt)
-                form_data.add_field('n', '1')
-                form_data.add_field('size', '1024x1024')
-                form_data.add_field('response_format', 'b64_json')
-                form_data.add_field('image', image_file, filename='image.png', content_type='image/png')
+async def handle_yookassa_notification(request: web.Request) -> web.Response:
+    """Принимает payment.succeeded / payment.canceled и зачисляет платеж ровно один раз.
 
-                async with session.post(API_URL, headers=headers, data=form_data) as response:
-                    response_text = await response.text()
+    Телу уведомления не доверяем: статус перепроверяется запросом к API ЮKassa.
+    Ответ не 200 заставляет ЮKassa повторить уведомление позже.
+    """
+    if YOOKASSA_NOTIFICATION_IP_CHECK and not notification_sender_allowed(request):
+        logger.warning(f"⛔ Уведомление ЮKassa с чужого адреса: {request.remote}")
+        return web.Response(status=403)
 
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info("✅ API редактирования вернуло ответ")
-
-                        if 'data' in result and result['data']:
-                            if 'b64_json' in result['data'][0]:
-                                image_data = result['data'][0]['b64_json']
-                            elif 'url' in result['data'][0] and result['data'][0]['url'].startswith('data:image/'):
-                                base64_data = result['data'][0]['url'].split('base64,')[1]
-                                image_data = base64_data
-                            else:
-                                return {"success": False, "error": "invalid_response", "message": "Неверный формат ответа API"}
-
-                            image_bytes = base64.b64decode(image_data)
-                            file_name = f"edited_{uuid.uuid4().hex}.png"
-                            with open(file_name, "wb") as f:
-                                f.write(image_bytes)
-
-                            logger.info(f"✅ Изображение сохранено: {file_name}")
-                            return {"success": True, "file_path": file_name}
-                        else:
-                            return {"success": False, "error": "no_data", "message": "API не вернул данные"}
-                    else:
-                        logger.error(f"❌ Ошибка API {response.status}: {response_text}")
-                        try:
-                            error_json = json.loads(response_text)
-                            error_msg = error_json.get('error', {}).get('message', response_text)
-                        except:
-                            error_msg = response_text[:200]
-                        return {"success": False, "error": f"api_error_{response.status}", "message": f"Ошибка API: {error_msg}"}
+    try:
+        notification = await request.json()
+        event = notification["event"]
+        yookassa_payment_id = notification["object"]["id"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+
+    if event not in ("payment.succeeded", "payment.canceled"):
+        return web.Response(status=200)
+
+    row = await db.fetchone("SELECT payment_id, user_id, amount FROM payments WHERE yookassa_payment_id = ?",
+                            (yookassa_payment_id,), label="handle_yookassa_notification")
+    if row is None:
+        logger.warning(f"⚠️ Уведомление о неизвестном платеже {yookassa_payment_id}")
+        return web.Response(status=200)
+
+    payment_id, user_id, amount = row
+    try:
+        payment = await yookassa_client.find_payment(yookassa_payment_id)
+    except YooKassaError as e:
+        logger.error(f"❌ Не удалось проверить платеж из уведомления {yookassa_payment_id}: {e}")
+        return web.Response(status=503)
+
+    status = payment.get("status")
+    logger.info(f"📨 Уведомление ЮKassa {event}: {yookassa_payment_id}, статус в API: {status}")
+    if status == 'succeeded':
+        images_added = await complete_payment(payment_id, user_id, amount)
+        if images_added is not None:
+            await notify_payment_completed(user_id, images_added)
+    elif status == 'canceled':
+        await cancel_payment(payment_id)
+    return web.Response(status=200)
+
+# ========== ПОТОКОВОЕ ЧТЕНИЕ ОТВЕТОВ API ==========
+AITUNNEL_MAX_RESPONSE_BYTES = int(os.getenv("AITUNNEL_MAX_RESPONSE_BYTES", str(32 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class ResponseTooLargeError(Exception):
+    """Ответ API превысил AITUNNEL_MAX_RESPONSE_BYTES"""
+
+class Base64ImageStreamDecoder:
+    """Находит в JSON-ответе b64_json / data:image;base64 и декодирует их по частям в хранилище.
+
+    Ответ целиком в памяти не держится: в буфере только хвост JSON и неполная группа base64.
+    С in_memory=True изображения собираются в байты (для результатов, которые не кэшируются).
+    """
+
+    PAYLOAD_START = re.compile(rb'"b64_json"\s*:\s*"|data:image\\?/[\w.+-]+;base64,')
+    DATA_KEY = b'"data"'
+    # Сколько байт хвоста хранить между чанками, чтобы не разрезать маркер
+    OVERLAP = 64
+
+    def __init__(self, store: ImageStore, in_memory: bool = False):
+        self.store = store
+        self.in_memory = in_memory
+        self.images: List[Union[str, bytes]] = []
+        self.saw_data = False
+        self._buffer = b""
+        self._in_payload = False
+        self._pending_escape = b""
+        self._b64_tail = b""
+        self._file = None
+        self._temp_path: Optional[str] = None
+        self._hasher = None
+        self._decode_seconds = 0.0
+        # feed может идти в потоке, поэтому метрика пишется в finish() из event loop
+        self.decode_timings: List[float] = []
+
+    def feed(self, chunk: bytes):
+        data = self._buffer + chunk
+        self._buffer = b""
+        while data:
+            if self._in_payload:
+                end = data.find(b'"')
+                if end == -1:
+                    self._write_base64(data)
+                    return
+                self._write_base64(data[:end])
+                self._finish_payload()
+                data = data[end + 1:]
+            else:
+                if not self.saw_data and self.DATA_KEY in data:
+                    self.saw_data = True
+                match = self.PAYLOAD_START.search(data)
+                if match is None:
+                    self._buffer = data[-self.OVERLAP:]
+                    return
+                self._start_payload()
+                data = data[match.end():]
+
+    def _start_payload(self):
+        self._in_payload = True
+        if self.in_memory:
+            self._file = io.BytesIO()
+        else:
+            self._temp_path = self.store.new_temp_path()
+            self._file = open(self._temp_path, "wb")
+        self._hasher = hashlib.sha256()
+
+    def _write_base64(self, data: bytes):
+        data = self._pending_escape + data
+        self._pending_escape = b""
+        if data.endswith(b"\\"):
+            self._pending_escape, data = b"\\", data[:-1]
+        # JSON может экранировать "/" как "\/"
+        data = self._b64_tail + data.replace(b"\\/", b"/")
+        usable = len(data) // 4 * 4
+        if usable:
+            started = time.perf_counter()
+            decoded = base64.b64decode(data[:usable])
+            self._decode_seconds += time.perf_counter() - started
+            self._file.write(decoded)
+            self._hasher.update(decoded)
+        self._b64_tail = data[usable:]
+
+    def _finish_payload(self):
+        if self._b64_tail:
+            started = time.perf_counter()
+            decoded = base64.b64decode(self._b64_tail + b"=" * (-len(self._b64_tail) % 4))
+            self._decode_seconds += time.perf_counter() - started
+            self._file.write(decoded)
+            self._hasher.update(decoded)
+        self.decode_timings.append(self._decode_seconds)
+        self._decode_seconds = 0.0
+        self._b64_tail = b""
+        self._in_payload = False
+        if self.in_memory:
+            self.images.append(self._file.getvalue())
+        else:
+            self._file.close()
+            self.images.append(self.store.commit_temp(self._temp_path, self._hasher.hexdigest()))
+        self._file = None
+        self._temp_path = None
+
+    def finish(self) -> List[Union[str, bytes]]:
+        if self._in_payload:
+            raise ValueError("Ответ API оборвался посреди изображения")
+        for seconds in self.decode_timings:
+            BASE64_DECODE_SECONDS.observe(seconds)
+        return self.images
+
+    def abort(self):
+        """Удаляет недописанный файл и уже записанные изображения этого ответа"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._temp_path and os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+        if not self.in_memory:
+            for path in self.images:
+                self.store.discard(path)
+        self.images = []
+
+async def read_image_response(response: aiohttp.ClientResponse,
+                              in_memory: bool = False) -> Tuple[List[Union[str, bytes]], bool]:
+    """Читает ответ API по частям; возвращает (пути или байты изображений, было ли поле data)"""
+    if response.content_length and response.content_length > AITUNNEL_MAX_RESPONSE_BYTES:
+        raise ResponseTooLargeError(f"Ответ API слишком большой ({response.content_length} байт)")
+
+    decoder = Base64ImageStreamDecoder(image_store, in_memory=in_memory)
+    received = 0
+    try:
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            received += len(chunk)
+            if received > AITUNNEL_MAX_RESPONSE_BYTES:
+                raise ResponseTooLargeError(f"Ответ API слишком большой (> {AITUNNEL_MAX_RESPONSE_BYTES} байт)")
+            if in_memory:
+                decoder.feed(chunk)
+            else:
+                # Декодирование и запись в файл хранилища - вне event loop
+                await asyncio.to_thread(decoder.feed, chunk)
+        return decoder.finish(), decoder.saw_data
+    except BaseException:
+        decoder.abort()
+        raise
+
+# ========== ОБРАБОТКА ИЗОБРАЖЕНИЙ (ПУЛ ПРОЦЕССОВ) ==========
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+EDIT_TARGET_SIZE = 1024  # совпадает с size=1024x1024 в запросе редактирования
+EDIT_JPEG_QUALITY = 90
+DELIVERY_JPEG_QUALITY = int(os.getenv("DELIVERY_JPEG_QUALITY", "92"))
+# Хранить в кэше исходный PNG от API (по умолчанию хранится компактный JPEG, который видел пользователь)
+KEEP_ORIGINAL_IMAGES = os.getenv("KEEP_ORIGINAL_IMAGES", "0") == "1"
+
+image_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_image_process_pool() -> ProcessPoolExecutor:
+    global image_process_pool
+    if image_process_pool is None:
+        image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    return image_process_pool
+
+def shutdown_image_process_pool():
+    global image_process_pool
+    if image_process_pool is not None:
+        image_process_pool.shutdown(wait=False, cancel_futures=True)
+        image_process_pool = None
+
+def normalize_edit_photo(data: bytes) -> bytes:
+    """Поворот по EXIF, уменьшение до EDIT_TARGET_SIZE, без метаданных (выполняется в пуле процессов)"""
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image.thumbnail((EDIT_TARGET_SIZE, EDIT_TARGET_SIZE), Image.LANCZOS)
+        output = io.BytesIO()
+        # Новое изображение сохраняется без exif/icc/info исходника
+        if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+            image.convert("RGBA").save(output, format="PNG", optimize=True)
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=EDIT_JPEG_QUALITY, optimize=True)
+        return output.getvalue()
+
+def image_upload_name(data: bytes) -> Tuple[str, str]:
+    """Имя файла и content-type по сигнатуре изображения"""
+    if data.startswith(b"\x89PNG"):
+        return "image.png", "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image.webp", "image/webp"
+    return "image.jpg", "image/jpeg"
+
+def encode_for_telegram(source: Union[str, bytes]) -> bytes:
+    """Перекодирует результат в JPEG для отправки фото в Telegram (выполняется в пуле процессов)"""
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        output = io.BytesIO()
+        # subsampling=0 (4:4:4) сохраняет четкость мелких деталей и цветных границ
+        image.convert("RGB").save(output, format="JPEG", quality=DELIVERY_JPEG_QUALITY,
+                                  subsampling=0, optimize=True)
+        return output.getvalue()
+
+async def prepare_delivery_photo(source: Union[str, bytes]) -> Tuple[Union[FSInputFile, BufferedInputFile], Optional[bytes]]:
+    """Готовит фото к отправке; возвращает (файл для Telegram, байты JPEG или None при ошибке)"""
+    loop = asyncio.get_running_loop()
+    try:
+        encoded = await loop.run_in_executor(get_image_process_pool(), encode_for_telegram, source)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось перекодировать результат, отправляю оригинал: {e}")
+        if isinstance(source, str):
+            return FSInputFile(source), None
+        return BufferedInputFile(source, filename="image.png"), None
+
+    original_size = os.path.getsize(source) if isinstance(source, str) else len(source)
+    logger.info(f"🗜 Результат перекодирован: {original_size} → {len(encoded)} байт")
+    return BufferedInputFile(encoded, filename="image.jpg"), encoded
+
+async def prepare_edit_upload(photo_bytes: bytes) -> bytes:
+    """Нормализует фото для API вне event loop; при ошибке отдает исходные байты"""
+    loop = asyncio.get_running_loop()
+    try:
+        prepared = await loop.run_in_executor(get_image_process_pool(), normalize_edit_photo, photo_bytes)
+        logger.info(f"🖼 Фото подготовлено: {len(photo_bytes)} → {len(prepared)} байт")
+        return prepared
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось подготовить фото, отправляю как есть: {e}")
+        return photo_bytes
+
+# ========== ФОТО, ОЖИДАЮЩИЕ ПРОМПТА РЕДАКТИРОВАНИЯ ==========
+PENDING_UPLOAD_DIR = os.getenv("PENDING_UPLOAD_DIR", "pending_uploads")
+PENDING_UPLOAD_TTL = int(os.getenv("PENDING_UPLOAD_TTL", "900"))
+# С общим состоянием фото сразу пишутся на диск: промпт может прийти в другой процесс
+PENDING_UPLOAD_MEMORY_BUDGET = int(os.getenv(
+    "PENDING_UPLOAD_MEMORY_BUDGET", "0" if STATE_BACKEND == "sqlite" else str(32 * 1024 * 1024)
+))
+PENDING_UPLOAD_SWEEP_INTERVAL = 60
+
+class PendingUpload:
+    def __init__(self, user_id: int, data: bytes):
+        self.user_id = user_id
+        self.data: Optional[bytes] = data
+        self.size = len(data)
+        self.path: Optional[str] = None
+        self.created_at = time.monotonic()
+
+class PendingUploadStore:
+    """Фото между загрузкой и промптом: в FSM лежит только короткий handle.
+
+    Сверх PENDING_UPLOAD_MEMORY_BUDGET самые старые фото выгружаются на диск,
+    а брошенные дольше PENDING_UPLOAD_TTL удаляются (баланс возвращает sweeper).
+    """
+
+    def __init__(self, root: str, ttl: int, memory_budget: int):
+        self.root = root
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+        self.entries: "OrderedDict[str, PendingUpload]" = OrderedDict()
+        self.memory_bytes = 0
+
+    async def put(self, user_id: int, data: bytes, handle: Optional[str] = None) -> str:
+        handle = handle or f"{user_id}_{uuid.uuid4().hex}"
+        self.entries[handle] = PendingUpload(user_id, data)
+        self.memory_bytes += len(data)
+        await self._spill_over_budget()
+        return handle
+
+    async def take(self, handle: Optional[str]) -> Optional[bytes]:
+        """Забирает фото (None, если его нет или оно уже удалено по TTL)"""
+        upload = self.entries.pop(handle, None) if handle else None
+        if upload is None:
+            # Фото мог принять другой процесс: ищем его выгруженный файл
+            if handle and re.fullmatch(r"\d+_[0-9a-f]{32}", handle):
+                return await asyncio.to_thread(self._read_and_remove, self._spill_path(handle))
+            return None
+        if upload.data is not None:
+            self.memory_bytes -= upload.size
+            return upload.data
+        return await asyncio.to_thread(self._read_and_remove, upload.path)
+
+    async def discard(self, handle: Optional[str]):
+        await self.take(handle)
+
+    async def expire(self) -> List[str]:
+        """Удаляет просроченные фото и возвращает их handle"""
+        deadline = time.monotonic() - self.ttl
+        expired = [handle for handle, upload in self.entries.items() if upload.created_at < deadline]
+        handles = []
+        for handle in expired:
+            # Возврат только если фото не успели забрать (в том числе другим процессом)
+            if await self.take(handle) is not None:
+                handles.append(handle)
+        return handles
+
+    def cleanup_leftovers(self, max_age: Optional[float] = None) -> List[str]:
+        """Удаляет выгруженные фото (старше max_age или все) и возвращает их handle"""
+        if not os.path.isdir(self.root):
+            return []
+        handles = []
+        now = time.time()
+        for filename in os.listdir(self.root):
+            path = os.path.join(self.root, filename)
+            if max_age is not None and filename.endswith(".taken"):
+                # Файл прямо сейчас читает процесс, который его забрал
+                continue
+            try:
+                if max_age is not None and now - os.path.getmtime(path) < max_age:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                # Файл забрал или удалил другой процесс
+                continue
+            if filename.endswith(".bin"):
+                handles.append(filename[:-len(".bin")])
+        return handles
+
+    def _spill_path(self, handle: str) -> str:
+        return os.path.join(self.root, f"{handle}.bin")
+
+    async def _spill_over_budget(self):
+        for handle, upload in list(self.entries.items()):
+            if self.memory_bytes <= self.memory_budget:
+                break
+            if upload.data is None:
+                continue
+            path = self._spill_path(handle)
+            await asyncio.to_thread(self._write, path, upload.data)
+            if self.entries.get(handle) is not upload:
+                # Фото забрали, пока оно записывалось
+                await asyncio.to_thread(self._read_and_remove, path)
+                continue
+            upload.path = path
+            upload.data = None
+            self.memory_bytes -= upload.size
+
+    def _write(self, path: str, data: bytes):
+        os.makedirs(self.root, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    @staticmethod
+    def _read_and_remove(path: str) -> Optional[bytes]:
+        # Переименование атомарно: из нескольких процессов файл заберет только один
+        claimed = f"{path}.{os.getpid()}.taken"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(claimed, "rb") as f:
+                data = f.read()
+            os.remove(claimed)
+            return data
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось прочитать выгруженное фото {path}: {e}")
+            return None
+
+pending_uploads = PendingUploadStore(PENDING_UPLOAD_DIR, PENDING_UPLOAD_TTL, PENDING_UPLOAD_MEMORY_BUDGET)
+
+async def refund_abandoned_upload(handle: str, notify: bool = True):
+    """Возвращает изображение за фото, к которому так и не прислали промпт"""
+    if not await release_hold(handle):
+        return
+    user_id = int(handle.split("_", 1)[0])
+    logger.info(f"⌛ Брошенное фото пользователя {user_id} удалено, баланс возвращен")
+    if not notify:
+        return
+    try:
+        await get_bot().send_message(
+            user_id,
+            "⌛ Фото для редактирования ждало слишком долго и было удалено.\n\n"
+            "<i>Изображение возвращено на баланс</i>",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось уведомить {user_id} о возврате: {e}")
+
+async def pending_upload_sweeper():
+    """Фоновая задача: удаляет брошенные фото и возвращает за них баланс"""
+    # С общим состоянием в каталоге лежат и живые фото других процессов
+    shared = STATE_BACKEND == "sqlite"
+    for handle in pending_uploads.cleanup_leftovers(PENDING_UPLOAD_TTL if shared else None):
+        await refund_abandoned_upload(handle, notify=False)
+    while True:
+        await asyncio.sleep(PENDING_UPLOAD_SWEEP_INTERVAL)
+        try:
+            expired = await pending_uploads.expire()
+            if shared:
+                # Фото процессов, которые завершились, не дождавшись промпта
+                expired += pending_uploads.cleanup_leftovers(PENDING_UPLOAD_TTL)
+            for handle in expired:
+                await refund_abandoned_upload(handle)
+            await release_stale_holds()
+        except Exception as e:
+            logger.error(f"❌ Ошибка очистки ожидающих фото: {e}")
+
+# ========== ФУНКЦИЯ РЕДАКТИРОВАНИЯ ИЗОБРАЖЕНИЙ ==========
+@timed(OPERATION_SECONDS, "edit_image_api")
+async def edit_image_api(photo_bytes: bytes, edit_prompt: str) -> Dict[str, Any]:
+    """Редактирует загруженное фото через AI Tunnel API (без временных файлов)"""
+    API_URL = f"{AITUNNEL_BASE_URL}/v1/images/edits"
+    headers = {"Accept": "application/json"}
+    request_started: Optional[float] = None
+
+    try:
+        session = get_http_session()
+        logger.info(f"✏️ Редактирую фото: '{edit_prompt[:50]}...'")
+
+        form_data = aiohttp.FormData()
+        form_data.add_field('model', 'flux.2-pro')
+        form_data.add_field('prompt', edit_prompt)
+        form_data.add_field('n', '1')
+        form_data.add_field('size', '1024x1024')
+        form_data.add_field('response_format', 'b64_json')
+        # memoryview: байты фото уходят в multipart без копирования
+        filename, content_type = image_upload_name(photo_bytes)
+        form_data.add_field('image', memoryview(photo_bytes), filename=filename, content_type=content_type)
+
+        request_started = time.perf_counter()
+        request_status = "error"
+        async with session.post(API_URL, headers=headers, data=form_data) as response:
+            request_status = str(response.status)
+            if response.status == 200:
+                images, saw_data = await read_image_response(response, in_memory=True)
+                logger.info("✅ API редактирования вернуло ответ")
+
+                if images:
+                    # Берем первое изображение, остальные не нужны
+                    logger.info(f"✅ Изображение получено: {len(images[0])} байт")
+                    return {"success": True, "image_bytes": images[0]}
+                elif saw_data:
+                    return {"success": False, "error": "invalid_response", "message": "Неверный формат ответа API"}
+                else:
+                    return {"success": False, "error": "no_data", "message": "API не вернул данные"}
+            else:
+                response_text = await response.text()
+                logger.error(f"❌ Ошибка API {response.status}: {response_text}")
+                try:
+                    error_json = json.loads(response_text)
+                    error_msg = error_json.get('error', {}).get('message', response_text)
+                except:
+                    error_msg = response_text[:200]
+                return {"success": False, "error": f"api_error_{response.status}", "message": f"Ошибка API: {error_msg}"}
 
     except asyncio.TimeoutError:
+        request_status = "timeout"
         logger.error("❌ Таймаут при редактировании")
         return {"success": False, "error": "timeout", "message": "Таймаут при обработке запроса"}
     except Exception as e:
         logger.exception(f"💥 Ошибка при редактировании: {e}")
         return {"success": False, "error": "unexpected_error", "message": f"Внутренняя ошибка: {str(e)}"}
     finally:
-        try:
-            if os.path.exists(temp_file_name):
-                os.remove(temp_file_name)
-        except:
-            pass
+        if request_started is not None:
+            AI_TUNNEL_SECONDS.observe(time.perf_counter() - request_started, "edits", request_status)
 
 # ========== ФУНКЦИЯ ГЕНЕРАЦИИ ИЗОБРАЖЕНИЙ ==========
+async def _generate_single_prompt(prompt: str) -> Dict[str, Any]:
+    """Генерирует одно изображение; ошибка возвращается как результат промпта"""
+    API_URL = f"{AITUNNEL_BASE_URL}/v1/images/generations"
+    headers = {"Content-Type": "application/json"}
+
+    data = {**GENERATION_PARAMS, "prompt": prompt}
+    request_started = time.perf_counter()
+    request_status = "error"
+
+    try:
+        session = get_http_session()
+        logger.info(f"🔄 Генерирую изображение для: {prompt[:50]}...")
+
+        async with session.post(API_URL, headers=headers, json=data) as response:
+            request_status = str(response.status)
+            if response.status == 200:
+                file_paths, saw_data = await read_image_response(response)
+
+                if saw_data:
+                    if file_paths:
+                        logger.info(f"✅ Успешно сгенерирован промпт: {prompt[:50]}")
+                        return {
+                            "prompt": prompt,
+                            "file_paths": file_paths,
+                            "from_cache": False
+                        }
+                    else:
+                        return {
+                            "prompt": prompt,
+                            "error": "no_images",
+                            "message": "API не вернул изображения"
+                        }
+                else:
+                    return {
+                        "prompt": prompt,
+                        "error": "invalid_response",
+                        "message": "Неверный ответ от API"
+                    }
+            else:
+                error_text = await response.text()
+                logger.error(f"❌ Ошибка API {response.status} для промпта: {prompt[:50]}")
+                return {
+                    "prompt": prompt,
+                    "error": "api_error",
+                    "message": f"Ошибка API: {response.status}"
+                }
+
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            request_status = "timeout"
+        logger.error(f"❌ Ошибка генерации для промпта '{prompt}': {e}")
+        return {
+            "prompt": prompt,
+            "error": "processing_error",
+            "message": str(e)[:100]
+        }
+    finally:
+        AI_TUNNEL_SECONDS.observe(time.perf_counter() - request_started, "generations", request_status)
+
+@timed(OPERATION_SECONDS, "generate_images_api")
 async def generate_images_api(prompts: List[str]) -> Dict[str, Any]:
     """Генерирует изображения через AI Tunnel API"""
     if not prompts:
@@ -601,8 +2647,8 @@ async def generate_images_api(prompts: List[str]) -> Dict[str, Any]:
     uncached_prompts = []
 
     for prompt in prompts:
-        cached = get_cached_image(prompt)
-        if cached and os.path.exists(cached):
+        cached = await get_cached_image(prompt)
+        if cached:
             cached_images[prompt] = cached
         else:
             uncached_prompts.append(prompt)
@@ -611,104 +2657,32 @@ async def generate_images_api(prompts: List[str]) -> Dict[str, Any]:
         return {
             "success": True,
             "from_cache": True,
-            "results": [{"prompt": p, "file_paths": [cached_images[p]], "from_cache": True} for p in prompts],
+            "results": [{"prompt": p, "file_ids": [cached_images[p][0]], "cache_paths": [cached_images[p][1]],
+                         "from_cache": True} for p in prompts],
             "cached_count": len(cached_images)
         }
 
-    API_URL = "https://api.aitunnel.ru/v1/images/generations"
-    headers = {
-        "Authorization": f"Bearer {AITUNNEL_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    all_results = []
-
-    for prompt in uncached_prompts:
-        data = {
-            "model": "flux.2-pro",
-            "prompt": prompt,
-            "width": 1024,
-            "height": 1024,
-            "steps": 20,
-            "num_images": 1
-        }
-
-        timeout = ClientTimeout(total=120)
+    async def generate_limited(prompt: str) -> Dict[str, Any]:
+        async with generation_semaphore:
+            return await _generate_single_prompt(prompt)
 
-        try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                logger.info(f"🔄 Генерирую изображение для: {prompt[:50]}...")
+    generated = await asyncio.gather(*(generate_limited(p) for p in uncached_prompts))
+    generated_iter = iter(generated)
 
-                async with session.post(API_URL, headers=headers, json=data) as response:
-                    if response.status == 200:
-                        result = await response.json()
-
-                        if 'data' in result and isinstance(result['data'], list):
-                            file_paths = []
-
-                            for idx, item in enumerate(result['data']):
-                                if 'url' in item and item['url'].startswith('data:image/'):
-                                    if 'base64,' in item['url']:
-                                        base64_data = item['url'].split('base64,')[1]
-                                        image_bytes = base64.b64decode(base64_data)
-
-                                        file_name = f"generated_{uuid.uuid4().hex}_{idx}.png"
-                                        with open(file_name, "wb") as f:
-                                            f.write(image_bytes)
-
-                                        file_paths.append(file_name)
-                                elif 'b64_json' in item:
-                                    image_bytes = base64.b64decode(item['b64_json'])
-                                    file_name = f"generated_{uuid.uuid4().hex}_{idx}.png"
-                                    with open(file_name, "wb") as f:
-                                        f.write(image_bytes)
-                                    file_paths.append(file_name)
-
-                            if file_paths:
-                                save_to_cache(prompt, file_paths[0])
-                                all_results.append({
-                                    "prompt": prompt,
-                                    "file_paths": file_paths,
-                                    "from_cache": False
-                                })
-                                logger.info(f"✅ Успешно сгенерирован промпт: {prompt[:50]}")
-                            else:
-                                all_results.append({
-                                    "prompt": prompt,
-                                    "error": "no_images",
-                                    "message": "API не вернул изображения"
-                                })
-                        else:
-                            all_results.append({
-                                "prompt": prompt,
-                                "error": "invalid_response",
-                                "message": "Неверный ответ от API"
-                            })
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"❌ Ошибка API {response.status} для промпта: {prompt[:50]}")
-                        all_results.append({
-                            "prompt": prompt,
-                            "error": "api_error",
-                            "message": f"Ошибка API: {response.status}"
-                        })
-
-        except Exception as e:
-            logger.error(f"❌ Ошибка генерации для промпта '{prompt}': {e}")
+    # Результаты в исходном порядке промптов
+    all_results = []
+    for prompt in prompts:
+        if prompt in cached_images:
             all_results.append({
                 "prompt": prompt,
-                "error": "processing_error",
-                "message": str(e)[:100]
+                "file_ids": [cached_images[prompt][0]],
+                "cache_paths": [cached_images[prompt][1]],
+                "from_cache": True
             })
+        else:
+            all_results.append(next(generated_iter))
 
-    for prompt in cached_images:
-        all_results.append({
-            "prompt": prompt,
-            "file_paths": [cached_images[prompt]],
-            "from_cache": True
-        })
-
-    successful_results = [r for r in all_results if "file_paths" in r]
+    successful_results = [r for r in all_results if "file_paths" in r or "file_ids" in r]
 
     return {
         "success": len(successful_results) > 0,
@@ -792,15 +2766,12 @@ async def btn_my_balance(message: types.Message):
     """Показать баланс"""
     user_id = message.from_user.id
     
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute("SELECT images_left, total_spent FROM user_balance WHERE user_id = ?", (user_id,))
-    balance_data = c.fetchone()
+    balance_data = await db.fetchone("SELECT images_left, total_spent FROM user_balance WHERE user_id = ?", (user_id,),
+                                     label="btn_my_balance")
     
     # Получаем историю платежей
-    c.execute("SELECT amount, description, status, created_at FROM payment_history WHERE user_id = ? ORDER BY created_at DESC LIMIT 5", (user_id,))
-    history = c.fetchall()
-    conn.close()
+    history = await db.fetchall("SELECT amount, description, status, created_at FROM payment_history WHERE user_id = ? ORDER BY created_at DESC LIMIT 5", (user_id,),
+                                label="btn_my_balance")
     
     if balance_data:
         images_left, total_spent = balance_data
@@ -886,7 +2857,7 @@ async def create_payment_menu(message: types.Message, amount: float, description
             f"1. Нажмите на ссылку ниже 👇\n"
             f"2. Оплатите через СБП или карту\n"
             f"3. Вернитесь в бота\n"
-            f"4. Нажмите <b>✅ Я оплатил</b>\n\n"
+            f"4. Изображения зачислятся автоматически (или нажмите <b>✅ Я оплатил</b>)\n\n"
             f"🔗 <a href='{payment_url}'>Оплатить {amount} руб.</a>\n\n"
             f"<i>После успешной оплаты изображения автоматически зачислятся на баланс</i>",
             parse_mode="HTML",
@@ -899,11 +2870,8 @@ async def btn_payment_done(message: types.Message):
     user_id = message.from_user.id
     
     # Ищем последний ожидающий платеж пользователя
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute("SELECT payment_id, yookassa_payment_id, amount FROM payments WHERE user_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1", (user_id,))
-    payment_data = c.fetchone()
-    conn.close()
+    payment_data = await db.fetchone("SELECT payment_id, yookassa_payment_id, amount FROM payments WHERE user_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1", (user_id,),
+                                     label="btn_payment_done")
     
     if not payment_data:
         await message.answer(
@@ -921,21 +2889,19 @@ async def btn_payment_done(message: types.Message):
         status = await check_payment_status(yookassa_payment_id)
         
         if status == 'succeeded':
-            # Зачисляем изображения
-            images_to_add = get_images_count_by_amount(amount)
-            await add_balance(user_id, images_to_add, amount)
-            
-            # Обновляем статус платежа
-            conn = sqlite3.connect('payments.db')
-            c = conn.cursor()
-            c.execute("UPDATE payments SET status = 'completed' WHERE payment_id = ?", (payment_id,))
-            c.execute("INSERT INTO payment_history (user_id, amount, description, status) VALUES (?, ?, ?, ?)",
-                      (user_id, amount, f"Покупка {images_to_add} изображений", 'completed'))
-            conn.commit()
-            conn.close()
-            
+            # Зачисляем изображения (повторное нажатие ничего не начислит)
+            images_to_add = await complete_payment(payment_id, user_id, amount)
             balance = await check_balance(user_id)
             
+            if images_to_add is None:
+                await message.answer(
+                    f"✅ <b>Оплата уже зачислена</b>\n\n"
+                    f"<b>Ваш баланс:</b> {balance} изображений",
+                    parse_mode="HTML",
+                    reply_markup=get_main_keyboard(message.from_user.id)
+                )
+                return
+            
             await message.answer(
                 f"✅ <b>Оплата подтверждена!</b>\n\n"
                 f"<b>Зачислено:</b> {images_to_add} изображений\n"
@@ -953,6 +2919,8 @@ async def btn_payment_done(message: types.Message):
                 reply_markup=get_payment_keyboard()
             )
         else:
+            if status == 'canceled':
+                await cancel_payment(payment_id)
             await message.answer(
                 f"❌ <b>Платеж не найден или отменен</b>\n\n"
                 f"Статус: {status}\n\n"
@@ -986,23 +2954,25 @@ async def cmd_restore(message: types.Message):
     
     await message.answer(
         "🔄 <b>Восстановление данных из ЮKassa</b>\n\n"
-        "Начинаю восстановление платежей...",
+        "Догружаю недостающие платежи...",
         parse_mode="HTML"
     )
     
-    restore_database_from_yookassa()
+    try:
+        synced = await sync_payments_from_yookassa()
+    except Exception as e:
+        logger.error(f"❌ Ошибка синхронизации с ЮKassa: {e}")
+        await message.answer(f"❌ Ошибка синхронизации: {e}", reply_markup=get_main_keyboard(message.from_user.id))
+        return
     
     # Проверяем что восстановилось
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM user_balance")
-    users_count = c.fetchone()[0] or 0
-    c.execute("SELECT SUM(amount) FROM payments WHERE status = 'completed'")
-    total_income = c.fetchone()[0] or 0
-    conn.close()
+    counters = await read_admin_counters()
+    users_count = int(counters.get("users", 0))
+    total_income = counters.get("income", 0)
     
     await message.answer(
         f"✅ <b>Восстановление завершено</b>\n\n"
+        f"• Зачислено платежей: {synced}\n"
         f"• Пользователей в базе: {users_count}\n"
         f"• Всего поступлений: {total_income} руб.\n\n"
         f"Теперь бот должен работать корректно!",
@@ -1138,16 +3108,8 @@ async def cmd_help(message: types.Message):
 async def cmd_stats(message: types.Message):
     """Статистика пользователя"""
     user_id = message.from_user.id
-    conn = sqlite3.connect('bot_cache.db')
-    c = conn.cursor()
-
-    c.execute("SELECT requests_count, total_images, last_request FROM user_stats WHERE user_id = ?", (user_id,))
-    user_stats = c.fetchone()
-
-    c.execute("SELECT COUNT(*) FROM image_cache")
-    cache_count = c.fetchone()[0]
-
-    conn.close()
+    user_stats = await user_stats_buffer.get(user_id)
+    cache_count = int((await read_admin_counters()).get("cached_images", 0))
     
     balance = await check_balance(user_id)
 
@@ -1200,7 +3162,8 @@ async def process_single_prompt(message: types.Message, state: FSMContext):
 
     # Проверяем и списываем баланс
     user_id = message.from_user.id
-    if not await deduct_balance(user_id, 1):
+    hold_id = await reserve_balance(user_id, 1)
+    if hold_id is None:
         await message.answer(
             "❌ <b>Недостаточно изображений на балансе!</b>\n\n"
             "Пополните баланс через 💰 Цены/Оплата",
@@ -1217,22 +3180,19 @@ async def process_single_prompt(message: types.Message, state: FSMContext):
         reply_markup=ReplyKeyboardRemove()
     )
 
-    async with queue_lock:
-        if len(request_queue) >= PROCESSING_LIMIT:
-            await message.answer(
-                "⏳ Очередь переполнена. Попробуйте через минуту.",
-                reply_markup=get_main_keyboard(message.from_user.id)
-            )
-            await state.clear()
-            return
-        request_queue.append(message.from_user.id)
-
     try:
-        result = await generate_images_api([prompt])
+        result = await run_user_job(message, lambda: generate_images_api([prompt]))
 
         if result.get("success"):
             update_user_stats(message.from_user.id, 1)
-            await handle_generation_results(message, result)
+            delivered = await handle_generation_results(message, result)
+            # Фото не дошло (Telegram отклонил отправку) - изображение возвращается
+            if await commit_hold(hold_id, used=delivered):
+                await message.answer(
+                    "📊 <b>Изображение возвращено на баланс</b>\n"
+                    "<i>Не удалось отправить фото</i>",
+                    parse_mode="HTML"
+                )
         else:
             error_msg = result.get("message", "Неизвестная ошибка")
             await message.answer(
@@ -1242,8 +3202,16 @@ async def process_single_prompt(message: types.Message, state: FSMContext):
                 reply_markup=get_main_keyboard(message.from_user.id)
             )
             # Возвращаем изображение на баланс при ошибке
-            await add_balance(user_id, 1, 0)
+            await release_hold(hold_id)
 
+    except QueueFullError:
+        await message.answer(
+            "⏳ Очередь переполнена. Попробуйте через минуту.\n\n"
+            "<i>Изображение возвращено на баланс</i>",
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(message.from_user.id)
+        )
+        await release_hold(hold_id)
     except Exception as e:
         logger.error(f"Ошибка обработки: {e}")
         await message.answer(
@@ -1253,12 +3221,8 @@ async def process_single_prompt(message: types.Message, state: FSMContext):
             reply_markup=get_main_keyboard(message.from_user.id)
         )
         # Возвращаем изображение на баланс при ошибке
-        await add_balance(user_id, 1, 0)
+        await release_hold(hold_id)
     finally:
-        async with queue_lock:
-            if message.from_user.id in request_queue:
-                request_queue.remove(message.from_user.id)
-
         await state.clear()
 
 @dp.message(StateFilter(Form.waiting_for_batch_prompts))
@@ -1295,7 +3259,8 @@ async def process_batch_prompts(message: types.Message, state: FSMContext):
 
     user_id = message.from_user.id
     # Проверяем и списываем баланс за все промпты
-    if not await deduct_balance(user_id, len(prompts)):
+    hold_id = await reserve_balance(user_id, len(prompts))
+    if hold_id is None:
         await message.answer(
             f"❌ <b>Недостаточно изображений на балансе!</b>\n\n"
             f"Нужно: {len(prompts)} изображений\n"
@@ -1313,36 +3278,25 @@ async def process_batch_prompts(message: types.Message, state: FSMContext):
     await message.answer(
         f"📦 <b>Обрабатываю {len(prompts)} промптов:</b>\n"
         f"{prompt_preview}\n"
-        f"⏳ Это займет {len(prompts) * 15} секунд...",
+        f"⏳ Это займет около {estimate_batch_seconds(len(prompts))} секунд...",
         parse_mode="HTML",
         reply_markup=ReplyKeyboardRemove()
     )
 
-    async with queue_lock:
-        if len(request_queue) >= PROCESSING_LIMIT:
-            await message.answer(
-                "⏳ Очередь переполнена. Попробуйте через минуту.",
-                reply_markup=get_main_keyboard(message.from_user.id)
-            )
-            await state.clear()
-            return
-        request_queue.append(message.from_user.id)
-
     try:
-        result = await generate_images_api(prompts)
+        result = await run_user_job(message, lambda: generate_images_api(prompts))
 
         if result.get("success"):
             successful_count = result.get("total_received", 0)
             update_user_stats(message.from_user.id, successful_count)
-            await handle_generation_results(message, result, is_batch=True)
+            delivered = await handle_generation_results(message, result, is_batch=True)
             
-            # Возвращаем неиспользованные изображения
-            failed_count = len(prompts) - successful_count
-            if failed_count > 0:
-                await add_balance(user_id, failed_count, 0)
+            # Списываем только удавшиеся и доставленные, остальное возвращается из резерва
+            failed_count = await commit_hold(hold_id, used=min(successful_count, delivered))
+            if failed_count:
                 await message.answer(
                     f"📊 <b>Возвращено на баланс:</b> {failed_count} изображений\n"
-                    f"<i>За неудавшиеся генерации</i>",
+                    f"<i>За неудавшиеся генерации и неотправленные фото</i>",
                     parse_mode="HTML"
                 )
         else:
@@ -1354,8 +3308,16 @@ async def process_batch_prompts(message: types.Message, state: FSMContext):
                 reply_markup=get_main_keyboard(message.from_user.id)
             )
             # Возвращаем все изображения при ошибке
-            await add_balance(user_id, len(prompts), 0)
+            await release_hold(hold_id)
 
+    except QueueFullError:
+        await message.answer(
+            "⏳ Очередь переполнена. Попробуйте через минуту.\n\n"
+            "<i>Все изображения возвращены на баланс</i>",
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(message.from_user.id)
+        )
+        await release_hold(hold_id)
     except Exception as e:
         logger.error(f"Ошибка обработки: {e}")
         await message.answer(
@@ -1365,12 +3327,8 @@ async def process_batch_prompts(message: types.Message, state: FSMContext):
             reply_markup=get_main_keyboard(message.from_user.id)
         )
         # Возвращаем все изображения при ошибке
-        await add_balance(user_id, len(prompts), 0)
+        await release_hold(hold_id)
     finally:
-        async with queue_lock:
-            if message.from_user.id in request_queue:
-                request_queue.remove(message.from_user.id)
-
         await state.clear()
 
 @dp.message(StateFilter(Form.waiting_for_photo), F.photo)
@@ -1383,7 +3341,8 @@ async def process_edit_photo(message: types.Message, state: FSMContext):
 
     user_id = message.from_user.id
     # Проверяем и списываем баланс ДО загрузки фото
-    if not await deduct_balance(user_id, 1):
+    hold_id = await reserve_balance(user_id, 1)
+    if hold_id is None:
         await message.answer(
             "❌ <b>Недостаточно изображений на балансе!</b>\n\n"
             "Пополните баланс через 💰 Цены/Оплата",
@@ -1393,17 +3352,18 @@ async def process_edit_photo(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
+    upload_handle = None
     try:
         file_id = message.photo[-1].file_id
-        file = await bot.get_file(file_id)
-
-        temp_file = f"temp_edit_{uuid.uuid4().hex}.jpg"
-        await bot.download_file(file.file_path, temp_file)
+        file = await message.bot.get_file(file_id)
 
-        with open(temp_file, "rb") as f:
-            photo_bytes = f.read()
+        # Без destination aiogram скачивает файл в BytesIO
+        photo_buffer = await message.bot.download_file(file.file_path)
+        photo_bytes = await prepare_edit_upload(photo_buffer.getvalue())
+        # Handle фото совпадает с id резерва: по нему же возвращается баланс за брошенное фото
+        upload_handle = await pending_uploads.put(user_id, photo_bytes, handle=hold_id)
 
-        await state.update_data(photo_bytes=photo_bytes)
+        await state.update_data(upload_handle=upload_handle)
 
         await message.answer(
             "✍️ <b>Что изменить на фото?</b>\n\n"
@@ -1423,15 +3383,11 @@ async def process_edit_photo(message: types.Message, state: FSMContext):
         )
         await state.set_state(Form.waiting_for_edit_prompt)
 
-        try:
-            os.remove(temp_file)
-        except:
-            pass
-
     except Exception as e:
         logger.error(f"Ошибка загрузки фото: {e}")
+        await pending_uploads.discard(upload_handle)
         # Возвращаем изображение при ошибке
-        await add_balance(user_id, 1, 0)
+        await release_hold(hold_id)
         await message.answer(
             f"❌ <b>Ошибка загрузки фото:</b> {str(e)[:100]}\n\n"
             f"<i>Изображение возвращено на баланс</i>",
@@ -1444,9 +3400,10 @@ async def process_edit_photo(message: types.Message, state: FSMContext):
 async def process_edit_request(message: types.Message, state: FSMContext):
     """Обработка запроса на редактирование"""
     if message.text == "⬅️ Назад":
-        user_id = message.from_user.id
+        data = await state.get_data()
+        await pending_uploads.discard(data.get("upload_handle"))
         # Возвращаем изображение при отмене
-        await add_balance(user_id, 1, 0)
+        await release_hold(data.get("upload_handle"))
         await state.clear()
         await message.answer(
             "⬅️ Возвращаюсь в главное меню\n\n"
@@ -1456,19 +3413,27 @@ async def process_edit_request(message: types.Message, state: FSMContext):
         )
         return
 
-    data = await state.get_data()
-    photo_bytes = data.get("photo_bytes")
     edit_prompt = message.text.strip()
+    if not edit_prompt:
+        await message.answer("⚠️ Введите, что изменить на фото")
+        return
+
+    data = await state.get_data()
+    hold_id = data.get("upload_handle")
+    photo_bytes = await pending_uploads.take(hold_id)
 
     if not photo_bytes:
-        await message.answer("❌ Фото не загружено", reply_markup=get_main_keyboard(message.from_user.id))
+        # Фото могло пропасть без возврата (перезапуск с фото в памяти); повторный возврат ничего не делает
+        await release_hold(hold_id)
+        await message.answer(
+            "❌ Фото не найдено — возможно, оно ждало слишком долго.\n\n"
+            "<i>Списанное изображение уже возвращено на баланс</i>",
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(message.from_user.id)
+        )
         await state.clear()
         return
 
-    if not edit_prompt:
-        await message.answer("⚠️ Введите, что изменить на фото")
-        return
-
     enhanced_prompt = enhance_edit_prompt(edit_prompt)
 
     await message.answer(
@@ -1478,35 +3443,38 @@ async def process_edit_request(message: types.Message, state: FSMContext):
         reply_markup=ReplyKeyboardRemove()
     )
 
-    result = await edit_image_api(photo_bytes, enhanced_prompt)
+    try:
+        result = await run_user_job(message, lambda: edit_image_api(photo_bytes, enhanced_prompt))
+    except QueueFullError:
+        result = {"success": False, "error": "queue_full", "message": "Очередь переполнена"}
 
     if result.get("success"):
-        file_path = result.get("file_path")
+        image_bytes = result.get("image_bytes")
 
-        if file_path and os.path.exists(file_path):
+        if image_bytes:
             try:
-                photo = FSInputFile(file_path)
-                await message.answer_photo(
+                photo, _ = await prepare_delivery_photo(image_bytes)
+                send_started = time.monotonic()
+                await send_with_flood_retry(lambda: message.answer_photo(
                     photo,
                     caption=f"✅ Отредактировано: {edit_prompt[:100]}",
                     reply_markup=get_main_keyboard(message.from_user.id)
-                )
-
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-
+                ), "sendPhoto")
+                logger.info(f"📤 Фото отправлено за {time.monotonic() - send_started:.2f} с")
+                await commit_hold(hold_id)
             except Exception as e:
                 logger.error(f"Ошибка отправки фото: {e}")
+                # Списываем только доставленное фото
+                await release_hold(hold_id)
                 await message.answer(
-                    "✅ Редактирование завершено, но не удалось отправить фото",
+                    "✅ Редактирование завершено, но не удалось отправить фото\n\n"
+                    "<i>Изображение возвращено на баланс</i>",
+                    parse_mode="HTML",
                     reply_markup=get_main_keyboard(message.from_user.id)
                 )
         else:
-            user_id = message.from_user.id
             # Возвращаем изображение при ошибке
-            await add_balance(user_id, 1, 0)
+            await release_hold(hold_id)
             await message.answer(
                 "❌ Ошибка при сохранении файла\n\n"
                 "<i>Изображение возвращено на баланс</i>",
@@ -1516,10 +3484,9 @@ async def process_edit_request(message: types.Message, state: FSMContext):
     else:
         error_type = result.get("error", "unknown")
         error_msg = result.get("message", "Неизвестная ошибка")
-        user_id = message.from_user.id
         
         # Возвращаем изображение при ошибке
-        await add_balance(user_id, 1, 0)
+        await release_hold(hold_id)
 
         if "400" in error_type:
             user_msg = (
@@ -1534,6 +3501,8 @@ async def process_edit_request(message: types.Message, state: FSMContext):
             user_msg = "⏳ Превышен лимит запросов. Попробуйте через 1-2 минуты.\n\n<i>Изображение возвращено на баланс</i>"
         elif "timeout" in error_type:
             user_msg = "⏳ Превышено время ожидания. Попробуйте позже.\n\n<i>Изображение возвращено на баланс</i>"
+        elif error_type == "queue_full":
+            user_msg = "⏳ Очередь переполнена. Попробуйте через минуту.\n\n<i>Изображение возвращено на баланс</i>"
         else:
             user_msg = f"❌ Ошибка редактирования: {error_msg}\n\n<i>Изображение возвращено на баланс</i>"
 
@@ -1545,9 +3514,28 @@ async def process_edit_request(message: types.Message, state: FSMContext):
 
     await state.clear()
 
+MEDIA_GROUP_LIMIT = 10  # ограничение Telegram на число фото в одном альбоме
+CAPTION_LIMIT = 1024    # ограничение Telegram на длину подписи к фото
+
+async def send_with_flood_retry(send: Callable[[], Awaitable[Any]], method: str) -> Any:
+    """Выполняет отправку, один раз повторяя ее после FloodWait"""
+    try:
+        with TELEGRAM_SEND_SECONDS.time(method):
+            return await send()
+    except TelegramRetryAfter as e:
+        logger.warning(f"⏳ FloodWait: жду {e.retry_after} с перед повторной отправкой")
+        await asyncio.sleep(e.retry_after)
+        with TELEGRAM_SEND_SECONDS.time(method):
+            return await send()
+
+@timed(OPERATION_SECONDS, "handle_generation_results")
 async def handle_generation_results(message: types.Message, result: Dict[str, Any],
-                                    is_batch: bool = False):
-    """Универсальная обработка результатов генерации"""
+                                    is_batch: bool = False) -> int:
+    """Универсальная обработка результатов генерации.
+
+    Возвращает число успешных промптов, фото которых дошли до пользователя:
+    за неотправленные фото вызывающий код возвращает изображения на баланс.
+    """
     if not result.get("success"):
         error_msg = result.get("message", "Неизвестная ошибка")
         await message.answer(
@@ -1556,7 +3544,7 @@ async def handle_generation_results(message: types.Message, result: Dict[str, An
             parse_mode="HTML",
             reply_markup=get_main_keyboard(message.from_user.id)
         )
-        return
+        return 0
 
     results = result.get("results", [])
     cached_count = result.get("cached_count", 0)
@@ -1569,77 +3557,155 @@ async def handle_generation_results(message: types.Message, result: Dict[str, An
             "Попробуйте другой промпт",
             reply_markup=get_main_keyboard(message.from_user.id)
         )
-        return
-
-    if cached_count > 0:
-        await message.answer(f"⚡ Использовано из кэша: {cached_count}", parse_mode="HTML")
+        return 0
 
-    successful_results = [r for r in results if "file_paths" in r and not r.get("error")]
+    successful_results = [r for r in results if ("file_paths" in r or "file_ids" in r) and not r.get("error")]
+    error_results = [r for r in results if r.get("error")]
 
+    # Элементы доставки: (результат, номер фото в результате, ссылка на фото, подпись)
+    items = []
     for res in successful_results:
         prompt = res.get("prompt", "Без названия")
-        file_paths = res.get("file_paths", [])
         from_cache = res.get("from_cache", False)
+        # Из кэша отправляем по file_id (без повторной загрузки), новые - файлом
+        photos = res.get("file_ids", []) if from_cache else res.get("file_paths", [])
+        for i, photo_ref in enumerate(photos):
+            # Подписи идут с parse_mode=HTML: текст пользователя экранируется
+            caption = f"✅ {html.escape(prompt[:100])}"
+            if from_cache:
+                caption += " (из кэша)"
+            if len(photos) > 1:
+                caption += f" [{i + 1}/{len(photos)}]"
+            items.append((res, i, photo_ref, caption))
+
+    async def prepare(res: Dict[str, Any], photo_ref: str):
+        if res.get("from_cache"):
+            return photo_ref, None
+        return await prepare_delivery_photo(photo_ref)
+
+    prepared = await asyncio.gather(*(prepare(res, photo_ref) for res, _, photo_ref, _ in items))
+
+    def stored_copy(n: int) -> Optional[FSInputFile]:
+        """Копия из хранилища для фото из кэша, если Telegram не принял его file_id"""
+        res, i = items[n][0], items[n][1]
+        paths = res.get("cache_paths", []) if res.get("from_cache") else []
+        if i < len(paths) and paths[i] and os.path.exists(paths[i]):
+            return FSInputFile(paths[i])
+        return None
 
-        if not file_paths:
-            continue
-
-        for i, file_path in enumerate(file_paths):
-            try:
-                photo = FSInputFile(file_path)
-                caption = f"✅ {prompt[:100]}"
-                if from_cache:
-                    caption += " (из кэша)"
-                if len(file_paths) > 1:
-                    caption += f" [{i + 1}/{len(file_paths)}]"
-
-                await message.answer_photo(
-                    photo,
-                    caption=caption,
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки фото: {e}")
-
-        if not from_cache:
-            for file_path in file_paths:
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                except:
-                    pass
-
-    error_results = [r for r in results if r.get("error")]
+    # Ошибки и итог идут в подпись к фото, а не отдельными сообщениями
+    footer = ""
     if error_results:
-        error_msg = "⚠️ <b>Частичные ошибки:</b>\n"
+        footer += "⚠️ <b>Частичные ошибки:</b>\n"
         for res in error_results[:3]:
-            error_msg += f"• {res.get('prompt', '?')[:30]}: {res.get('message', 'Ошибка')}\n"
-
+            footer += f"• {html.escape(res.get('prompt', '?')[:30])}: {html.escape(str(res.get('message', 'Ошибка')))}\n"
         if len(error_results) > 3:
-            error_msg += f"<i>... и еще {len(error_results) - 3} ошибок</i>"
-
-        await message.answer(error_msg, parse_mode="HTML")
+            footer += f"<i>... и еще {len(error_results) - 3} ошибок</i>\n"
+        footer += "\n"
 
     success_count = len(successful_results)
 
     if is_batch:
-        summary = f"📦 <b>Пакетная обработка завершена:</b> {success_count}/{total_requested} успешно"
+        footer += f"📦 <b>Пакетная обработка завершена:</b> {success_count}/{total_requested} успешно"
     else:
-        summary = f"🎨 <b>Генерация завершена:</b> {success_count} изображений"
+        footer += f"🎨 <b>Генерация завершена:</b> {success_count} изображений"
 
     if cached_count > 0:
-        summary += f", {cached_count} из кэша"
+        footer += f", {cached_count} из кэша"
 
     balance = await check_balance(message.from_user.id)
-    summary += f"\n💰 <b>Ваш баланс:</b> {balance} изображений"
+    footer += f"\n💰 <b>Ваш баланс:</b> {balance} изображений"
     
     # Добавляем подсказку про выгоду
     if balance < 3:
-        summary += "\n\n💡 <b>Совет:</b> Возьмите пакет 5 промптов за 99 руб - это выгоднее!"
+        footer += "\n\n💡 <b>Совет:</b> Возьмите пакет 5 промптов за 99 руб - это выгоднее!"
     
-    summary += "\n\n✅ <i>Готово! Что создаем дальше?</i>"
+    footer += "\n\n✅ <i>Готово! Что создаем дальше?</i>"
+
+    sent_messages: List[Optional[types.Message]] = [None] * len(items)
+    # Фото из кэша, отправленные копией из хранилища: их новый file_id пишется в кэш
+    resent_from_store = set()
+    footer_sent = False
+
+    if len(items) == 1:
+        # Одно фото: подпись, итог и клавиатура уходят одним сообщением
+        (_, _, _, caption), (photo, _) = items[0], prepared[0]
+        merged = f"{caption}\n\n{footer}"
+        footer_sent = len(merged) <= CAPTION_LIMIT
+
+        async def send_photo(photo: Union[str, FSInputFile, BufferedInputFile]) -> types.Message:
+            return await send_with_flood_retry(lambda: message.answer_photo(
+                photo,
+                caption=merged if footer_sent else caption,
+                parse_mode="HTML",
+                reply_markup=get_main_keyboard(message.from_user.id) if footer_sent else None
+            ), "sendPhoto")
+
+        try:
+            send_started = time.monotonic()
+            try:
+                sent_messages[0] = await send_photo(photo)
+            except TelegramBadRequest as e:
+                fallback = stored_copy(0)
+                if fallback is None:
+                    raise
+                logger.warning(f"⚠️ file_id из кэша не принят ({e}), отправляю копию из хранилища")
+                sent_messages[0] = await send_photo(fallback)
+                resent_from_store.add(0)
+            logger.info(f"📤 Фото отправлено за {time.monotonic() - send_started:.2f} с")
+        except Exception as e:
+            footer_sent = False
+            logger.error(f"Ошибка отправки фото: {e}")
+    else:
+        for offset in range(0, len(items), MEDIA_GROUP_LIMIT):
+            chunk = range(offset, min(offset + MEDIA_GROUP_LIMIT, len(items)))
+
+            async def send_album(photos: Dict[int, Any]) -> List[types.Message]:
+                media = [InputMediaPhoto(media=photos[n], caption=items[n][3], parse_mode="HTML") for n in chunk]
+                return await send_with_flood_retry(lambda: message.answer_media_group(media), "sendMediaGroup")
+
+            try:
+                send_started = time.monotonic()
+                try:
+                    sent = await send_album({n: prepared[n][0] for n in chunk})
+                except TelegramBadRequest as e:
+                    fallbacks = {n: stored_copy(n) for n in chunk}
+                    if not any(fallbacks.values()):
+                        raise
+                    logger.warning(f"⚠️ Альбом с file_id из кэша не принят ({e}), отправляю копии из хранилища")
+                    sent = await send_album({n: fallbacks[n] or prepared[n][0] for n in chunk})
+                    resent_from_store.update(n for n in chunk if fallbacks[n])
+                logger.info(f"📤 Альбом из {len(chunk)} фото отправлен за {time.monotonic() - send_started:.2f} с")
+                for n, sent_message in zip(chunk, sent):
+                    sent_messages[n] = sent_message
+            except Exception as e:
+                logger.error(f"Ошибка отправки альбома: {e}")
+
+    for n, ((res, i, photo_ref, _), (_, delivery_bytes), sent) in enumerate(zip(items, prepared, sent_messages)):
+        if (res.get("from_cache") and n not in resent_from_store) or i != 0 or not sent or not sent.photo:
+            continue
+        try:
+            cache_path = photo_ref
+            if n in resent_from_store:
+                cache_path = res["cache_paths"][i]
+            elif delivery_bytes and not KEEP_ORIGINAL_IMAGES:
+                cache_path = await asyncio.to_thread(image_store.put, delivery_bytes, "jpg")
+            await save_to_cache(res.get("prompt", "Без названия"), sent.photo[-1].file_id,
+                                sent.photo[-1].file_unique_id, cache_path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения в кэш: {e}")
+
+    await image_store.discard_files([file_path for res in successful_results if not res.get("from_cache")
+                                     for file_path in res.get("file_paths", [])])
 
-    await message.answer(summary, parse_mode="HTML", reply_markup=get_main_keyboard(message.from_user.id))
+    if not footer_sent:
+        # Альбомы не поддерживают клавиатуру, поэтому итог с ней - отдельным сообщением
+        await message.answer(footer, parse_mode="HTML", reply_markup=get_main_keyboard(message.from_user.id))
+
+    delivered = {id(res) for (res, _, _, _), sent in zip(items, sent_messages) if sent is not None}
+    if len(delivered) < len(successful_results):
+        logger.warning(f"⚠️ Не доставлено фото: {len(successful_results) - len(delivered)} из {len(successful_results)}")
+    return len(delivered)
 
 # ========== ТЕКСТОВЫЕ КОМАНДЫ ==========
 @dp.message(Command("generate"))
@@ -1657,7 +3723,8 @@ async def cmd_generate_text(message: types.Message):
         return
 
     user_id = message.from_user.id
-    if not await deduct_balance(user_id, 1):
+    hold_id = await reserve_balance(user_id, 1)
+    if hold_id is None:
         await message.answer(
             "❌ <b>Недостаточно изображений на балансе!</b>\n\n"
             "Пополните баланс через 💰 Цены/Оплата",
@@ -1671,21 +3738,19 @@ async def cmd_generate_text(message: types.Message):
         parse_mode="HTML"
     )
 
-    async with queue_lock:
-        if len(request_queue) >= PROCESSING_LIMIT:
-            await message.answer(
-                "⏳ Очередь переполнена. Попробуйте через минуту.",
-                reply_markup=get_main_keyboard(message.from_user.id)
-            )
-            return
-        request_queue.append(message.from_user.id)
-
     try:
-        result = await generate_images_api([prompt])
+        result = await run_user_job(message, lambda: generate_images_api([prompt]))
 
         if result.get("success"):
             update_user_stats(message.from_user.id, 1)
-            await handle_generation_results(message, result)
+            delivered = await handle_generation_results(message, result)
+            # Фото не дошло (Telegram отклонил отправку) - изображение возвращается
+            if await commit_hold(hold_id, used=delivered):
+                await message.answer(
+                    "📊 <b>Изображение возвращено на баланс</b>\n"
+                    "<i>Не удалось отправить фото</i>",
+                    parse_mode="HTML"
+                )
         else:
             error_msg = result.get("message", "Неизвестная ошибка")
             await message.answer(
@@ -1694,8 +3759,16 @@ async def cmd_generate_text(message: types.Message):
                 parse_mode="HTML",
                 reply_markup=get_main_keyboard(message.from_user.id)
             )
-            await add_balance(user_id, 1, 0)
+            await release_hold(hold_id)
 
+    except QueueFullError:
+        await message.answer(
+            "⏳ Очередь переполнена. Попробуйте через минуту.\n\n"
+            "<i>Изображение возвращено на баланс</i>",
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(message.from_user.id)
+        )
+        await release_hold(hold_id)
     except Exception as e:
         logger.error(f"Ошибка обработки: {e}")
         await message.answer(
@@ -1704,11 +3777,7 @@ async def cmd_generate_text(message: types.Message):
             parse_mode="HTML",
             reply_markup=get_main_keyboard(message.from_user.id)
         )
-        await add_balance(user_id, 1, 0)
-    finally:
-        async with queue_lock:
-            if message.from_user.id in request_queue:
-                request_queue.remove(message.from_user.id)
+        await release_hold(hold_id)
 
 @dp.message(Command("batch"))
 async def cmd_batch_text(message: types.Message):
@@ -1741,7 +3810,8 @@ async def cmd_batch_text(message: types.Message):
         await message.answer(f"⚠️ Будут обработаны первые {MAX_PROMPTS_PER_BATCH} промптов")
 
     user_id = message.from_user.id
-    if not await deduct_balance(user_id, len(prompts)):
+    hold_id = await reserve_balance(user_id, len(prompts))
+    if hold_id is None:
         await message.answer(
             f"❌ <b>Недостаточно изображений на балансе!</b>\n\n"
             f"Нужно: {len(prompts)} изображений\n"
@@ -1754,33 +3824,23 @@ async def cmd_batch_text(message: types.Message):
     await message.answer(
         f"📦 <b>Обрабатываю {len(prompts)} промптов:</b>\n"
         f"<i>{' • '.join(p[:20] + '...' if len(p) > 20 else p for p in prompts)}</i>\n"
-        f"⏳ Это займет {len(prompts) * 15} секунд...",
+        f"⏳ Это займет около {estimate_batch_seconds(len(prompts))} секунд...",
         parse_mode="HTML"
     )
 
-    async with queue_lock:
-        if len(request_queue) >= PROCESSING_LIMIT:
-            await message.answer(
-                "⏳ Очередь переполнена. Попробуйте через минуту.",
-                reply_markup=get_main_keyboard(message.from_user.id)
-            )
-            return
-        request_queue.append(message.from_user.id)
-
     try:
-        result = await generate_images_api(prompts)
+        result = await run_user_job(message, lambda: generate_images_api(prompts))
 
         if result.get("success"):
             successful_count = result.get("total_received", 0)
             update_user_stats(message.from_user.id, successful_count)
-            await handle_generation_results(message, result, is_batch=True)
+            delivered = await handle_generation_results(message, result, is_batch=True)
             
-            failed_count = len(prompts) - successful_count
-            if failed_count > 0:
-                await add_balance(user_id, failed_count, 0)
+            failed_count = await commit_hold(hold_id, used=min(successful_count, delivered))
+            if failed_count:
                 await message.answer(
                     f"📊 <b>Возвращено на баланс:</b> {failed_count} изображений\n"
-                    f"<i>За неудавшиеся генерации</i>",
+                    f"<i>За неудавшиеся генерации и неотправленные фото</i>",
                     parse_mode="HTML"
                 )
         else:
@@ -1791,8 +3851,16 @@ async def cmd_batch_text(message: types.Message):
                 parse_mode="HTML",
                 reply_markup=get_main_keyboard(message.from_user.id)
             )
-            await add_balance(user_id, len(prompts), 0)
+            await release_hold(hold_id)
 
+    except QueueFullError:
+        await message.answer(
+            "⏳ Очередь переполнена. Попробуйте через минуту.\n\n"
+            "<i>Все изображения возвращены на баланс</i>",
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(message.from_user.id)
+        )
+        await release_hold(hold_id)
     except Exception as e:
         logger.error(f"Ошибка обработки: {e}")
         await message.answer(
@@ -1801,11 +3869,7 @@ async def cmd_batch_text(message: types.Message):
             parse_mode="HTML",
             reply_markup=get_main_keyboard(message.from_user.id)
         )
-        await add_balance(user_id, len(prompts), 0)
-    finally:
-        async with queue_lock:
-            if message.from_user.id in request_queue:
-                request_queue.remove(message.from_user.id)
+        await release_hold(hold_id)
 
 # ========== АДМИН ПАНЕЛЬ ==========
 @dp.message(Command("admin"))
@@ -1816,51 +3880,23 @@ async def cmd_admin(message: types.Message):
         await message.answer("⛔ Доступ запрещен", reply_markup=get_main_keyboard(message.from_user.id))
         return
     
-    # Получаем статистику из БД
-    conn_cache = sqlite3.connect('bot_cache.db')
-    conn_payments = sqlite3.connect('payments.db')
-    
-    c_cache = conn_cache.cursor()
-    c_payments = conn_payments.cursor()
-    
-    # 1. Статистика пользователей
-    c_payments.execute("SELECT COUNT(DISTINCT user_id) FROM user_balance WHERE images_left > 0")
-    active_users_result = c_payments.fetchone()
-    active_users = active_users_result[0] if active_users_result else 0
-    
-    c_payments.execute("SELECT COUNT(DISTINCT user_id) FROM payments WHERE status = 'completed'")
-    total_users_result = c_payments.fetchone()
-    total_users = total_users_result[0] if total_users_result else 0
-    
-    # 2. Статистика генераций
-    c_cache.execute("SELECT COUNT(*) FROM user_stats")
-    total_requests_result = c_cache.fetchone()
-    total_requests = total_requests_result[0] if total_requests_result else 0
-    
-    c_cache.execute("SELECT SUM(total_images) FROM user_stats")
-    successful_generations_result = c_cache.fetchone()
-    successful_generations = successful_generations_result[0] if successful_generations_result else 0
-    
-    # 3. Статистика по платежам
-    c_payments.execute("SELECT SUM(amount) FROM payments WHERE status = 'completed'")
-    total_income_result = c_payments.fetchone()
-    total_income = total_income_result[0] if total_income_result else 0
-    
-    c_payments.execute("SELECT COUNT(*) FROM payments WHERE status = 'completed'")
-    total_payments_count_result = c_payments.fetchone()
-    total_payments_count = total_payments_count_result[0] if total_payments_count_result else 0
-    
-    # 4. Кэш
-    c_cache.execute("SELECT COUNT(*) FROM image_cache")
-    cache_count_result = c_cache.fetchone()
-    cache_count = cache_count_result[0] if cache_count_result else 0
-    
-    conn_cache.close()
-    conn_payments.close()
+    # Счетчики обновляются вместе с записями, поэтому панель не агрегирует таблицы
+    counters = await read_admin_counters()
+    active_users = int(counters.get("users_with_balance", 0))
+    total_users = int(counters.get("paying_users", 0))
+    total_requests = int(counters.get("stats_users", 0))
+    successful_generations = int(counters.get("generated_images", 0))
+    total_income = counters.get("income", 0)
+    total_payments_count = int(counters.get("completed_payments", 0))
+    cache_count = int(counters.get("cached_images", 0))
     
     # Рассчет успешности
     success_rate = 100.0 if total_requests == 0 else (successful_generations / total_requests * 100)
     
+    store_stats = image_store.stats_snapshot()
+    lookups = store_stats["hits"] + store_stats["misses"]
+    hit_rate = 0.0 if lookups == 0 else store_stats["hits"] / lookups * 100
+    
     # Проверка API ключа
     api_key_status = "✅ есть" if AITUNNEL_API_KEY else "❌ нет"
     yookassa_status = "✅ включена" if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY else "⏸ тестовый режим"
@@ -1887,6 +3923,9 @@ async def cmd_admin(message: types.Message):
         f"• API ключ: {api_key_status}\n"
         f"• Оплата: {yookassa_status}\n"
         f"• Изображений в кэше: {cache_count}\n"
+        f"• Кэш: {store_stats['hits']} попаданий / {store_stats['misses']} промахов ({hit_rate:.1f}%)\n"
+        f"• Вытеснено: {store_stats['evictions']}, не допущено: {store_stats['rejections']}\n"
+        f"• Хранилище: {store_stats['entries']} файлов, {store_stats['bytes'] / 1024 / 1024:.1f} МБ\n"
         f"• Бот работает: ✅ стабильно"
     )
     
@@ -1898,48 +3937,41 @@ async def btn_free_test(message: types.Message):
     user_id = message.from_user.id
     
     # Проверяем, получал ли пользователь уже подарок
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    
-    # Проверяем есть ли запись о бесплатном подарке
-    c.execute("SELECT COUNT(*) FROM payment_history WHERE user_id = ? AND (description LIKE '%бесплатный%' OR description LIKE '%подарок%' OR description LIKE '%тест%')", (user_id,))
-    has_free_gift = c.fetchone()[0] > 0
-    
-    if has_free_gift:
-        conn.close()
-        balance = await check_balance(user_id)
-        await message.answer(
-            "🎁 <b>Вы уже получали бесплатный тест!</b>\n\n"
-            f"💰 <b>Ваш текущий баланс:</b> {balance} изображений\n\n"
-            "💡 <b>Хотите больше изображений?</b>\n"
-            "• 📦 Пакет 5 промптов - 99 руб (выгодно!)\n"
-            "• 🎁 Большой пакет 15 - 199 руб (очень выгодно!)",
-            parse_mode="HTML",
-            reply_markup=get_main_keyboard(user_id)
-        )
-        return
-    
-    # Дарим 1 изображение БЕСПЛАТНО
-    try:
-        # Сначала проверяем есть ли пользователь в базе
-        c.execute("SELECT images_left FROM user_balance WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
+    # (проверка и начисление в одной транзакции, чтобы двойное нажатие не дало два подарка)
+    def grant_free_gift(conn: sqlite3.Connection) -> Optional[int]:
+        c = conn.cursor()
         
-        if result:
-            # Есть запись - добавляем 1
-            c.execute("UPDATE user_balance SET images_left = images_left + 1 WHERE user_id = ?", (user_id,))
-            images_left = result[0] + 1
-        else:
-            # Нет записи - создаем
-            c.execute("INSERT INTO user_balance (user_id, images_left) VALUES (?, ?)", (user_id, 1))
-            images_left = 1
+        # Флаг ставится условным UPDATE: второй вызов не изменит ни одной строки
+        c.execute("INSERT OR IGNORE INTO user_balance (user_id) VALUES (?)", (user_id,))
+        claimed = c.execute("UPDATE user_balance SET free_gift_claimed = 1 WHERE user_id = ? AND free_gift_claimed = 0",
+                            (user_id,)).rowcount
+        if not claimed:
+            return None
+        
+        credit_balance(conn, user_id, 1, 0, kind="gift")
+        images_left = c.execute("SELECT images_left FROM user_balance WHERE user_id = ?", (user_id,)).fetchone()[0]
         
         # Записываем в историю (БЕЗ списания денег!)
-        c.execute("INSERT INTO payment_history (user_id, amount, description, status, created_at) VALUES (?, ?, ?, ?, ?)",
-                  (user_id, 0, "Бесплатный тестовый подарок (кнопка 🎁)", 'completed', datetime.now()))
+        c.execute("INSERT INTO payment_history (user_id, amount, description, status) VALUES (?, ?, ?, ?)",
+                  (user_id, 0, "Бесплатный тестовый подарок (кнопка 🎁)", 'completed'))
+        return images_left
+    
+    # Дарим 1 изображение БЕСПЛАТНО
+    try:
+        images_left = await db.transaction(grant_free_gift)
         
-        conn.commit()
-        conn.close()
+        if images_left is None:
+            balance = await check_balance(user_id)
+            await message.answer(
+                "🎁 <b>Вы уже получали бесплатный тест!</b>\n\n"
+                f"💰 <b>Ваш текущий баланс:</b> {balance} изображений\n\n"
+                "💡 <b>Хотите больше изображений?</b>\n"
+                "• 📦 Пакет 5 промптов - 99 руб (выгодно!)\n"
+                "• 🎁 Большой пакет 15 - 199 руб (очень выгодно!)",
+                parse_mode="HTML",
+                reply_markup=get_main_keyboard(user_id)
+            )
+            return
         
         await message.answer(
             "🎁 <b>БЕСПЛАТНЫЙ ТЕСТОВЫЙ ПОДАРОК!</b>\n\n"
@@ -1959,7 +3991,6 @@ async def btn_free_test(message: types.Message):
         
     except Exception as e:
         logger.error(f"Ошибка при выдаче бесплатного теста: {e}")
-        conn.close()
         await message.answer(
             "❌ <b>Ошибка при выдаче теста</b>\n\n"
             "Попробуйте позже или обратитесь в поддержку.",
@@ -1997,8 +4028,186 @@ async def handle_any_message(message: types.Message, state: FSMContext):
             reply_markup=get_cancel_keyboard()
         )
 
+# ========== ВЕБ-СЕРВЕР ==========
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+# Публичный адрес сервиса; на Railway берется из RAILWAY_PUBLIC_DOMAIN
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL") or (
+    f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}" if os.getenv("RAILWAY_PUBLIC_DOMAIN") else ""
+)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT") or os.getenv("PORT") or "8080")
+# Telegram присылает секрет в заголовке X-Telegram-Bot-Api-Secret-Token;
+# без заданного значения он выводится из токена, чтобы все процессы бота регистрировали один и тот же
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
+def build_web_app(with_webhook: bool, ready: asyncio.Event) -> web.Application:
+    """Создает aiohttp-приложение: webhook Telegram, уведомления ЮKassa, готовность, метрики"""
+    app = web.Application()
+
+    async def readiness(request: web.Request) -> web.Response:
+        # 503, пока бот не начал принимать обновления
+        return web.Response(status=200 if ready.is_set() else 503, text="ok" if ready.is_set() else "starting")
+
+    async def metrics(request: web.Request) -> web.Response:
+        if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""),
+                                                     f"Bearer {METRICS_TOKEN}"):
+            return web.Response(status=401)
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    app.router.add_get("/ready", readiness)
+    if METRICS_ENABLED:
+        app.router.add_get(METRICS_PATH, metrics)
+    if with_webhook:
+        bot = get_bot()
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=True
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    if YOOKASSA_NOTIFICATIONS:
+        app.router.add_post(YOOKASSA_NOTIFICATION_PATH, handle_yookassa_notification)
+    return app
+
+def web_server_needed(mode: str) -> bool:
+    return mode == "webhook" or YOOKASSA_NOTIFICATIONS or METRICS_ENABLED
+
+async def start_web_server(mode: str, ready: asyncio.Event) -> web.AppRunner:
+    """Поднимает веб-сервер на WEB_HOST:WEB_PORT"""
+    runner = web.AppRunner(build_web_app(with_webhook=mode == "webhook", ready=ready))
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEB_HOST, port=WEB_PORT)
+    try:
+        await site.start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    logger.info(f"🌐 Веб-сервер слушает {WEB_HOST}:{WEB_PORT}")
+    return runner
+
+async def register_webhook():
+    """Регистрирует webhook в Telegram; обновления принимает веб-сервер"""
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для режима webhook задайте WEBHOOK_BASE_URL")
+
+    await get_bot().set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info("✅ Webhook зарегистрирован в Telegram")
+
 # ========== ЗАПУСК БОТА ==========
-async def main():
+first_update_seen = False
+
+async def first_update_timer(handler, event, data):
+    """Пишет в лог, через сколько после старта процесса пришло первое обновление"""
+    global first_update_seen
+    if not first_update_seen:
+        first_update_seen = True
+        logger.info(f"⏱ Первое обновление через {time.perf_counter() - IMPORT_STARTED:.2f} с после начала импорта")
+    return await handler(event, data)
+
+dp.update.outer_middleware(first_update_timer)
+
+class BotApplication:
+    """Жизненный цикл бота: БД, HTTP-клиенты и фоновые задачи создаются при запуске, а не при импорте.
+
+    ready выставляется, когда бот начинает принимать обновления; время импорта
+    и каждой фазы запуска пишется в лог.
+    """
+
+    def __init__(self, mode: str):
+        if mode not in ("polling", "webhook"):
+            raise ValueError(f"Неизвестный режим запуска: {mode}")
+        self.mode = mode
+        self.ready = asyncio.Event()
+        self.phases: List[Tuple[str, float]] = []
+        self.background_tasks: List[asyncio.Task] = []
+        self.web_runner: Optional[web.AppRunner] = None
+        self.bot: Optional[Bot] = None
+
+    async def _phase(self, name: str, awaitable: Awaitable[Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    async def start(self):
+        self.bot = get_bot()
+        # Схема БД и прогрев соединения с AI Tunnel не зависят друг от друга
+        await asyncio.gather(
+            self._phase("база данных", asyncio.to_thread(init_db)),
+            self._phase("AI Tunnel", start_http_session())
+        )
+        job_scheduler.start()
+        self.background_tasks = [
+            asyncio.create_task(pending_upload_sweeper()),
+            asyncio.create_task(payment_reconciler()),
+            # Платежи догружаются в фоне, бот уже принимает обновления
+            asyncio.create_task(payment_sync_loop()),
+            asyncio.create_task(user_stats_buffer.run())
+        ]
+        if web_server_needed(self.mode):
+            try:
+                self.web_runner = await self._phase("веб-сервер", start_web_server(self.mode, self.ready))
+            except OSError as e:
+                if self.mode == "webhook":
+                    raise
+                # В режиме polling сервер вспомогательный (метрики, уведомления ЮKassa):
+                # занятый порт не должен мешать боту работать, платежи догонит сверка
+                logger.warning(f"⚠️ Веб-сервер не запущен ({WEB_HOST}:{WEB_PORT}): {e}")
+
+    def mark_ready(self):
+        self.ready.set()
+        phases = ", ".join(f"{name} {seconds:.2f} с" for name, seconds in self.phases)
+        logger.info(
+            f"⏱ Импорт: библиотеки {LIBRARIES_IMPORTED - IMPORT_STARTED:.2f} с, "
+            f"модуль {MODULE_IMPORTED - LIBRARIES_IMPORTED:.2f} с; запуск: {phases}; "
+            f"готов через {time.perf_counter() - IMPORT_STARTED:.2f} с"
+        )
+
+    async def run(self):
+        try:
+            await self.start()
+            if self.mode == "webhook":
+                await self._phase("регистрация webhook", register_webhook())
+                self.mark_ready()
+                await asyncio.Event().wait()
+            else:
+                # getUpdates не работает, пока у бота установлен webhook
+                await self._phase("сброс webhook", self.bot.delete_webhook())
+                self.mark_ready()
+                await dp.start_polling(self.bot)
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self.web_runner is not None:
+            await self.web_runner.cleanup()
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        await job_scheduler.stop()
+        # Накопленная статистика пишется до закрытия БД
+        await user_stats_buffer.flush()
+        shutdown_image_process_pool()
+        await close_http_session()
+        await yookassa_client.close()
+        if self.bot is not None:
+            # Polling и webhook закрывают сессию сами, но не при ошибке запуска
+            await self.bot.session.close()
+        db.close()
+        state_db.close()
+
+def create_app(mode: Optional[str] = None) -> BotApplication:
+    """Фабрика приложения: ничего не открывает до вызова run()"""
+    return BotApplication(mode or BOT_MODE)
+
+async def main(mode: Optional[str] = None):
     logger.info("=" * 50)
     logger.info("🚀 PIXELMAGE PRO 2.0 ЗАПУЩЕН")
     logger.info("=" * 50)
@@ -2015,9 +4224,12 @@ async def main():
         logger.info("💰 СИСТЕМА ОПЛАТЫ: ТЕСТОВЫЙ РЕЖИМ")
         logger.info("⚠️ Для реальной оплаты добавьте переменные YOOKASSA_SHOP_ID и YOOKASSA_SECRET_KEY")
     
+    app = create_app(mode)
+    logger.info(f"📡 Режим получения обновлений: {app.mode}")
     logger.info("=" * 50)
+    await app.run()
 
-    await dp.start_polling(bot)
+MODULE_IMPORTED = time.perf_counter()
 
 if __name__ == "__main__":
     print("=" * 50)
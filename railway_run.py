@@ -14,9 +14,12 @@ print("=" * 50)
 # Проверяем переменные
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 AITUNNEL_API_KEY = os.getenv("AITUNNEL_API_KEY")
+# Режим запуска: python railway_run.py [polling|webhook] или переменная BOT_MODE
+BOT_MODE = sys.argv[1] if len(sys.argv) > 1 else os.getenv("BOT_MODE", "polling")
 
 print(f"✓ BOT_TOKEN: {'***УСТАНОВЛЕН***' if BOT_TOKEN else '❌ НЕ НАЙДЕН'}")
 print(f"✓ AITUNNEL_API_KEY: {'***УСТАНОВЛЕН***' if AITUNNEL_API_KEY else '❌ НЕ НАЙДЕН'}")
+print(f"✓ Режим: {BOT_MODE}")
 
 if not BOT_TOKEN or not AITUNNEL_API_KEY:
     print("❌ ОШИБКА: Отсутствуют необходимые переменные!")
@@ -35,7 +38,7 @@ try:
     print("📱 Отправьте /start в Telegram")
     print("=" * 50)
     
-    asyncio.run(bot_main())
+    asyncio.run(bot_main(BOT_MODE))
     
 except ImportError as e:
     print(f"❌ Ошибка импорта: {e}")
@@ -0,0 +1,127 @@
+"""Задержка запросов к AI Tunnel: новая сессия на каждый запрос (как было) против общего пула.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/bench_aitunnel_latency.py
+    ... --requests 50 --rtt 0.05 --delay 0.2 --no-tls
+
+Поднимает поддельный AI Tunnel (scripts/fake_aitunnel.py) с TLS на самоподписанном
+сертификате и прокси (scripts/latency_proxy.py), добавляющий сетевую задержку (--rtt) к установке соединения
+и к каждому пакету данных, - так локальный замер видит цену DNS/TCP/TLS. Сравниваются:
+    до     - aiohttp.ClientSession на каждый запрос, как в generate_images_api до пула;
+    после  - общая сессия бота (start_http_session с прогревом, get_http_session).
+Режимы: последовательные запросы и пакеты по GENERATION_CONCURRENCY одновременных.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_aitunnel_")
+CERT = os.path.join(WORKDIR, "cert.pem")
+KEY = os.path.join(WORKDIR, "key.pem")
+
+def make_certificate() -> bool:
+    """Самоподписанный сертификат для 127.0.0.1; False, если нет openssl"""
+    if not shutil.which("openssl"):
+        return False
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-keyout", KEY, "-out", CERT, "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+                   check=True, capture_output=True)
+    # aiohttp создает проверяющий SSL-контекст при импорте, поэтому сертификат задается до импорта
+    os.environ["SSL_CERT_FILE"] = CERT
+    return True
+
+TLS = "--no-tls" not in sys.argv and make_certificate()
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTS))
+sys.path.insert(0, SCRIPTS)
+
+import asyncio  # noqa: E402
+import logging  # noqa: E402
+import ssl  # noqa: E402
+
+import aiohttp  # noqa: E402
+
+import pixelmage_pro as pm  # noqa: E402
+from fake_aitunnel import FakeAITunnel  # noqa: E402
+from latency_proxy import LatencyProxy  # noqa: E402
+
+def summary(name: str, samples: list, connections: int) -> str:
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return (f"{name:<28} среднее {statistics.mean(samples) * 1000:7.1f} мс, p50 {statistics.median(samples) * 1000:7.1f}, "
+            f"p95 {p95 * 1000:7.1f}, первый {samples[0] * 1000:7.1f}; соединений: {connections}")
+
+async def post(session: aiohttp.ClientSession, url: str, prompt: str) -> float:
+    started = time.perf_counter()
+    async with session.post(url, json={**pm.GENERATION_PARAMS, "prompt": prompt}) as response:
+        await response.read()
+        response.raise_for_status()
+    return time.perf_counter() - started
+
+async def fresh_session_post(url: str, prompt: str) -> float:
+    # Как было: сессия и соединение на каждый промпт
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(timeout=pm.AITUNNEL_TIMEOUT,
+                                     headers={"Authorization": f"Bearer {pm.AITUNNEL_API_KEY}"}) as session:
+        await post(session, url, prompt)
+    return time.perf_counter() - started
+
+async def run_mode(fake: FakeAITunnel, name: str, request, args) -> list:
+    lines = []
+    before = fake.connections
+    sequential = [await request(f"промпт {n}") for n in range(args.requests)]
+    lines.append(summary(f"{name}: последовательно", sequential, fake.connections - before))
+
+    before = fake.connections
+    batches = []
+    for round_index in range(max(1, args.requests // pm.GENERATION_CONCURRENCY)):
+        started = time.perf_counter()
+        await asyncio.gather(*(request(f"пакет {round_index}-{n}") for n in range(pm.GENERATION_CONCURRENCY)))
+        batches.append(time.perf_counter() - started)
+    lines.append(summary(f"{name}: пакет x{pm.GENERATION_CONCURRENCY}", batches, fake.connections - before))
+    return lines
+
+async def main(args):
+    fake = FakeAITunnel(delay=args.delay)
+    server_ssl = None
+    if TLS:
+        server_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_ssl.load_cert_chain(CERT, KEY)
+    fake_url = await fake.start(ssl_context=server_ssl)
+    proxy = LatencyProxy(int(fake_url.rsplit(":", 1)[1]), args.rtt)
+    proxy_port = await proxy.start()
+    pm.AITUNNEL_BASE_URL = f"{'https' if TLS else 'http'}://127.0.0.1:{proxy_port}"
+    url = f"{pm.AITUNNEL_BASE_URL}/v1/images/generations"
+    print(f"Поддельный AI Tunnel: {'TLS' if TLS else 'без TLS'}, RTT {args.rtt * 1000:.0f} мс, "
+          f"обработка {args.delay * 1000:.0f} мс, ответ {len(fake.response_body) // 1024} КБ")
+
+    lines = await run_mode(fake, "до (сессия на запрос)", lambda prompt: fresh_session_post(url, prompt), args)
+
+    started = time.perf_counter()
+    await pm.start_http_session()
+    lines.append(f"прогрев общей сессии при старте: {(time.perf_counter() - started) * 1000:.1f} мс")
+    lines += await run_mode(fake, "после (общий пул)", lambda prompt: post(pm.get_http_session(), url, prompt), args)
+    await pm.close_http_session()
+
+    await proxy.stop()
+    await fake.stop()
+    print("\n".join(lines))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--rtt", type=float, default=0.03, help="сетевая задержка туда-обратно, с")
+    parser.add_argument("--delay", type=float, default=0.0, help="время обработки запроса сервером, с")
+    parser.add_argument("--no-tls", action="store_true", help="без TLS (нет openssl)")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    asyncio.run(main(args))
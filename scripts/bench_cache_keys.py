@@ -0,0 +1,103 @@
+"""Доля попаданий в кэш на повторе потока промптов: старый ключ md5(промпт) против build_cache_key.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/bench_cache_keys.py
+    ... --corpus prompts.txt          свой поток промптов, по одному в строке (например, из логов)
+    ... --requests 5000 --seed 7
+
+Без --corpus поток синтетический: популярные промпты выбираются по закону Ципфа
+и набираются так, как их набирают люди, - с заглавной буквы, с двойными и
+неразрывными пробелами, пробелом в конце, полноширинными символами. Кэш пустой
+в начале; промпт попадает, если такой ключ уже встречался.
+На второй половине потока меняется размер генерации: старый ключ продолжает
+отдавать картинки старого размера (устаревшие попадания), build_cache_key - нет.
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_cache_keys_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pixelmage_pro as pm  # noqa: E402
+
+PROMPTS = [
+    "кот в космосе", "собака на пляже", "закат над морем", "киберпанк город ночью",
+    "портрет девушки в стиле аниме", "дракон над замком", "лес в тумане", "робот читает книгу",
+    "горы и озеро на рассвете", "кофе и круассан на столе", "космонавт на луне", "лиса в снегу",
+    "старый маяк в шторм", "неоновая вывеска под дождем", "чайный домик в японском саду",
+    "a cat astronaut floating in space", "cyberpunk street at night", "watercolor mountains",
+    "логотип для кофейни", "милый енот в очках", "подводный город", "осенний парк",
+    "пиксель-арт рыцарь", "натюрморт с фруктами", "северное сияние над тундрой",
+    "ретро автомобиль 60-х", "панда ест бамбук", "волшебник с посохом", "уютная комната с камином",
+    "футуристический поезд", "котенок в корзинке", "замок из облаков",
+]
+
+def typed_variant(prompt: str, rng: random.Random) -> str:
+    """Тот же промпт, как его мог бы набрать пользователь"""
+    variant = prompt
+    if rng.random() < 0.3:
+        variant = variant[:1].upper() + variant[1:]
+    if rng.random() < 0.15:
+        variant = variant.replace(" ", "  ", 1)
+    if rng.random() < 0.15:
+        variant = variant + " "
+    if rng.random() < 0.08:
+        variant = variant.replace(" ", "\u00a0", 1)
+    if rng.random() < 0.05:
+        # Полноширинные цифры и латиница с японской раскладки
+        variant = variant.translate({code: code + 0xFEE0 for code in range(0x21, 0x7F)})
+    if rng.random() < 0.03:
+        variant = variant.upper()
+    return variant
+
+def synthetic_corpus(requests: int, rng: random.Random) -> list:
+    weights = [1 / rank for rank in range(1, len(PROMPTS) + 1)]
+    return [typed_variant(prompt, rng) for prompt in rng.choices(PROMPTS, weights, k=requests)]
+
+def old_key(prompt: str, params: dict) -> str:
+    # Ключ до build_cache_key: только текст промпта
+    return hashlib.md5(prompt.encode()).hexdigest()
+
+def replay(corpus: list, key) -> tuple:
+    """(попаданий, устаревших попаданий): устаревшее - картинка с другими параметрами генерации"""
+    changed_params = {**pm.GENERATION_PARAMS, "width": 1536, "height": 1536}
+    cache = {}
+    hits = stale = 0
+    for position, prompt in enumerate(corpus):
+        params = pm.GENERATION_PARAMS if position < len(corpus) // 2 else changed_params
+        cached = cache.get(key(prompt, params))
+        if cached is None:
+            cache[key(prompt, params)] = params
+            continue
+        hits += 1
+        stale += cached != params
+    return hits, stale
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="файл с промптами, по одному в строке")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        corpus = synthetic_corpus(args.requests, random.Random(args.seed))
+
+    print(f"промптов: {len(corpus)}, различных строк: {len(set(corpus))}, "
+          f"различных после нормализации: {len({pm.normalize_prompt(prompt) for prompt in corpus})}")
+    for name, key in (("md5(промпт)", old_key), ("build_cache_key", pm.build_cache_key)):
+        hits, stale = replay(corpus, key)
+        print(f"{name:<16} попаданий {hits / len(corpus):6.1%}, из них устаревших {stale}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Отправка результатов в Telegram: исходный PNG от API против JPEG из prepare_delivery_photo.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/bench_delivery_encode.py
+    ... --sends 10 --uplink-mbit 20 --rtt 0.05
+    ... result1.png result2.png               свои результаты вместо синтетического
+
+Фото уходят через aiogram в поддельный Bot API (sendPhoto) за прокси с ограниченной
+полосой выгрузки (scripts/latency_proxy.py):
+    до     - FSInputFile с PNG, как handle_generation_results отправлял раньше;
+    после  - prepare_delivery_photo (JPEG DELIVERY_JPEG_QUALITY в пуле процессов), время
+             перекодирования входит в задержку.
+Синтетический результат - PNG 1024x1024 из scripts/fake_aitunnel.py.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import FSInputFile
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_delivery_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTS))
+sys.path.insert(0, SCRIPTS)
+
+import pixelmage_pro as pm  # noqa: E402
+from fake_aitunnel import sample_png  # noqa: E402
+from latency_proxy import LatencyProxy  # noqa: E402
+
+class FakeSendPhoto:
+    """Bot API, который принимает sendPhoto и запоминает размер каждого фото"""
+
+    def __init__(self):
+        self.photo_sizes = []
+        self.runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        async for part in await request.multipart():
+            data = await part.read()
+            if part.filename:
+                self.photo_sizes.append(len(data))
+        return web.json_response({"ok": True, "result": {
+            "message_id": len(self.photo_sizes), "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "photo": [{"file_id": "file", "file_unique_id": "unique", "width": 1024, "height": 1024}]
+        }})
+
+    async def start(self) -> int:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/sendPhoto", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+def summary(name: str, samples: list) -> str:
+    return f"{name:<7} среднее {statistics.mean(samples) * 1000:7.1f} мс, максимум {max(samples) * 1000:7.1f} мс"
+
+async def main(args):
+    paths = args.paths
+    if not paths:
+        paths = [os.path.join(WORKDIR, "result.png")]
+        with open(paths[0], "wb") as f:
+            f.write(sample_png())
+
+    fake = FakeSendPhoto()
+    proxy = LatencyProxy(await fake.start(), args.rtt, args.uplink_mbit * 1_000_000 / 8)
+    api = TelegramAPIServer.from_base(f"http://127.0.0.1:{await proxy.start()}")
+    bot = Bot(token=pm.BOT_TOKEN, session=AiohttpSession(api=api))
+
+    # Пул процессов и соединение с Bot API открываются до замера, как в работающем боте
+    await pm.prepare_delivery_photo(paths[0])
+    await bot.send_photo(1, FSInputFile(paths[0]))
+    fake.photo_sizes.clear()
+    print(f"отправок: {args.sends}, выгрузка {args.uplink_mbit} Мбит/с, RTT {args.rtt * 1000:.0f} мс, "
+          f"JPEG quality {pm.DELIVERY_JPEG_QUALITY}")
+
+    sends = [paths[n % len(paths)] for n in range(args.sends)]
+    before = []
+    for path in sends:
+        started = time.perf_counter()
+        await bot.send_photo(1, FSInputFile(path))
+        before.append(time.perf_counter() - started)
+    before_bytes = sum(fake.photo_sizes)
+    fake.photo_sizes.clear()
+
+    after, encode = [], []
+    for path in sends:
+        started = time.perf_counter()
+        photo, delivery_bytes = await pm.prepare_delivery_photo(path)
+        encode.append(time.perf_counter() - started)
+        if delivery_bytes is None:
+            sys.exit(f"❌ Не удалось перекодировать {path}")
+        await bot.send_photo(1, photo)
+        after.append(time.perf_counter() - started)
+    after_bytes = sum(fake.photo_sizes)
+
+    await bot.session.close()
+    pm.shutdown_image_process_pool()
+    await proxy.stop()
+    await fake.stop()
+
+    print(f"выгрузка: {before_bytes / len(sends) / 1024:.0f} КБ → {after_bytes / len(sends) / 1024:.0f} КБ на фото "
+          f"(x{before_bytes / after_bytes:.1f})")
+    print(f"перекодирование в пуле процессов: среднее {statistics.mean(encode) * 1000:.1f} мс")
+    print(summary("до", before))
+    print(summary("после", after))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="свои результаты генерации (PNG)")
+    parser.add_argument("--sends", type=int, default=10)
+    parser.add_argument("--uplink-mbit", type=float, default=20.0, help="полоса выгрузки до Telegram, Мбит/с")
+    parser.add_argument("--rtt", type=float, default=0.05, help="сетевая задержка туда-обратно, с")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    asyncio.run(main(args))
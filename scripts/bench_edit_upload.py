@@ -0,0 +1,122 @@
+"""Подготовка фото для редактирования: объем выгрузки и задержка запроса к API до и после.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/bench_edit_upload.py
+    ... --photos 5 --uplink-mbit 20 --rtt 0.05 --delay 0.5
+    ... photo1.jpg photo2.jpg                 свои фото вместо синтетических
+
+Синтетические фото похожи на снимки с телефона: 4032x3024 JPEG с шумом сенсора,
+EXIF-ориентацией (повернуто на 90°) и метаданными камеры. Каждое фото отправляется
+в поддельный AI Tunnel (scripts/fake_aitunnel.py) через прокси с ограниченной полосой
+выгрузки (scripts/latency_proxy.py):
+    до     - байты из Telegram как есть, как edit_image_api отправлял их раньше;
+    после  - prepare_edit_upload (поворот по EXIF, 1024x1024, без метаданных) в пуле процессов.
+Задержка «после» включает время подготовки.
+"""
+import argparse
+import asyncio
+import io
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_edit_upload_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTS))
+sys.path.insert(0, SCRIPTS)
+
+from PIL import Image  # noqa: E402
+
+import pixelmage_pro as pm  # noqa: E402
+from fake_aitunnel import FakeAITunnel  # noqa: E402
+from latency_proxy import LatencyProxy  # noqa: E402
+
+def phone_photo(seed: int, width: int = 4032, height: int = 3024) -> bytes:
+    """JPEG как с камеры телефона: шум сенсора на плавном фоне, EXIF с ориентацией и камерой"""
+    noise = Image.effect_noise((width // 2, height // 2), 12 + seed).resize((width, height))
+    horizontal = Image.linear_gradient("L").rotate(90).resize((width, height))
+    vertical = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (Image.blend(horizontal, noise, 0.35), Image.blend(vertical, noise, 0.35), noise))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: повернуть на 90° по часовой
+    exif[0x010F] = "Phone"  # Make
+    exif[0x0110] = f"Camera {seed}"  # Model
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=93, exif=exif)
+    return output.getvalue()
+
+def summary(name: str, samples: list) -> str:
+    return f"{name:<7} среднее {statistics.mean(samples) * 1000:7.1f} мс, максимум {max(samples) * 1000:7.1f} мс"
+
+async def edit(photo: bytes) -> float:
+    started = time.perf_counter()
+    result = await pm.edit_image_api(photo, "сделай небо закатным")
+    if not result["success"]:
+        raise RuntimeError(result["message"])
+    return time.perf_counter() - started
+
+async def main(args):
+    photos = []
+    for path in args.paths:
+        with open(path, "rb") as f:
+            photos.append(f.read())
+    photos = photos or [phone_photo(seed) for seed in range(args.photos)]
+
+    fake = FakeAITunnel(delay=args.delay)
+    fake_url = await fake.start()
+    proxy = LatencyProxy(int(fake_url.rsplit(":", 1)[1]), args.rtt, args.uplink_mbit * 1_000_000 / 8)
+    pm.AITUNNEL_BASE_URL = f"http://127.0.0.1:{await proxy.start()}"
+    await pm.start_http_session()
+
+    # Пул процессов запускается до замера, как после первого редактирования в работающем боте
+    await pm.prepare_edit_upload(photos[0])
+    print(f"фото: {len(photos)}, выгрузка {args.uplink_mbit} Мбит/с, RTT {args.rtt * 1000:.0f} мс, "
+          f"обработка API {args.delay * 1000:.0f} мс")
+
+    before = [await edit(photo) for photo in photos]
+    before_uploads = list(fake.uploads)
+    fake.uploads.clear()
+
+    after, prepare = [], []
+    for photo in photos:
+        started = time.perf_counter()
+        prepared = await pm.prepare_edit_upload(photo)
+        prepare.append(time.perf_counter() - started)
+        after.append(prepare[-1] + await edit(prepared))
+        with Image.open(io.BytesIO(prepared)) as image:
+            oriented = image.height > image.width and max(image.size) <= pm.EDIT_TARGET_SIZE
+            stripped = not image.getexif()
+        if not (oriented or args.paths) or not stripped:
+            sys.exit("❌ Подготовленное фото не повернуто по EXIF или сохранило метаданные")
+    after_uploads = list(fake.uploads)
+
+    await pm.close_http_session()
+    pm.shutdown_image_process_pool()
+    await proxy.stop()
+    await fake.stop()
+
+    before_bytes = sum(upload["bytes"] for upload in before_uploads)
+    after_bytes = sum(upload["bytes"] for upload in after_uploads)
+    print(f"выгрузка: {before_bytes / len(photos) / 1024:.0f} КБ → {after_bytes / len(photos) / 1024:.0f} КБ на фото "
+          f"(x{before_bytes / after_bytes:.1f}); тип: {before_uploads[0]['content_type']} → "
+          f"{after_uploads[0]['content_type']}")
+    print(f"подготовка в пуле процессов: среднее {statistics.mean(prepare) * 1000:.1f} мс")
+    print(summary("до", before))
+    print(summary("после", after))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="свои фото (JPEG/PNG)")
+    parser.add_argument("--photos", type=int, default=5, help="сколько синтетических фото")
+    parser.add_argument("--uplink-mbit", type=float, default=20.0, help="полоса выгрузки до API, Мбит/с")
+    parser.add_argument("--rtt", type=float, default=0.05, help="сетевая задержка туда-обратно, с")
+    parser.add_argument("--delay", type=float, default=0.0, help="время обработки запроса API, с")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,106 @@
+"""Замер масштабирования общей очереди задач (STATE_BACKEND=sqlite): 1 процесс против N.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/bench_job_scaling.py [процессов] [задач]
+
+Одно и то же число задач делится между процессами, каждый ставит свои задачи в общую
+очередь SharedJobScheduler. Задача похожа на генерацию: ожидание ответа AI Tunnel
+(--latency) и разбор ответа в процессе (декодирование base64 и sha256 изображения
+размером --image-kb). JOB_WORKERS действует на процесс, поэтому с N процессами
+одновременно выполняется до N * JOB_WORKERS задач, а разбор ответов идет на N ядрах.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def configure(workdir: str, workers: int):
+    os.environ["PAYMENTS_DB_PATH"] = os.path.join(workdir, "payments.db")
+    os.environ["CACHE_DB_PATH"] = os.path.join(workdir, "bot_cache.db")
+    os.environ["STATE_DB_PATH"] = os.path.join(workdir, "bot_state.db")
+    os.environ["IMAGE_STORE_DIR"] = os.path.join(workdir, "image_store")
+    os.environ["STATE_BACKEND"] = "sqlite"
+    os.environ["JOB_WORKERS"] = str(workers)
+    os.environ["MAX_WAITING_JOBS"] = "100000"
+    sys.path.insert(0, ROOT)
+
+async def submit_jobs(pm, jobs: int, first_user: int, latency: float, payload: bytes) -> float:
+    async def job():
+        await asyncio.sleep(latency)
+        image = base64.b64decode(payload)
+        hashlib.sha256(image).hexdigest()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(pm.job_scheduler.run(first_user + n, job) for n in range(jobs)))
+    elapsed = time.perf_counter() - started
+    await pm.job_scheduler.stop()
+    return elapsed
+
+def run_worker(workdir: str, workers: int, jobs: int, first_user: int, latency: float, image_kb: int,
+               barrier, results):
+    configure(workdir, workers)
+    import logging
+    logging.disable(logging.WARNING)
+    import pixelmage_pro as pm
+
+    payload = base64.b64encode(os.urandom(image_kb * 1024))
+    # Старт одновременно: импорт модуля в дочерних процессах занимает разное время
+    barrier.wait()
+    results.put(asyncio.run(submit_jobs(pm, jobs, first_user, latency, payload)))
+    pm.db.close()
+    pm.state_db.close()
+
+def measure(context, workdir: str, processes: int, args) -> float:
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    share = args.jobs // processes
+    workers = [context.Process(target=run_worker,
+                               args=(workdir, args.workers, share, index * share, args.latency, args.image_kb,
+                                     barrier, results))
+               for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            sys.exit(f"Процесс завершился с кодом {worker.exitcode}")
+    elapsed = max(results.get() for _ in workers)
+    return share * processes / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("processes", type=int, nargs="?", default=4)
+    parser.add_argument("jobs", type=int, nargs="?", default=240)
+    parser.add_argument("--workers", type=int, default=3, help="JOB_WORKERS на процесс")
+    parser.add_argument("--latency", type=float, default=0.2, help="ожидание ответа API, с")
+    parser.add_argument("--image-kb", type=int, default=1536, help="размер изображения в ответе, КБ")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pixelmage_scaling_")
+    configure(workdir, args.workers)
+    import logging
+    logging.disable(logging.WARNING)
+    import pixelmage_pro as pm
+    pm.init_db()
+    pm.db.close()
+    pm.state_db.close()
+
+    # spawn: при fork дочерний процесс унаследовал бы соединение и поток БД родителя
+    context = multiprocessing.get_context("spawn")
+    print(f"задач: {args.jobs}, JOB_WORKERS={args.workers}, ответ API {args.latency * 1000:.0f} мс, "
+          f"изображение {args.image_kb} КБ")
+    baseline = None
+    for processes in sorted({1, args.processes}):
+        throughput = measure(context, workdir, processes, args)
+        baseline = baseline or throughput
+        print(f"процессов: {processes}: {throughput:.1f} задач/с (x{throughput / baseline:.2f})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Замер накладных расходов метрик /metrics.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/bench_metrics.py
+
+Базы создаются во временном каталоге. Стоимость инструментирования (observe, таймер,
+@db_helper) меряется без потока БД: переключение потоков шумит сильнее, чем сами метрики.
+Затем она сравнивается с медианным кругом db.fetchone.
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_bench_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pixelmage_pro as pm  # noqa: E402
+
+N = 200_000
+QUERIES = 2_000
+ROUNDS = 7
+
+def per_call_us(fn, n: int = N) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - started) / n * 1e6
+
+def timer_block():
+    with pm.SQLITE_SECONDS.time("bench"):
+        pass
+
+async def noop():
+    return None
+
+labelled_noop = pm.db_helper(noop)
+
+async def coroutine_us(factory, n: int = N) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        await factory()
+    return (time.perf_counter() - started) / n * 1e6
+
+async def fetchone_us(n: int) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        await pm.db.fetchone("SELECT images_left FROM user_balance WHERE user_id = ?", (1,))
+    return (time.perf_counter() - started) / n * 1e6
+
+async def main():
+    pm.init_db()
+    inc = per_call_us(lambda: pm.CACHE_LOOKUPS.inc("miss"))
+    observe = per_call_us(lambda: pm.SQLITE_SECONDS.observe(0.001, "bench"))
+    timer = per_call_us(timer_block)
+    helper = await coroutine_us(labelled_noop) - await coroutine_us(noop)
+
+    await fetchone_us(500)  # прогрев соединения и кэша выражений
+    roundtrip = statistics.median([await fetchone_us(QUERIES) for _ in range(ROUNDS)])
+    overhead = timer + helper
+
+    render_started = time.perf_counter()
+    text = pm.render_metrics()
+    render_ms = (time.perf_counter() - render_started) * 1e3
+
+    print(f"Counter.inc:              {inc:6.2f} мкс")
+    print(f"Histogram.observe:        {observe:6.2f} мкс")
+    print(f"with histogram.time():    {timer:6.2f} мкс")
+    print(f"@db_helper:               {helper:6.2f} мкс")
+    print(f"db.fetchone (медиана):    {roundtrip:6.1f} мкс")
+    print(f"метрики на запрос к БД:   {overhead:6.2f} мкс ({overhead / roundtrip * 100:.1f}% круга)")
+    print(f"render_metrics():         {render_ms:6.2f} мс, {len(text)} байт")
+    pm.db.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,181 @@
+"""Задержка от появления обновления в Telegram до обработчика: long polling против webhook.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/bench_update_latency.py
+    ... --updates 300 --rate 50 --rtt 0.05
+
+Поднимает поддельный Bot API (getMe, getUpdates с долгим опросом, остальные методы
+отвечают ok) и поток синтетических сообщений с пуассоновскими интервалами (--rate в секунду).
+    polling - dp.start_polling(bot) против поддельного Bot API, как BotApplication в режиме polling;
+    webhook - веб-приложение бота (build_web_app) получает те же обновления POST-запросом
+              с секретом X-Telegram-Bot-Api-Secret-Token.
+Сетевая задержка --rtt добавляется к каждому запросу и ответу (по rtt/2 в каждую сторону).
+Замеряется время от создания обновления до внешнего middleware диспетчера; обработчики бота
+не вызываются, чтобы сравнивать только доставку.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_updates_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pixelmage_pro as pm  # noqa: E402
+
+class FakeBotAPI:
+    """Минимальный Bot API: очередь обновлений для getUpdates, ok на все остальное"""
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.pending = []
+        self.new_update = asyncio.Event()
+        self.get_updates_calls = 0
+        self.runner = None
+
+    def push(self, update: dict):
+        self.pending.append(update)
+        self.new_update.set()
+
+    async def get_updates(self, params) -> list:
+        self.get_updates_calls += 1
+        offset = int(params.get("offset") or 0)
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        if not self.pending:
+            self.new_update.clear()
+            try:
+                async with asyncio.timeout(int(params.get("timeout") or 0)):
+                    await self.new_update.wait()
+            except TimeoutError:
+                pass
+        return list(self.pending)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.rtt / 2)
+        method = request.match_info["method"]
+        try:
+            params = await request.post()
+        except ConnectionResetError:
+            # Остановка polling обрывает ожидающий getUpdates
+            raise web.HTTPBadRequest()
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "PixelMage", "username": "pixelmage_test_bot"}
+        elif method == "getUpdates":
+            result = await self.get_updates(params)
+        else:
+            result = True
+        await asyncio.sleep(self.rtt / 2)
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+def make_update(update_id: int) -> dict:
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": int(time.time()), "text": "замер",
+                        "chat": {"id": 1, "type": "private"},
+                        "from": {"id": 1, "is_bot": False, "first_name": "Замер"}}}
+
+created = {}
+arrived = {}
+
+async def probe(handler, event, data):
+    # Обновления замера дальше диспетчера не идут
+    arrived[event.update_id] = time.perf_counter()
+
+async def produce(first_id: int, count: int, rate: float, deliver) -> list:
+    """Создает обновления с пуассоновскими интервалами и ждет, пока все дойдут до диспетчера"""
+    ids = list(range(first_id, first_id + count))
+    deliveries = []
+    for update_id in ids:
+        await asyncio.sleep(random.expovariate(rate))
+        created[update_id] = time.perf_counter()
+        deliveries.append(asyncio.create_task(deliver(make_update(update_id))))
+    await asyncio.gather(*deliveries)
+    while not all(update_id in arrived for update_id in ids):
+        await asyncio.sleep(0.01)
+    return [arrived[update_id] - created[update_id] for update_id in ids]
+
+def summary(name: str, samples: list) -> str:
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return (f"{name:<8} среднее {statistics.mean(samples) * 1000:6.1f} мс, p50 {statistics.median(samples) * 1000:6.1f}, "
+            f"p95 {p95 * 1000:6.1f}, максимум {ordered[-1] * 1000:6.1f}")
+
+async def measure_polling(fake: FakeBotAPI, args) -> list:
+    async def deliver(update: dict):
+        fake.push(update)
+
+    polling = asyncio.create_task(pm.dp.start_polling(pm.bot, handle_signals=False, close_bot_session=False))
+    samples = await produce(1, args.updates, args.rate, deliver)
+    await pm.dp.stop_polling()
+    await polling
+    return samples
+
+async def measure_webhook(args) -> list:
+    runner = web.AppRunner(pm.build_web_app(True, asyncio.Event()))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{pm.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": pm.WEBHOOK_SECRET}
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=make_update(0), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as r:
+            rejected = r.status
+
+        async def deliver(update: dict):
+            await asyncio.sleep(args.rtt / 2)
+            async with session.post(url, json=update, headers=headers) as response:
+                response.raise_for_status()
+
+        samples = await produce(args.updates + 1, args.updates, args.rate, deliver)
+    await runner.cleanup()
+    print(f"запрос с неверным секретом: {rejected}")
+    return samples
+
+async def main(args):
+    fake = FakeBotAPI(args.rtt)
+    base_url = await fake.start()
+    pm.bot = Bot(token=pm.BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+    pm.dp.update.outer_middleware(probe)
+    print(f"обновлений: {args.updates}, {args.rate:.0f} в секунду, RTT {args.rtt * 1000:.0f} мс")
+
+    polling = await measure_polling(fake, args)
+    print(f"getUpdates за замер polling: {fake.get_updates_calls}")
+    webhook = await measure_webhook(args)
+    await fake.stop()
+    print(summary("polling", polling))
+    print(summary("webhook", webhook))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20.0, help="обновлений в секунду")
+    parser.add_argument("--rtt", type=float, default=0.05, help="сетевая задержка туда-обратно до Telegram, с")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,105 @@
+"""Проверка клиента ЮKassa, сверки и синхронизации на поддельном API (scripts/fake_yookassa.py).
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/check_yookassa_client.py
+
+Базы создаются во временном каталоге. Проверяется:
+    * повтор POST после 503/429 идет с тем же Idempotence-Key и создает один платеж;
+    * 400 не повторяется и превращается в YooKassaError;
+    * сверка зачисляет оплаченный платеж один раз и отменяет отмененный;
+    * синхронизация проходит все страницы, зачисляет только новое и ставит отметку.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_yookassa_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+os.environ["YOOKASSA_SHOP_ID"] = "fake-shop"
+os.environ["YOOKASSA_SECRET_KEY"] = "fake-secret"
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTS))
+sys.path.insert(0, SCRIPTS)
+
+import pixelmage_pro as pm  # noqa: E402
+from fake_yookassa import FakeYooKassa  # noqa: E402
+
+failures = []
+
+def check(condition: bool, description: str):
+    print(f"{'✅' if condition else '❌'} {description}")
+    if not condition:
+        failures.append(description)
+
+async def balance(user_id: int) -> int:
+    row = await pm.db.fetchone("SELECT images_left FROM user_balance WHERE user_id = ?", (user_id,))
+    return row[0] if row else 0
+
+async def main():
+    pm.init_db()
+    fake = FakeYooKassa()
+    pm.yookassa_client.base_url = await fake.start()
+    # Уведомления в Telegram в проверке не нужны
+    pm.notify_payment_completed = lambda *args, **kwargs: asyncio.sleep(0)
+
+    # 1. Повторы с одним ключом идемпотентности
+    fake.inject_faults(503)
+    fake.inject_faults(429)
+    result = await pm.create_yookassa_payment(101, 99.0, "Пакет 5")
+    posts = [r for r in fake.requests if r["method"] == "POST"]
+    check(result.get("success") and result["payment_id"] in fake.payments, "платеж создан после 503 и 429")
+    check([r["status"] for r in posts] == [503, 429, 200], "было три попытки POST")
+    check(len({r["idempotence_key"] for r in posts}) == 1, "все попытки с одним Idempotence-Key")
+    check(len(fake.payments) == 1, "в ЮKassa создан ровно один платеж")
+
+    # 2. Ошибка запроса не повторяется
+    fake.requests.clear()
+    fake.inject_faults(400)
+    try:
+        await pm.yookassa_client.create_payment({"amount": {"value": "1.00", "currency": "RUB"}}, "bad-request")
+        check(False, "400 превращается в YooKassaError")
+    except pm.YooKassaError:
+        check(len(fake.requests) == 1, "400 не повторяется и превращается в YooKassaError")
+
+    # 3. Сверка: оплаченный зачисляется один раз, отмененный отменяется
+    paid_id = result["payment_id"]
+    fake.set_status(paid_id, "succeeded")
+    local = await pm.db.fetchone("SELECT payment_id, amount FROM payments WHERE yookassa_payment_id = ?", (paid_id,))
+    await asyncio.gather(*(pm.reconcile_payment(local[0], paid_id, 101, local[1]) for _ in range(3)))
+    check(await balance(101) == 5, "сверка зачислила 5 изображений один раз")
+
+    canceled = await pm.create_yookassa_payment(102, 29.0, "1 генерация")
+    fake.set_status(canceled["payment_id"], "canceled")
+    local = await pm.db.fetchone("SELECT payment_id, amount FROM payments WHERE yookassa_payment_id = ?",
+                                 (canceled["payment_id"],))
+    await pm.reconcile_payment(local[0], canceled["payment_id"], 102, local[1])
+    status = await pm.db.fetchone("SELECT status FROM payments WHERE payment_id = ?", (local[0],))
+    check(status[0] == "canceled" and await balance(102) == 0, "отмененный платеж отменен без зачисления")
+
+    # 4. Синхронизация: первый проход переносит историю, следующий зачисляет новое
+    for n in range(250):
+        fake.add_payment(99.0, 1000 + n, status="succeeded")
+    fake.requests.clear()
+    await pm.sync_payments_from_yookassa()
+    pages = [r for r in fake.requests if r["method"] == "GET" and r["path"] == "/v3/payments"]
+    history = await pm.db.fetchone("SELECT COUNT(*) FROM payments WHERE payment_id LIKE 'restored_%' AND status = 'completed'")
+    check(len(pages) >= 3, f"первый проход прошел все страницы ({len(pages)})")
+    check(history[0] == 250 and await balance(1000) == 0, "история перенесена как completed без зачисления")
+
+    fresh = fake.add_payment(199.0, 2000, status="succeeded")
+    await pm.sync_payments_from_yookassa()
+    await pm.sync_payments_from_yookassa()
+    check(await balance(2000) == 15, f"новый платеж {fresh['id']} зачислен один раз")
+
+    await fake.stop()
+    await pm.yookassa_client.close()
+    pm.db.close()
+    if failures:
+        sys.exit(f"Провалено проверок: {len(failures)}")
+    print("Все проверки пройдены")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""Проверка планов запросов: горячие запросы к payments.db используют индексы миграций.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/explain_indexes.py
+    ... --db payments.db       проверить существующую базу (миграции применяются при старте бота)
+
+Без --db создает базы во временном каталоге через init_db. Для каждого запроса
+выполняется EXPLAIN QUERY PLAN и проверяется, что SQLite ищет по ожидаемому индексу
+(SEARCH ... USING INDEX), а не просматривает таблицу целиком (SCAN).
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_explain_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pixelmage_pro as pm  # noqa: E402
+
+# (запрос, параметры, индекс, где используется)
+QUERIES = [
+    ("SELECT payment_id, yookassa_payment_id, amount FROM payments "
+     "WHERE user_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
+     (1,), "idx_payments_user_status", "проверка оплаты пользователем"),
+    ("SELECT 1 FROM payments WHERE user_id = ? AND status = 'completed'",
+     (1,), "idx_payments_user_status", "триггеры счетчиков админ-панели"),
+    ("SELECT payment_id, yookassa_payment_id, user_id, amount, created_at "
+     "FROM payments WHERE status = 'pending' AND yookassa_payment_id IS NOT NULL",
+     (), "idx_payments_status", "payment_reconciler"),
+    ("UPDATE payments SET status = 'completed' WHERE payment_id = ? AND status = 'pending'",
+     ("p",), "idx_payments_payment_id", "зачисление платежа"),
+    ("SELECT payment_id, user_id, amount FROM payments WHERE yookassa_payment_id = ?",
+     ("y",), "ux_payments_yookassa_payment_id", "уведомления и синхронизация ЮKassa"),
+    ("SELECT amount, description, status, created_at FROM payment_history "
+     "WHERE user_id = ? ORDER BY created_at DESC LIMIT 5",
+     (1,), "idx_payment_history_user", "история платежей пользователя"),
+    ("SELECT COALESCE(SUM(delta), 0) FROM balance_ledger WHERE user_id = ?",
+     (1,), "idx_balance_ledger_user", "сверка баланса с журналом"),
+    ("SELECT hold_id FROM balance_holds WHERE created_at < ?",
+     (0,), "idx_balance_holds_created", "release_stale_holds"),
+]
+
+def query_plan(conn: sqlite3.Connection, sql: str, params: tuple) -> list:
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="путь к существующей payments.db")
+    args = parser.parse_args()
+
+    if args.db:
+        path = args.db
+    else:
+        pm.init_db()
+        pm.db.close()
+        path = os.environ["PAYMENTS_DB_PATH"]
+
+    conn = sqlite3.connect(path)
+    failures = 0
+    for sql, params, index, purpose in QUERIES:
+        plan = query_plan(conn, sql, params)
+        used = any(step.startswith("SEARCH") and f"INDEX {index} " in f"{step} " for step in plan)
+        failures += not used
+        print(f"{'✅' if used else '❌'} {purpose}: {index}")
+        if not used:
+            for step in plan:
+                print(f"      {step}")
+    conn.close()
+    if failures:
+        sys.exit(f"Запросов без ожидаемого индекса: {failures}")
+    print("Все запросы используют индексы")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Поддельный AI Tunnel для локальных замеров генерации и редактирования.
+
+Поддерживает то, чем пользуется бот:
+    GET  /v1/models                 прогрев соединения
+    POST /v1/images/generations     JSON-запрос, ответ {"data": [{"b64_json": ...}]}
+    POST /v1/images/edits           multipart с полем image, ответ в том же формате
+
+Задержка ответа (delay) имитирует время генерации. Сервер считает TCP-соединения
+и запоминает размер и тип каждой загруженной картинки, чтобы замеры могли проверить
+переиспользование соединений и объем выгрузки.
+
+Самостоятельный запуск:
+    python scripts/fake_aitunnel.py --port 8766 --delay 0.5
+    AITUNNEL_BASE_URL=http://127.0.0.1:8766 python railway_run.py
+"""
+import argparse
+import asyncio
+import base64
+import io
+import ssl
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from PIL import Image
+
+def sample_png(size: int = 1024) -> bytes:
+    """PNG с шумом и градиентом: сжимается примерно как настоящий результат генерации"""
+    noise = Image.effect_noise((size, size), 24)
+    gradient = Image.linear_gradient("L").resize((size, size))
+    image = Image.merge("RGB", (noise, gradient, gradient.transpose(Image.Transpose.ROTATE_90)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+class FakeAITunnel:
+    def __init__(self, delay: float = 0.0, image: Optional[bytes] = None):
+        self.delay = delay
+        self.image = image or sample_png()
+        self.response_body = ('{"created": 0, "data": [{"b64_json": "%s"}]}'
+                              % base64.b64encode(self.image).decode()).encode()
+        self.peers = set()  # (адрес, порт) клиента - одно TCP-соединение
+        self.uploads: List[Dict[str, Any]] = []
+        self.requests = 0
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    @property
+    def connections(self) -> int:
+        return len(self.peers)
+
+    def _count_connection(self, request: web.Request):
+        self.requests += 1
+        if request.transport is not None:
+            self.peers.add(request.transport.get_extra_info("peername"))
+
+    async def models(self, request: web.Request) -> web.Response:
+        self._count_connection(request)
+        return web.json_response({"object": "list", "data": [{"id": "flux.2-pro"}]})
+
+    async def generations(self, request: web.Request) -> web.Response:
+        self._count_connection(request)
+        await request.read()
+        await asyncio.sleep(self.delay)
+        return web.Response(body=self.response_body, content_type="application/json")
+
+    async def edits(self, request: web.Request) -> web.Response:
+        self._count_connection(request)
+        upload = {"bytes": 0, "content_type": None, "prompt": None}
+        async for part in await request.multipart():
+            if part.name == "image":
+                upload["content_type"] = part.headers.get("Content-Type")
+                upload["bytes"] = len(await part.read())
+            elif part.name == "prompt":
+                upload["prompt"] = await part.text()
+            else:
+                await part.read()
+        self.uploads.append(upload)
+        await asyncio.sleep(self.delay)
+        return web.Response(body=self.response_body, content_type="application/json")
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_post("/v1/images/generations", self.generations)
+        app.router.add_post("/v1/images/edits", self.edits)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0,
+                    ssl_context: Optional[ssl.SSLContext] = None) -> str:
+        """Запускает сервер и возвращает базовый адрес (для AITUNNEL_BASE_URL)"""
+        self.runner = web.AppRunner(self.build_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port, ssl_context=ssl_context)
+        await site.start()
+        actual_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"{'https' if ssl_context else 'http'}://{host}:{actual_port}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+async def serve(host: str, port: int, delay: float):
+    fake = FakeAITunnel(delay=delay)
+    url = await fake.start(host, port)
+    print(f"Поддельный AI Tunnel: {url} (ответ {len(fake.image) // 1024} КБ, задержка {delay} с)")
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.delay))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,193 @@
+"""Поддельный API ЮKassa v3 для локальной проверки клиента, сверки и уведомлений.
+
+Поддерживает то, чем пользуется бот:
+    POST /v3/payments            создание платежа (Idempotence-Key обязателен)
+    GET  /v3/payments/{id}       платеж по id
+    GET  /v3/payments            список с limit, cursor и created_at.gte
+
+Для сценариев есть управляющие методы:
+    POST /_control/payments/{id}/{succeeded|canceled}   сменить статус платежа
+    POST /_control/faults        {"status": 503, "count": 2} - ответить ошибкой N раз
+    GET  /_control/requests      журнал запросов (метод, путь, Idempotence-Key, ответ)
+
+Самостоятельный запуск:
+    python scripts/fake_yookassa.py --port 8765
+    YOOKASSA_API_URL=http://127.0.0.1:8765/v3 YOOKASSA_SHOP_ID=1 YOOKASSA_SECRET_KEY=x python railway_run.py
+"""
+import argparse
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+
+class FakeYooKassa:
+    def __init__(self):
+        self.payments: Dict[str, Dict[str, Any]] = {}
+        self.order: List[str] = []  # id в порядке создания
+        self.by_idempotence_key: Dict[str, str] = {}
+        self.requests: List[Dict[str, Any]] = []
+        self.faults: List[int] = []
+        self._clock = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    # ----- данные -----
+    def _next_created_at(self) -> str:
+        self._clock += timedelta(seconds=1)
+        return self._clock.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    def add_payment(self, amount: float, user_id: int, status: str = "pending",
+                    created_at: Optional[str] = None) -> Dict[str, Any]:
+        """Платеж, созданный «в обход» бота (например, для проверки синхронизации)"""
+        payment_id = f"fake-{uuid.uuid4().hex[:12]}"
+        payment = {
+            "id": payment_id,
+            "status": status,
+            "paid": status == "succeeded",
+            "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
+            "created_at": created_at or self._next_created_at(),
+            "metadata": {"user_id": str(user_id)},
+            "confirmation": {"type": "redirect",
+                             "confirmation_url": f"https://yoomoney.example/checkout/{payment_id}"},
+        }
+        self.payments[payment_id] = payment
+        self.order.append(payment_id)
+        return payment
+
+    def set_status(self, payment_id: str, status: str):
+        self.payments[payment_id]["status"] = status
+        self.payments[payment_id]["paid"] = status == "succeeded"
+
+    def inject_faults(self, status: int, count: int = 1):
+        self.faults.extend([status] * count)
+
+    # ----- HTTP -----
+    def _log(self, request: web.Request, status: int):
+        self.requests.append({
+            "method": request.method,
+            "path": request.path,
+            "idempotence_key": request.headers.get("Idempotence-Key"),
+            "status": status,
+        })
+
+    def _fault(self, request: web.Request) -> Optional[web.Response]:
+        if not self.faults:
+            return None
+        status = self.faults.pop(0)
+        self._log(request, status)
+        return web.json_response({"type": "error", "code": "injected_fault"}, status=status)
+
+    async def create_payment(self, request: web.Request) -> web.Response:
+        fault = self._fault(request)
+        if fault:
+            return fault
+        key = request.headers.get("Idempotence-Key")
+        if not key:
+            self._log(request, 400)
+            return web.json_response({"type": "error", "code": "invalid_request",
+                                      "description": "Idempotence-Key header is required"}, status=400)
+        if key in self.by_idempotence_key:
+            # Повтор с тем же ключом возвращает уже созданный платеж
+            self._log(request, 200)
+            return web.json_response(self.payments[self.by_idempotence_key[key]])
+        body = await request.json()
+        if "amount" not in body:
+            self._log(request, 400)
+            return web.json_response({"type": "error", "code": "invalid_request"}, status=400)
+        payment = self.add_payment(float(body["amount"]["value"]), int(body.get("metadata", {}).get("user_id", 0)))
+        payment["description"] = body.get("description")
+        payment["metadata"] = {key: str(value) for key, value in body.get("metadata", {}).items()}
+        self.by_idempotence_key[key] = payment["id"]
+        self._log(request, 200)
+        return web.json_response(payment)
+
+    async def find_payment(self, request: web.Request) -> web.Response:
+        fault = self._fault(request)
+        if fault:
+            return fault
+        payment = self.payments.get(request.match_info["payment_id"])
+        self._log(request, 200 if payment else 404)
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response(payment)
+
+    async def list_payments(self, request: web.Request) -> web.Response:
+        fault = self._fault(request)
+        if fault:
+            return fault
+        limit = int(request.query.get("limit", "10"))
+        # Курсор - позиция в отфильтрованном списке; ЮKassa тоже кладет фильтры в курсор
+        since = request.query.get("created_at.gte", "")
+        offset = 0
+        if "cursor" in request.query:
+            since, offset_text = request.query["cursor"].split("|", 1)
+            offset = int(offset_text)
+        # Как в ЮKassa: новые платежи первыми
+        items = [self.payments[pid] for pid in reversed(self.order) if self.payments[pid]["created_at"] >= since]
+        page = items[offset:offset + limit]
+        response = {"type": "list", "items": page}
+        if offset + limit < len(items):
+            response["next_cursor"] = f"{since}|{offset + limit}"
+        self._log(request, 200)
+        return web.json_response(response)
+
+    async def control_status(self, request: web.Request) -> web.Response:
+        payment_id, status = request.match_info["payment_id"], request.match_info["status"]
+        if payment_id not in self.payments:
+            return web.Response(status=404)
+        self.set_status(payment_id, status)
+        return web.json_response(self.payments[payment_id])
+
+    async def control_faults(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.inject_faults(int(body["status"]), int(body.get("count", 1)))
+        return web.json_response({"pending_faults": len(self.faults)})
+
+    async def control_requests(self, request: web.Request) -> web.Response:
+        return web.json_response(self.requests)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v3/payments", self.create_payment)
+        app.router.add_get("/v3/payments/{payment_id}", self.find_payment)
+        app.router.add_get("/v3/payments", self.list_payments)
+        app.router.add_post("/_control/payments/{payment_id}/{status:succeeded|canceled}", self.control_status)
+        app.router.add_post("/_control/faults", self.control_faults)
+        app.router.add_get("/_control/requests", self.control_requests)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает базовый адрес API (…/v3)"""
+        self.runner = web.AppRunner(self.build_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        actual_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{actual_port}/v3"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def serve(host: str, port: int):
+    fake = FakeYooKassa()
+    url = await fake.start(host, port)
+    print(f"Поддельная ЮKassa: {url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
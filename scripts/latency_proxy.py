@@ -0,0 +1,72 @@
+"""TCP-прокси, имитирующий сеть между ботом и внешним API, для локальных замеров.
+
+    proxy = LatencyProxy(upstream_port, rtt=0.05, uplink_bytes_per_second=1_250_000)
+    port = await proxy.start()      # клиент подключается к 127.0.0.1:port
+
+Установка соединения задерживается на rtt (SYN / SYN-ACK), каждый пакет - на rtt/2
+в каждую сторону. С uplink_bytes_per_second данные от клиента к серверу проходят
+не быстрее заданной полосы: так выгрузка фото стоит столько, сколько на реальном канале.
+"""
+import asyncio
+from typing import Optional
+
+class LatencyProxy:
+    def __init__(self, upstream_port: int, rtt: float, uplink_bytes_per_second: Optional[float] = None):
+        self.upstream_port = upstream_port
+        self.rtt = rtt
+        self.uplink_bytes_per_second = uplink_bytes_per_second
+        self.server = None
+        self.writers = set()
+        self.handlers = set()
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    bytes_per_second: Optional[float]):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        link_free_at = 0.0
+
+        async def deliver():
+            while True:
+                deliver_at, chunk = await queue.get()
+                if chunk is None:
+                    break
+                await asyncio.sleep(max(0.0, deliver_at - loop.time()))
+                writer.write(chunk)
+                await writer.drain()
+            writer.close()
+
+        delivery = asyncio.create_task(deliver())
+        try:
+            while chunk := await reader.read(65536):
+                sent_at = loop.time()
+                if bytes_per_second:
+                    # Пакеты встают в очередь канала друг за другом
+                    link_free_at = max(link_free_at, sent_at) + len(chunk) / bytes_per_second
+                    sent_at = link_free_at
+                queue.put_nowait((sent_at + self.rtt / 2, chunk))
+        except ConnectionError:
+            pass
+        queue.put_nowait((0, None))
+        await delivery
+
+    async def _handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        self.handlers.add(asyncio.current_task())
+        self.writers.add(client_writer)
+        # SYN / SYN-ACK
+        await asyncio.sleep(self.rtt)
+        upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", self.upstream_port)
+        self.writers.add(upstream_writer)
+        await asyncio.gather(self._pipe(client_reader, upstream_writer, self.uplink_bytes_per_second),
+                             self._pipe(upstream_reader, client_writer, None),
+                             return_exceptions=True)
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        # Соединения закрываются сами, а не отменой задач: отмененный обработчик asyncio пишет в лог как ошибку
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
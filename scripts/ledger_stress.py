@@ -0,0 +1,117 @@
+"""Нагрузочная проверка журнала баланса: нет потерянных обновлений между процессами.
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/ledger_stress.py [процессов] [операций]
+
+Несколько процессов одновременно пополняют баланс, резервируют и закрывают резервы
+(частично, целиком, с возвратом) на одних и тех же пользователях. В конце для каждого
+пользователя должно выполняться SUM(balance_ledger.delta) == images_left, баланс
+не может быть отрицательным, открытых резервов не остается.
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS = 5
+CONCURRENCY = 8
+
+def configure(workdir: str):
+    os.environ["PAYMENTS_DB_PATH"] = os.path.join(workdir, "payments.db")
+    os.environ["CACHE_DB_PATH"] = os.path.join(workdir, "bot_cache.db")
+    os.environ["IMAGE_STORE_DIR"] = os.path.join(workdir, "image_store")
+    sys.path.insert(0, ROOT)
+
+async def hammer(pm, operations: int, seed: int) -> int:
+    rng = random.Random(seed)
+    done = 0
+
+    async def one():
+        user_id = rng.randrange(USERS)
+        action = rng.random()
+        if action < 0.3:
+            await pm.db.transaction(pm.credit_balance, user_id, rng.randint(1, 5), 0, "credit", None)
+            return
+        images = rng.randint(1, 3)
+        hold_id = await pm.reserve_balance(user_id, images)
+        if hold_id is None:
+            return
+        await asyncio.sleep(0)
+        if action < 0.6:
+            await pm.commit_hold(hold_id)
+        elif action < 0.8:
+            await pm.commit_hold(hold_id, used=rng.randint(0, images))
+        else:
+            await pm.release_hold(hold_id)
+
+    async def worker(count: int):
+        nonlocal done
+        for _ in range(count):
+            await one()
+            done += 1
+
+    share = operations // CONCURRENCY
+    await asyncio.gather(*(worker(share) for _ in range(CONCURRENCY)))
+    return done
+
+def run_worker(workdir: str, operations: int, seed: int, results):
+    configure(workdir)
+    import logging
+    logging.disable(logging.WARNING)
+    import pixelmage_pro as pm
+
+    started = time.perf_counter()
+    done = asyncio.run(hammer(pm, operations, seed))
+    results.put((done, time.perf_counter() - started))
+    pm.db.close()
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    workdir = tempfile.mkdtemp(prefix="pixelmage_ledger_")
+    configure(workdir)
+    import logging
+    logging.disable(logging.WARNING)
+    import pixelmage_pro as pm
+    pm.init_db()
+
+    # spawn: при fork дочерний процесс унаследовал бы соединение и поток БД родителя
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [context.Process(target=run_worker, args=(workdir, operations, seed, results))
+               for seed in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            sys.exit(f"Процесс завершился с кодом {worker.exitcode}")
+    for _ in workers:
+        done, seconds = results.get()
+        print(f"процесс: {done} операций за {seconds:.1f} с ({done / seconds:.0f} оп/с)")
+
+    def check(conn):
+        mismatched = conn.execute(
+            """SELECT b.user_id, b.images_left, COALESCE(SUM(l.delta), 0)
+               FROM user_balance b LEFT JOIN balance_ledger l ON l.user_id = b.user_id
+               GROUP BY b.user_id HAVING b.images_left != COALESCE(SUM(l.delta), 0)"""
+        ).fetchall()
+        negative = conn.execute("SELECT COUNT(*) FROM user_balance WHERE images_left < 0").fetchone()[0]
+        holds = conn.execute("SELECT COUNT(*) FROM balance_holds").fetchone()[0]
+        return mismatched, negative, holds
+
+    mismatched, negative, holds = pm.db.transaction_sync(check)
+    pm.db.close()
+    print(f"расхождений журнала: {len(mismatched)}, отрицательных балансов: {negative}, открытых резервов: {holds}")
+    if mismatched or negative or holds:
+        for row in mismatched:
+            print(f"  user_id={row[0]}: images_left={row[1]}, сумма журнала={row[2]}")
+        sys.exit(1)
+    print("✅ журнал сходится с балансами")
+
+if __name__ == "__main__":
+    main()
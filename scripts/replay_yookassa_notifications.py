@@ -0,0 +1,169 @@
+"""Повтор уведомлений ЮKassa против обработчика бота и поддельного API (scripts/fake_yookassa.py).
+
+Запуск из корня репозитория:
+    BOT_TOKEN=123456:ABC AITUNNEL_API_KEY=x python scripts/replay_yookassa_notifications.py
+    ... --copies 50                        сколько одинаковых уведомлений слать одновременно
+    ... --url http://host:8080/yookassa/notifications --bodies saved.json
+                                           переслать сохраненные тела в запущенный бот
+
+Без --url поднимает веб-приложение бота и поддельную ЮKassa на свободных портах,
+базы создаются во временном каталоге. Проверяется:
+    * N одновременных payment.succeeded зачисляют платеж и уведомляют пользователя один раз;
+    * уведомление, которое API не подтверждает (платеж еще pending), ничего не зачисляет;
+    * payment.canceled отменяет ожидающий платеж;
+    * битое тело - 400, уведомление о неизвестном платеже - 200 без изменений;
+    * при YOOKASSA_NOTIFICATION_IP_CHECK запрос с 127.0.0.1 получает 403, в том числе
+      с поддельным X-Forwarded-For; за прокси (TRUSTED_PROXY_HOPS) проходит только адрес,
+      дописанный прокси.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+import aiohttp
+from aiohttp import web
+
+WORKDIR = tempfile.mkdtemp(prefix="pixelmage_notifications_")
+os.environ.setdefault("PAYMENTS_DB_PATH", os.path.join(WORKDIR, "payments.db"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(WORKDIR, "bot_cache.db"))
+os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(WORKDIR, "image_store"))
+os.environ["YOOKASSA_SHOP_ID"] = "fake-shop"
+os.environ["YOOKASSA_SECRET_KEY"] = "fake-secret"
+os.environ["YOOKASSA_NOTIFICATIONS"] = "1"
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTS))
+sys.path.insert(0, SCRIPTS)
+
+import pixelmage_pro as pm  # noqa: E402
+from fake_yookassa import FakeYooKassa  # noqa: E402
+
+failures = []
+notified = []
+
+def check(condition: bool, description: str):
+    print(f"{'✅' if condition else '❌'} {description}")
+    if not condition:
+        failures.append(description)
+
+def notification(event: str, payment: dict) -> dict:
+    return {"type": "notification", "event": event,
+            "object": {"id": payment["id"], "status": event.split(".")[1], "amount": payment["amount"]}}
+
+async def post_all(session: aiohttp.ClientSession, url: str, bodies: list,
+                   forwarded_for: str = None) -> list:
+    headers = {"Content-Type": "application/json"}
+    if forwarded_for:
+        headers["X-Forwarded-For"] = forwarded_for
+
+    async def post(body):
+        data = body if isinstance(body, (str, bytes)) else json.dumps(body)
+        async with session.post(url, data=data, headers=headers) as response:
+            return response.status
+    return await asyncio.gather(*(post(body) for body in bodies))
+
+async def balance(user_id: int) -> int:
+    row = await pm.db.fetchone("SELECT images_left FROM user_balance WHERE user_id = ?", (user_id,))
+    return row[0] if row else 0
+
+async def payment_status(yookassa_payment_id: str) -> str:
+    row = await pm.db.fetchone("SELECT status FROM payments WHERE yookassa_payment_id = ?", (yookassa_payment_id,))
+    return row[0] if row else None
+
+async def replay_file(url: str, path: str):
+    """Пересылает сохраненные тела уведомлений по одному и печатает ответы"""
+    with open(path, encoding="utf-8") as f:
+        bodies = json.load(f)
+    async with aiohttp.ClientSession() as session:
+        for body in bodies if isinstance(bodies, list) else [bodies]:
+            [status] = await post_all(session, url, [body])
+            print(f"{status} {body.get('event')} {body.get('object', {}).get('id')}")
+
+async def run_scenarios(copies: int):
+    pm.init_db()
+    fake = FakeYooKassa()
+    pm.yookassa_client.base_url = await fake.start()
+
+    # Пользователю в Telegram ничего не отправляем, только считаем уведомления
+    async def fake_notify(user_id: int, images_added: int):
+        notified.append((user_id, images_added))
+    pm.notify_payment_completed = fake_notify
+
+    runner = web.AppRunner(pm.build_web_app(False, asyncio.Event()))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{pm.YOOKASSA_NOTIFICATION_PATH}"
+
+    async with aiohttp.ClientSession() as session:
+        # 1. Дубли одного уведомления приходят одновременно
+        paid = await pm.create_yookassa_payment(201, 99.0, "Пакет 5")
+        payment = fake.payments[paid["payment_id"]]
+        fake.set_status(payment["id"], "succeeded")
+        statuses = await post_all(session, url, [notification("payment.succeeded", payment)] * copies)
+        check(statuses == [200] * copies, f"все {copies} уведомлений приняты с ответом 200")
+        check(await balance(201) == 5, "платеж зачислен один раз")
+        check(notified == [(201, 5)], "пользователь уведомлен один раз")
+
+        # 2. Тело говорит succeeded, а API - pending: не доверяем телу
+        pending = await pm.create_yookassa_payment(202, 199.0, "Пакет 15")
+        pending_payment = fake.payments[pending["payment_id"]]
+        statuses = await post_all(session, url, [notification("payment.succeeded", pending_payment)])
+        check(statuses == [200] and await balance(202) == 0, "неподтвержденное уведомление не зачислено")
+        check(await payment_status(pending_payment["id"]) == "pending", "платеж остался ожидающим")
+
+        # 3. Отмена
+        fake.set_status(pending_payment["id"], "canceled")
+        await post_all(session, url, [notification("payment.canceled", pending_payment)] * 3)
+        check(await payment_status(pending_payment["id"]) == "canceled" and await balance(202) == 0,
+              "payment.canceled отменил платеж без зачисления")
+
+        # 4. Мусор и неизвестные платежи
+        statuses = await post_all(session, url, ["not json", {"event": "payment.succeeded"}])
+        check(statuses == [400, 400], "битые тела получают 400")
+        unknown = fake.add_payment(29.0, 203, status="succeeded")
+        statuses = await post_all(session, url, [notification("payment.succeeded", unknown)])
+        check(statuses == [200] and await balance(203) == 0, "неизвестный платеж не зачислен")
+
+        # 5. Проверка адреса отправителя
+        body = notification("payment.succeeded", payment)
+        yookassa_ip = "185.71.76.1"
+        pm.YOOKASSA_NOTIFICATION_IP_CHECK = True
+        statuses = await post_all(session, url, [body])
+        check(statuses == [403], "запрос с 127.0.0.1 отклонен с 403")
+        statuses = await post_all(session, url, [body], forwarded_for=yookassa_ip)
+        check(statuses == [403], "без доверенного прокси X-Forwarded-For игнорируется")
+
+        pm.TRUSTED_PROXY_HOPS = 1
+        # Клиент подставил адрес ЮKassa, прокси дописал настоящий
+        statuses = await post_all(session, url, [body], forwarded_for=f"{yookassa_ip}, 203.0.113.7")
+        check(statuses == [403], "поддельная левая запись X-Forwarded-For отклонена с 403")
+        statuses = await post_all(session, url, [body])
+        check(statuses == [403], "запрос в обход прокси (без X-Forwarded-For) отклонен с 403")
+        statuses = await post_all(session, url, [body], forwarded_for=yookassa_ip)
+        check(statuses == [200] and await balance(201) == 5, "адрес ЮKassa от прокси принят, повторного зачисления нет")
+        pm.TRUSTED_PROXY_HOPS = 0
+        pm.YOOKASSA_NOTIFICATION_IP_CHECK = False
+
+    await runner.cleanup()
+    await fake.stop()
+    await pm.yookassa_client.close()
+    pm.db.close()
+    if failures:
+        sys.exit(f"Провалено проверок: {len(failures)}")
+    print("Все проверки пройдены")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=20)
+    parser.add_argument("--url", help="адрес уведомлений запущенного бота")
+    parser.add_argument("--bodies", help="JSON-файл с телом уведомления или их списком")
+    args = parser.parse_args()
+    if args.url:
+        if not args.bodies:
+            parser.error("--url требует --bodies")
+        asyncio.run(replay_file(args.url, args.bodies))
+    else:
+        asyncio.run(run_scenarios(args.copies))